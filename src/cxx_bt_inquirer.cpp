@@ -0,0 +1,167 @@
+#include "cxx_bt_inquirer.hpp"
+
+#include "application_config.h"
+#include "common/panic.h"
+#include "panic_list.hpp"
+
+// -------------------------------------------------------------------
+
+CCxxBtInquirer* CCxxBtInquirer::NewL()
+{
+  CCxxBtInquirer* obj = new (ELeave) CCxxBtInquirer();
+  CleanupStack::PushL(obj);
+  obj->ConstructL();
+  CleanupStack::Pop();
+  return obj;
+}
+
+CCxxBtInquirer::CCxxBtInquirer() : CActive(EPriorityStandard)
+{
+  CActiveScheduler::Add(this);
+}
+
+void CCxxBtInquirer::ConstructL()
+{
+  LEAVE_IF_ERROR_OR_SET_SESSION_OPEN(iSocketServ, iSocketServ.Connect());
+
+  _LIT(KLinkManager, "BTLinkManager");
+  TProtocolDesc protocolInfo;
+  User::LeaveIfError(iSocketServ.FindProtocol(KLinkManager(), protocolInfo));
+
+  LEAVE_IF_ERROR_OR_SET_SESSION_OPEN(iResolver, iResolver.Open(iSocketServ, protocolInfo.iAddrFamily, protocolInfo.iProtocol));
+}
+
+CCxxBtInquirer::~CCxxBtInquirer()
+{
+  Cancel(); // safe when AO inactive as DoCancel not called
+  SESSION_CLOSE_IF_OPEN(iResolver);
+  SESSION_CLOSE_IF_OPEN(iSocketServ);
+  FreeCallback();
+}
+
+void CCxxBtInquirer::SetCallback(PyObject* aCallback)
+{
+  if (IsActive()) Cancel();
+  FreeCallback();
+  iCallback = aCallback;
+  Py_INCREF(iCallback);
+}
+
+void CCxxBtInquirer::Discover(TBool aWithNames, PyObject* aCallback)
+{
+  SetCallback(aCallback);
+  iAddr = TInquirySockAddr();
+  iAddr.SetIAC(KGIAC);
+  TUint action = KHostResInquiry | KHostResIgnoreCache;
+  if (aWithNames)
+    action |= KHostResName;
+  iAddr.SetAction(action);
+  iResolver.GetByAddress(iAddr, iEntry, iStatus);
+  SetActive();
+}
+
+// To be called from the callback, to get the next device found by
+// "Discover".
+void CCxxBtInquirer::Next()
+{
+  if (IsActive()) return;
+  iResolver.Next(iEntry, iStatus);
+  SetActive();
+}
+
+void CCxxBtInquirer::LookupName(const TBTDevAddr& aAddr, PyObject* aCallback)
+{
+  SetCallback(aCallback);
+  iAddr = TInquirySockAddr();
+  iAddr.SetBTAddr(aAddr);
+  iAddr.SetAction(KHostResName | KHostResIgnoreCache);
+  iResolver.GetByAddress(iAddr, iEntry, iStatus);
+  SetActive();
+}
+
+// Calls the callback with the error code, the address of the device
+// as 12 lower case hex digits, and the name of the device, which is
+// empty if it was not asked for.
+void CCxxBtInquirer::PythonCall(TInt errCode)
+{
+  TBuf8<12> mac;
+  TPtrC name(KNullDesC);
+  if (!errCode)
+    {
+      const TBTDevAddr& addr = TInquirySockAddr::Cast(iEntry().iAddr).BTAddr();
+      for (TInt i = 0; i < KBTDevAddrSize; i++)
+	mac.AppendNumFixedWidth(addr[i], EHex, 2);
+      name.Set(iEntry().iName);
+    }
+
+  PyEval_RestoreThread(PYTHON_TLS->thread_state);
+
+  PyObject* arg = Py_BuildValue("(is#u#)", errCode,
+				mac.Ptr(), mac.Length(),
+				name.Ptr(), name.Length());
+  if (arg)
+    {
+      // Keep the callback alive, as it may start a new request.
+      PyObject* cb = iCallback;
+      Py_INCREF(cb);
+      PyObject* result = PyObject_CallObject(cb, arg);
+      Py_DECREF(cb);
+      Py_DECREF(arg);
+      Py_XDECREF(result);
+      if (!result)
+        {
+          // Callbacks are not supposed to throw exceptions. Make sure
+          // that the error gets noticed.
+          PyErr_Clear();
+          Panic(EPanicExceptionInCallback);
+        }
+    }
+
+  PyEval_SaveThread();
+}
+
+void CCxxBtInquirer::RunL()
+{
+  PythonCall(iStatus.Int());
+}
+  
+// Actually this should never get called.
+TInt CCxxBtInquirer::RunError(TInt aError)
+{
+  PythonCall(aError);
+  return KErrNone;
+}
+
+void CCxxBtInquirer::DoCancel() 
+{
+  iResolver.Cancel();
+}
+
+/**
+
+Copyright 2010 Helsinki Institute for Information Technology (HIIT)
+and the authors. All rights reserved.
+
+Authors: Tero Hasu <tero.hasu@hut.fi>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation files
+(the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge,
+publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+ **/
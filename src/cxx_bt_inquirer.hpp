@@ -0,0 +1,91 @@
+#ifndef __cxx_bt_inquirer_hpp__
+#define __cxx_bt_inquirer_hpp__
+
+#include <Python.h>
+#include <e32std.h>
+
+#include <es_sock.h> // link against esock.lib
+#include <bt_sock.h> // link against bluetooth.lib
+
+#include "common/epoc-session.hpp"
+
+// Bluetooth device discovery, optionally without remote name
+// requests, which take seconds per device. Also looks up the name of
+// a given device.
+NONSHARABLE_CLASS(CCxxBtInquirer) :
+  public CActive
+{
+ public:
+
+  static CCxxBtInquirer* NewL();
+
+  virtual ~CCxxBtInquirer();
+
+  void Discover(TBool aWithNames, PyObject* aCallback);
+
+  void Next();
+
+  void LookupName(const TBTDevAddr& aAddr, PyObject* aCallback);
+
+ private:
+ 
+  CCxxBtInquirer();
+
+  void ConstructL();
+
+  void FreeCallback() { if (iCallback) { Py_DECREF(iCallback); iCallback = NULL; } }
+
+  void SetCallback(PyObject* aCallback);
+
+  void PythonCall(TInt errCode);
+
+ private: // CActive
+
+  virtual void RunL();
+  
+  virtual TInt RunError(TInt aError);
+
+  virtual void DoCancel();
+
+ private:
+
+  DEF_SESSION(RSocketServ, iSocketServ);
+  DEF_SESSION(RHostResolver, iResolver);
+
+  TInquirySockAddr iAddr;
+  TNameEntry iEntry;
+
+  PyObject* iCallback;
+
+};
+
+#endif /* __cxx_bt_inquirer_hpp__ */
+
+/**
+
+Copyright 2010 Helsinki Institute for Information Technology (HIIT)
+and the authors. All rights reserved.
+
+Authors: Tero Hasu <tero.hasu@hut.fi>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation files
+(the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge,
+publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+ **/
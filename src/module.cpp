@@ -36,6 +36,7 @@
 
 #include "py_get_position.hpp"
 #include "py_positioner.hpp"
+#include "py_bt_inquirer.hpp"
 
 // -------------------------------------------------------
 // Python module...
@@ -65,6 +66,7 @@ static PyMethodDef const _ft__pytwink[] = {
   {"set_softkey_text", reinterpret_cast<PyCFunction>(_fn__pytwink__set_softkey_text), METH_VARARGS, NULL},
   {"get_current_position", reinterpret_cast<PyCFunction>(py_GetCurrentPosition), METH_VARARGS, NULL},
   {"Positioner", (PyCFunction)new_Positioner, METH_VARARGS},
+  {"BtInquirer", (PyCFunction)new_BtInquirer, METH_NOARGS},
   {NULL}};
 
 EXPORT_C void initpytwink()
@@ -74,6 +76,7 @@ EXPORT_C void initpytwink()
     return;
   }
   if (def_Positioner() < 0) return;
+  if (def_BtInquirer() < 0) return;
 }
 
 #ifndef EKA2
@@ -0,0 +1,196 @@
+#include "py_bt_inquirer.hpp"
+#include "cxx_bt_inquirer.hpp"
+
+#include "application_config.h"
+#include "common/panic.h"
+#include "panic_list.hpp"
+
+#include <symbian_python_ext_util.h>
+#include "local_epoc_py_utils.h"
+
+typedef struct
+{
+  PyObject_VAR_HEAD;
+  CCxxBtInquirer* iCppObject;
+} obj_BtInquirer;
+
+static PyObject* check_callback(PyObject* cb)
+{
+  if (!PyCallable_Check(cb))
+    {
+      PyErr_SetString(PyExc_TypeError, "parameter must be callable");
+      return NULL;
+    }
+  return cb;
+}
+
+static PyObject* meth_discover(obj_BtInquirer* self, PyObject* args)
+{
+  if (!self->iCppObject)
+    Panic(EPanicSessionAlreadyClosed);
+
+  TInt withNames;
+  PyObject* cb;
+  if (!PyArg_ParseTuple(args, "iO", &withNames, &cb))
+    {
+      return NULL;
+    }
+  if (!check_callback(cb))
+    return NULL;
+
+  self->iCppObject->Discover(withNames ? ETrue : EFalse, cb);
+  
+  RETURN_NO_VALUE;
+}
+
+static PyObject* meth_next(obj_BtInquirer* self, PyObject* /*args*/)
+{
+  if (!self->iCppObject)
+    Panic(EPanicSessionAlreadyClosed);
+  self->iCppObject->Next();
+  RETURN_NO_VALUE;
+}
+
+static PyObject* meth_lookup_name(obj_BtInquirer* self, PyObject* args)
+{
+  if (!self->iCppObject)
+    Panic(EPanicSessionAlreadyClosed);
+
+  char* mac;
+  TInt macLen;
+  PyObject* cb;
+  if (!PyArg_ParseTuple(args, "s#O", &mac, &macLen, &cb))
+    {
+      return NULL;
+    }
+  if (!check_callback(cb))
+    return NULL;
+
+  TBuf<12> readable;
+  TBTDevAddr addr;
+  if (macLen != 12)
+    {
+      PyErr_SetString(PyExc_ValueError, "address must be 12 hex digits");
+      return NULL;
+    }
+  readable.Copy(TPtrC8((TUint8*)mac, macLen));
+  if (addr.SetReadable(readable) != 12)
+    {
+      PyErr_SetString(PyExc_ValueError, "address must be 12 hex digits");
+      return NULL;
+    }
+
+  self->iCppObject->LookupName(addr, cb);
+  
+  RETURN_NO_VALUE;
+}
+
+static PyObject* meth_cancel(obj_BtInquirer* self, PyObject* /*args*/)
+{
+  if (!self->iCppObject)
+    Panic(EPanicSessionAlreadyClosed);
+  self->iCppObject->Cancel();
+  RETURN_NO_VALUE;
+}
+
+static PyObject* meth_close(obj_BtInquirer* self, PyObject* /*args*/)
+{
+  delete self->iCppObject;
+  self->iCppObject = NULL;
+  RETURN_NO_VALUE;
+}
+
+static const PyMethodDef BtInquirer_methods[] =
+  {
+    {"discover", (PyCFunction)meth_discover, METH_VARARGS, NULL},
+    {"next", (PyCFunction)meth_next, METH_NOARGS, NULL},
+    {"lookup_name", (PyCFunction)meth_lookup_name, METH_VARARGS, NULL},
+    {"cancel", (PyCFunction)meth_cancel, METH_NOARGS, NULL},
+    {"close", (PyCFunction)meth_close, METH_NOARGS, NULL},
+    {NULL, NULL} /* sentinel */
+  };
+
+static void del_BtInquirer(obj_BtInquirer *self)
+{
+  delete self->iCppObject;
+  self->iCppObject = NULL;
+  PyObject_Del(self);
+}
+
+static PyObject *getattr_BtInquirer(obj_BtInquirer *self, char *name)
+{
+  return Py_FindMethod(METHOD_TABLE(BtInquirer), reinterpret_cast<PyObject*>(self), name);
+}
+
+const static PyTypeObject tmpl_BtInquirer =
+  {
+    PyObject_HEAD_INIT(NULL)
+    0, /*ob_size*/
+    "pytwink.BtInquirer", /*tp_name*/
+    sizeof(obj_BtInquirer), /*tp_basicsize*/
+    0, /*tp_itemsize*/
+    /* methods */
+    (destructor)del_BtInquirer, /*tp_dealloc*/
+    0, /*tp_print*/
+    (getattrfunc)getattr_BtInquirer, /*tp_getattr*/
+    0, /*tp_setattr*/
+    0, /*tp_compare*/
+    0, /*tp_repr*/
+    0, /*tp_as_number*/
+    0, /*tp_as_sequence*/
+    0, /*tp_as_mapping*/
+    0 /*tp_hash*/
+  };
+
+TInt def_BtInquirer()
+{
+  return ConstructType(&tmpl_BtInquirer, "pytwink.BtInquirer");
+}
+
+PyObject* new_BtInquirer(PyObject* /*self*/, PyObject* /*args*/)
+{
+  PyTypeObject* typeObject = reinterpret_cast<PyTypeObject*>(SPyGetGlobalString("pytwink.BtInquirer"));
+  obj_BtInquirer* self = PyObject_New(obj_BtInquirer, typeObject);
+  if (self == NULL)
+      return NULL;
+  self->iCppObject = NULL;
+
+  TRAPD(error,
+	self->iCppObject = CCxxBtInquirer::NewL();
+	);
+  if (error) {
+    PyObject_Del(self);
+    return SPyErr_SetFromSymbianOSErr(error);
+  }
+
+  return reinterpret_cast<PyObject*>(self);
+}
+
+/**
+
+Copyright 2010 Helsinki Institute for Information Technology (HIIT)
+and the authors. All rights reserved.
+
+Authors: Tero Hasu <tero.hasu@hut.fi>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation files
+(the "Software"), to deal in the Software without restriction,
+including without limitation the rights to use, copy, modify, merge,
+publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+ **/
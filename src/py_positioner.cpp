@@ -78,6 +78,24 @@ static PyObject* meth_get_position(obj_Positioner* self, PyObject* /*args*/)
 		       "horizontal_accuracy", position.HorizontalAccuracy());
 }
 
+// Like "get_position", but returns a tuple (latitude, longitude,
+// altitude, vertical_accuracy, horizontal_accuracy), which is cheaper
+// to make and to keep than a dictionary.
+static PyObject* meth_get_fix(obj_Positioner* self, PyObject* /*args*/)
+{
+  if (!self->iCppObject)
+    Panic(EPanicSessionAlreadyClosed);
+
+  const TPosition& position = self->iCppObject->Position();
+
+  return Py_BuildValue("(ddddd)",
+		       position.Latitude(),
+		       position.Longitude(),
+		       position.Altitude(),
+		       position.VerticalAccuracy(),
+		       position.HorizontalAccuracy());
+}
+
 static PyObject* meth_cancel(obj_Positioner* self, PyObject* /*args*/)
 {
   if (!self->iCppObject)
@@ -97,6 +115,7 @@ static const PyMethodDef Positioner_methods[] =
   {
     {"ask_position", (PyCFunction)meth_ask_position, METH_VARARGS, NULL},
     {"get_position", (PyCFunction)meth_get_position, METH_NOARGS, NULL},
+    {"get_fix", (PyCFunction)meth_get_fix, METH_NOARGS, NULL},
     {"cancel", (PyCFunction)meth_cancel, METH_NOARGS, NULL},
     {"close", (PyCFunction)meth_close, METH_NOARGS, NULL},
     {NULL, NULL} /* sentinel */
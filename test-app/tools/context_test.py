@@ -0,0 +1,454 @@
+#
+# Copyright 2007 Helsinki Institute for Information Technology (HIIT)
+# and the authors.  All rights reserved.
+#
+# Authors: Tero Hasu <tero.hasu@hut.fi>
+#
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Tests of the context scanning and positioning of the engine on a
+# PC, against the stand-ins of "upload_bench", with its clock skipping
+# over any waits. Requires Python 2, like the application.
+#
+#   python context_test.py
+
+import sys
+import tempfile
+import unittest
+
+import upload_bench
+
+engine = upload_bench.import_engine()
+loop = upload_bench.loop
+location = sys.modules["location"]
+
+def quiet_report(*args):
+    pass
+
+engine.ut.report = quiet_report
+
+def new_config():
+    engine.configdb_file = tempfile.mktemp()
+    return engine.Config()
+
+def run_for(secs):
+    """
+    Runs the loop until the given number of seconds has passed.
+    """
+    until = loop.now() + secs
+    loop.call_at(until, lambda: None)
+    loop.run_until(lambda: loop.now() >= until)
+
+class CellTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.config = new_config()
+        self.tracker = engine.CellTracker(self.config)
+        self.cell = location.cell
+        self.samples = []
+        self.gsm_location = location.gsm_location
+        location.gsm_location = self.sample
+
+    def tearDown(self):
+        self.tracker.stop()
+        location.gsm_location = self.gsm_location
+        location.cell = self.cell
+
+    def sample(self):
+        self.samples.append(loop.now())
+        return self.gsm_location()
+
+    def set_cell_at(self, secs, cell):
+        loop.call_at(loop.now() + secs,
+                     lambda: setattr(location, "cell", cell))
+
+    def gaps(self):
+        """
+        Returns the intervals between the samples taken, in whole
+        seconds.
+        """
+        result = []
+        for i in range(1, len(self.samples)):
+            result.append(int(round(self.samples[i] - self.samples[i - 1])))
+        return result
+
+    def test_backoff(self):
+        min_interval = self.config.get_gsm_min_interval()
+        max_interval = self.config.get_gsm_max_interval()
+        self.tracker.start()
+        run_for(1000)
+        gaps = self.gaps()
+        interval = min_interval
+        for gap in gaps:
+            self.assertEqual(gap, interval)
+            interval = min(interval * 2, max_interval)
+        self.assertEqual(gaps[-1], max_interval)
+        self.assertEqual(len(self.tracker.changes), 1)
+
+    def test_change_resets_interval(self):
+        cell_a = (244, 5, 4020, 1)
+        cell_b = (244, 5, 4021, 2)
+        location.cell = cell_a
+        self.tracker.start()
+        run_for(500)
+        self.set_cell_at(1, cell_b)
+        n = len(self.samples)
+        run_for(300)
+        self.assertEqual(self.tracker.cell, cell_b)
+        # The first sample to see the new cell is followed by one
+        # after the minimum interval.
+        gaps = self.gaps()[n - 1:]
+        self.assertEqual(gaps[1], self.config.get_gsm_min_interval())
+
+    def test_history(self):
+        cells = [(244, 5, 4020, 1), None, (244, 5, 4021, 2)]
+        location.cell = cells[0]
+        start = loop.now()
+        self.tracker.start()
+        self.set_cell_at(200, cells[1])
+        self.set_cell_at(400, cells[2])
+        run_for(600)
+        history = self.tracker.history(900)
+        self.assertEqual([ entry[1:] for entry in history ],
+                         [[244, 5, 4020, 1], [None, None, None, None],
+                          [244, 5, 4021, 2]])
+        times = [ entry[0] - int(start) for entry in history ]
+        self.failUnless(times[0] <= 1)
+        self.failUnless(200 <= times[1] < 200 + 120)
+        self.failUnless(400 <= times[2] < 400 + 120)
+        # Only the changes within the window.
+        window = loop.now() - start - 300
+        self.assertEqual(len(self.tracker.history(window)), 1)
+
+    def test_log_size(self):
+        self.tracker.start()
+        for i in range(self.config.get_gsm_log_size() + 5):
+            location.cell = (244, 5, 4020, i)
+            run_for(self.config.get_gsm_min_interval())
+        self.assertEqual(len(self.tracker.changes),
+                         self.config.get_gsm_log_size())
+
+    def test_restart_keeps_log(self):
+        location.cell = (244, 5, 4020, 1)
+        self.tracker.start()
+        run_for(100)
+        first = self.tracker.changes[0]
+        self.tracker.stop()
+        self.assertEqual(self.tracker.cell, None)
+        self.tracker.start()
+        run_for(100)
+        # The same cell again is no change.
+        self.assertEqual(self.tracker.changes, [first])
+        location.cell = (244, 5, 4021, 2)
+        run_for(200)
+        self.assertEqual(len(self.tracker.changes), 2)
+
+class FakePositioner:
+    """
+    A "pytwink.Positioner" whose module answers after the delay, and
+    with the horizontal accuracy, given in "behavior" for its ID. An
+    accuracy of None makes it answer with an error.
+    """
+    behavior = {}
+    made = []
+    asked = []
+
+    def __init__(self, module_id, update_timeout, max_update_age):
+        self.module_id = module_id
+        self.entry = None
+        self.closed = False
+        FakePositioner.made.append(self)
+
+    def ask_position(self, cb):
+        FakePositioner.asked.append(self.module_id)
+        delay, accuracy = self.behavior[self.module_id]
+        if accuracy is None:
+            code = -1
+        else:
+            code = 0
+        self.entry = loop.call_at(loop.now() + delay, self._answer, cb, code)
+
+    def _answer(self, cb, code):
+        self.entry = None
+        cb(code)
+
+    def get_position(self):
+        nan = engine.INFINITY - engine.INFINITY
+        return {"latitude": 60.0 + self.module_id, "longitude": 24.0,
+                "altitude": nan, "vertical_accuracy": nan,
+                "horizontal_accuracy": self.behavior[self.module_id][1]}
+
+    def cancel(self):
+        loop.cancel(self.entry)
+        self.entry = None
+
+    def close(self):
+        self.cancel()
+        self.closed = True
+
+class FakePositioning:
+    def modules(self):
+        return [{"name": u"Network based", "id": 1, "available": 1},
+                {"name": u"Integrated GPS", "id": 2, "available": 1},
+                {"name": u"Bluetooth GPS", "id": 3, "available": 1},
+                {"name": u"Assisted GPS", "id": 4, "available": 0}]
+
+class FakeOutbox:
+    def poke(self):
+        pass
+
+class PositionTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (engine.gps_avail, getattr(engine, "positioning", None),
+                      engine.Positioner, engine.save_unsent_card)
+        engine.gps_avail = True
+        engine.positioning = FakePositioning()
+        engine.Positioner = FakePositioner
+        engine.save_unsent_card = lambda request: None
+        FakePositioner.made = []
+        FakePositioner.asked = []
+        FakePositioner.behavior = {1: (3, 2000.0), 2: (40, 8.0),
+                                   3: (12, 30.0)}
+        self.config = new_config()
+        self.config.db["store_on"] = True
+        self.config.db["btprox_scanning_enabled"] = False
+        self.sender = engine.ScannerSender(self.config, FakeOutbox())
+
+    def tearDown(self):
+        self.sender.close()
+        (engine.gps_avail, engine.positioning,
+         engine.Positioner, engine.save_unsent_card) = self.saved
+
+    def acquire(self):
+        """
+        Returns the position acquired, and the seconds it took.
+        """
+        acquirer = engine.PositionAcquirer(self.config)
+        result = []
+        start = loop.now()
+        acquirer.acquire(lambda position: result.append(position))
+        loop.run_until(lambda: result)
+        acquirer.close()
+        return result[0], int(round(loop.now() - start))
+
+    def test_first_accurate_fix(self):
+        position, secs = self.acquire()
+        self.assertEqual((position["latitude"], secs), (63.0, 12))
+        # The others were cancelled.
+        for positioner in FakePositioner.made:
+            self.assertEqual(positioner.entry, None)
+            self.failUnless(positioner.closed)
+
+    def test_best_fix_at_deadline(self):
+        self.config.db["position_accuracy"] = 5
+        position, secs = self.acquire()
+        self.assertEqual((position["latitude"], secs),
+                         (63.0, self.config.get_position_deadline()))
+
+    def test_all_answered(self):
+        FakePositioner.behavior[2] = (4, None)
+        FakePositioner.behavior[3] = (5, None)
+        position, secs = self.acquire()
+        self.assertEqual((position["latitude"], secs), (61.0, 5))
+
+    def test_modules_setting(self):
+        self.config.db["position_modules"] = [u"Integrated GPS"]
+        FakePositioner.behavior[2] = (4, None)
+        position, secs = self.acquire()
+        self.assertEqual((position, secs), (None, 4))
+        self.assertEqual(len(FakePositioner.made), 1)
+
+    def send(self, card = None):
+        if card is None:
+            card = engine.Card(self.config, None)
+        out = []
+        self.sender.scan_and_send(card, lambda status, msg:
+                                  out.append(status))
+        loop.run_until(lambda: out and out[-1] in ("ok", "fail"))
+        self.assertEqual(out[-1], "ok")
+        return card
+
+    def test_concurrent(self):
+        card = self.send()
+        self.assertEqual(card.gps["position"]["latitude"], 63.0)
+
+    def test_sequential(self):
+        self.config.db["concurrent_scan"] = False
+        card = self.send()
+        self.assertEqual(card.gps["position"]["latitude"], 63.0)
+
+    def test_sequential_cached_btprox(self):
+        self.config.db["concurrent_scan"] = False
+        self.config.db["btprox_scanning_enabled"] = True
+        self.sender.context.put("btprox", engine.BtDevices())
+        card = self.send()
+        self.failIf(card.btprox is None)
+        self.assertEqual(card.gps["position"]["latitude"], 63.0)
+
+    def test_cached_position(self):
+        self.config.db["concurrent_scan"] = False
+        self.send()
+        n = len(FakePositioner.asked)
+        card = self.send()
+        self.assertEqual(card.gps["position"]["latitude"], 63.0)
+        self.assertEqual(len(FakePositioner.asked), n)
+
+    def test_reused_card(self):
+        self.config.db["concurrent_scan"] = False
+        card = engine.Card(self.config, None)
+        self.send(card)
+        self.assertEqual(card.gps["position"]["latitude"], 63.0)
+        n = len(FakePositioner.asked)
+        # The network module is now accurate enough, and the fix
+        # sent before is long out of date.
+        FakePositioner.behavior[1] = (3, 100.0)
+        loop.skew += 3600
+        self.send(card)
+        self.failUnless(len(FakePositioner.asked) > n)
+        self.assertEqual(card.gps["position"]["latitude"], 61.0)
+
+    def test_gps_scanning_fix(self):
+        fix = {"position": {"latitude": 65.0, "longitude": 25.0,
+                            "altitude": 10.0, "vertical_accuracy": 5.0,
+                            "horizontal_accuracy": 5.0},
+               "course": None, "satellites": None}
+        self.sender.gps_fix = fix
+        loop.skew += 3600
+        card = self.send()
+        self.assertEqual(card.gps, fix)
+        self.assertEqual(FakePositioner.asked, [])
+
+    def test_view_acquired_position(self):
+        forms = []
+        class Form:
+            def __init__(self, fields, flags):
+                forms.append(fields)
+            def execute(self):
+                pass
+        appuifw = engine.appuifw
+        appuifw.Form = Form
+        appuifw.FFormDoubleSpaced = 1
+        appuifw.FFormViewModeOnly = 2
+        try:
+            card = self.send()
+            card.view_gps(u"Network based")
+        finally:
+            del appuifw.Form
+        self.assertEqual(len(forms[0]), 5)
+
+class FakeFixPositioner:
+    """
+    A "pytwink.Positioner" that answers every request after two
+    seconds, with a fix whose latitude counts the answers. Every fifth
+    request fails.
+    """
+    def __init__(self, module_id, update_timeout, max_update_age):
+        self.update_timeout = update_timeout
+        self.entry = None
+        self.answers = 0
+        self.closed = False
+
+    def ask_position(self, cb):
+        self.entry = loop.call_at(loop.now() + 2, self._answer, cb)
+
+    def _answer(self, cb):
+        self.entry = None
+        self.answers += 1
+        if self.answers % 5 == 0:
+            cb(-1)
+        else:
+            cb(0)
+
+    def get_fix(self):
+        return (float(self.answers), 24.0, 10.0, 5.0, 12.5)
+
+    def cancel(self):
+        loop.cancel(self.entry)
+        self.entry = None
+
+    def close(self):
+        self.cancel()
+        self.closed = True
+
+class FakeDefaultPositioning:
+    def default_module(self):
+        return 7
+
+class PositionStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (engine.gps_avail, getattr(engine, "positioning", None),
+                      engine.Positioner)
+        engine.gps_avail = True
+        engine.positioning = FakeDefaultPositioning()
+        engine.Positioner = FakeFixPositioner
+        self.config = new_config()
+        self.config.db["position_buffer_size"] = 8
+        self.config.db["position_batch_size"] = 3
+        self.config.db["position_interval"] = 10
+        self.stream = engine.PositionStream(self.config)
+        self.batches = []
+        self.stream.subscribe(self.delivered)
+
+    def tearDown(self):
+        self.stream.close()
+        (engine.gps_avail, engine.positioning,
+         engine.Positioner) = self.saved
+
+    def delivered(self, batch):
+        self.batches.append([ int(fix[1]) for fix in batch ])
+
+    def test_batches_and_wrap_around(self):
+        self.stream.start()
+        positioner = self.stream.positioner
+        self.assertEqual(positioner.update_timeout,
+                         self.config.get_position_update_timeout() * 1000000)
+        # Answers at 2, 14, 26, ... seconds, the fifth one failing.
+        run_for(125)
+        self.assertEqual(positioner.answers, 11)
+        # Delivered in batches of 3, before the next request.
+        self.assertEqual(self.batches, [[1, 2, 3], [4, 6, 7]])
+        # Only the latest 8 fixes are kept, oldest first.
+        self.assertEqual([ int(fix[1]) for fix in self.stream.fixes() ],
+                         [2, 3, 4, 6, 7, 8, 9, 11])
+        self.assertEqual(self.stream.latest()[1:],
+                         (11.0, 24.0, 10.0, 5.0, 12.5))
+        self.assertEqual(len(self.stream.fixes(3)), 3)
+        # The rest on demand.
+        self.stream.flush()
+        self.assertEqual(self.batches[-1], [8, 9, 11])
+        self.stream.flush()
+        self.assertEqual(len(self.batches), 3)
+
+    def test_stop_delivers(self):
+        self.stream.start()
+        run_for(20)
+        self.stream.stop()
+        self.assertEqual(self.batches, [[1, 2]])
+        self.assertEqual(self.stream.positioner.entry, None)
+
+    def test_no_positioner(self):
+        engine.Positioner = None
+        self.stream.start()
+        self.failIf(self.stream.running)
+        self.assertEqual(self.stream.positioner, None)
+
+if __name__ == "__main__":
+    unittest.main()
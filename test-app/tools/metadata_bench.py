@@ -0,0 +1,154 @@
+#
+# Copyright 2007 Helsinki Institute for Information Technology (HIIT)
+# and the authors.  All rights reserved.
+#
+# Authors: Tero Hasu <tero.hasu@hut.fi>
+#
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Compares the metadata codecs of "tpytwink_metadata" on a PC, in
+# terms of encoding time and encoded size (also after deflating), for
+# cards of various shapes. Requires Python 2, like the application.
+#
+#   python metadata_bench.py [rounds]
+#
+# The "simplejson" on the phone is pure Python, whereas on a PC it
+# (or the "json" module we fall back to) usually has C speedups, so
+# JSON is also timed with the speedups disabled where we know how to
+# do that. The binary codec is always pure Python.
+
+import os
+import sys
+import time
+import zlib
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+app_dir = os.path.dirname(tools_dir)
+sys.path.insert(0, app_dir)
+
+try:
+    import simplejson
+except ImportError:
+    import json
+    sys.modules["simplejson"] = json
+
+import tpytwink_metadata as meta
+
+contact = {"first_name": u"Matti", "last_name": u"Meik\xe4l\xe4inen",
+           "email_address": u"matti.meikalainen@myhost.mydomain"}
+
+def make_card(num_devices, with_gps):
+    """
+    Returns metadata shaped like that made by "Card.refresh_metadata".
+    """
+    md = {"sender": contact,
+          "receiver": {"first_name": u"Keep private",
+                       "email_address": u"private@myhost.mydomain"},
+          "status": u"Having lunch",
+          "photo filename": u"Image(042).jpg",
+          "gsm": {"country code": 244, "network code": 5,
+                  "area code": 4020, "cell id": 2312391},
+          "time": {"time": 1190000000.53125, "timezone": -7200,
+                   "daylight": True, "altzone": -10800}}
+    if num_devices:
+        md["bt scan"] = [ {"mac": "00:1b:%02x:3c:%02x:5e" % (i, i * 7 % 256),
+                           "name": u"Nokia N%d" % (70 + i)}
+                          for i in range(num_devices) ]
+    if with_gps:
+        md["gps"] = {
+            "position": {"latitude": 60.18794593, "longitude": 24.83047318,
+                         "altitude": 41.5, "vertical_accuracy": 22.5,
+                         "horizontal_accuracy": 13.4261703491},
+            "course": {"speed": 0.31, "heading": 221.36,
+                       "speed_accuracy": 1.25, "heading_accuracy": 359.0},
+            "satellites": {"horizontal_dop": 1.1, "vertical_dop": 1.7,
+                           "time_dop": 1.0, "used_satellites": 7,
+                           "satellites": 11,
+                           "time": 1190000000.0}}
+    return md
+
+cards = [("minimal", make_card(0, False)),
+         ("gsm+bt5", make_card(5, False)),
+         ("gps+bt10", make_card(10, True)),
+         ("gps+bt60", make_card(60, True))]
+
+class PureJsonCodec(meta.JsonCodec):
+    """
+    JSON without any C speedups, for Python 2.6 onwards "json".
+    """
+    name = "json (pure)"
+
+    def encode(self, obj):
+        import json.encoder as enc
+        saved = enc.c_make_encoder, enc.encode_basestring_ascii
+        enc.c_make_encoder = None
+        enc.encode_basestring_ascii = enc.py_encode_basestring_ascii
+        try:
+            return meta.json_codec.encode(obj)
+        finally:
+            enc.c_make_encoder, enc.encode_basestring_ascii = saved
+
+def codecs():
+    result = [meta.json_codec]
+    try:
+        import json.encoder
+        json.encoder.py_encode_basestring_ascii
+        if meta.simplejson is sys.modules.get("json"):
+            result.append(PureJsonCodec())
+    except (ImportError, AttributeError):
+        pass
+    result.append(meta.binary_codec)
+    return result
+
+def time_encode(codec, obj, rounds):
+    """
+    Returns the median time of encoding the object, in seconds.
+    """
+    times = []
+    for i in range(rounds):
+        start = time.time()
+        for j in range(10):
+            codec.encode(obj)
+        times.append((time.time() - start) / 10)
+    times.sort()
+    return times[len(times) / 2]
+
+def main():
+    rounds = 50
+    if len(sys.argv) > 1:
+        rounds = int(sys.argv[1])
+    row = "%-10s %-12s %8s %9s %10s\n"
+    sys.stdout.write(row % ("card", "codec", "bytes", "deflated",
+                            "encode us"))
+    for cname, md in cards:
+        for codec in codecs():
+            data = codec.encode(md)
+            if codec.decode(data) != md:
+                sys.stderr.write("%s: %s does not round trip\n" %
+                                 (cname, codec.name))
+            elapsed = time_encode(codec, md, rounds)
+            sys.stdout.write(row % (cname, codec.name, len(data),
+                                    len(zlib.compress(data, 6)),
+                                    "%.1f" % (elapsed * 1e6)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#
+# Copyright 2007 Helsinki Institute for Information Technology (HIIT)
+# and the authors.  All rights reserved.
+#
+# Authors: Tero Hasu <tero.hasu@hut.fi>
+#
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Times the NaN sanitizing of card metadata ("strip_nan" of the
+# engine) against the earlier "filter_nan", which copied every dict
+# and did not look inside lists, for cards of various shapes, with
+# and without NaNs. Requires Python 2, like the application.
+#
+#   python nan_bench.py [rounds]
+
+import sys
+import time
+
+import upload_bench
+import metadata_bench
+
+engine = upload_bench.import_engine()
+
+def old_filter_nan(d):
+    new_d = {}
+    for k, v in d.iteritems():
+        if type(v) == dict:
+            new_d[k] = old_filter_nan(v)
+        elif engine.is_nan(v):
+            pass
+        else:
+            new_d[k] = v
+    return new_d
+
+nan = engine.INFINITY - engine.INFINITY
+
+def with_nans(md):
+    """
+    Returns a copy of the card metadata with NaNs where a phone may
+    well produce them: the altitude and the vertical accuracy of a 2D
+    fix, an unknown course, and a satellite list entry.
+    """
+    md = md.copy()
+    gps = md["gps"] = md["gps"].copy()
+    pos = gps["position"] = gps["position"].copy()
+    pos["altitude"] = nan
+    pos["vertical_accuracy"] = nan
+    course = gps["course"] = gps["course"].copy()
+    course["heading"] = nan
+    course["heading_accuracy"] = nan
+    gps["satellite_signals"] = [(12, 41.0), (17, nan), (23, 38.5)]
+    return md
+
+cards = metadata_bench.cards + \
+        [("gps+bt10 nan", with_nans(metadata_bench.make_card(10, True))),
+         ("gps+bt60 nan", with_nans(metadata_bench.make_card(60, True)))]
+
+def time_call(f, obj, rounds):
+    """
+    Returns the median time of calling the function on the object, in
+    seconds.
+    """
+    times = []
+    for i in range(rounds):
+        start = time.time()
+        for j in range(100):
+            f(obj)
+        times.append((time.time() - start) / 100)
+    times.sort()
+    return times[len(times) / 2]
+
+def main():
+    rounds = 50
+    if len(sys.argv) > 1:
+        rounds = int(sys.argv[1])
+    row = "%-14s %12s %12s %8s %10s\n"
+    sys.stdout.write(row % ("card", "filter us", "strip us", "copied",
+                            "old left"))
+    for cname, md in cards:
+        old = time_call(old_filter_nan, md, rounds)
+        new = time_call(engine.strip_nan, md, rounds)
+        result = engine.strip_nan(md)
+        # Whether the list NaN (if any) survived the old filter.
+        sats = old_filter_nan(md).get("gps", {}).get("satellite_signals")
+        left = "-"
+        if sats is not None:
+            left = str(len([ s for s in sats if s[1] != s[1] ]))
+        sys.stdout.write(row % (cname, "%.1f" % (old * 1e6),
+                                "%.1f" % (new * 1e6),
+                                result is not md and "yes" or "no",
+                                left))
+
+if __name__ == "__main__":
+    main()
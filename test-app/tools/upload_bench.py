@@ -0,0 +1,678 @@
+#
+# Copyright 2007 Helsinki Institute for Information Technology (HIIT)
+# and the authors.  All rights reserved.
+#
+# Authors: Tero Hasu <tero.hasu@hut.fi>
+#
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Benchmarks of the upload path of the application ("serialize_card"
+# plus "Uploader") on a PC. Requires Python 2, like the application
+# itself.
+#
+#   python upload_bench.py [-q] [-z] [-n rounds] [-p sizes] [-i sizes]
+#                          [-l links]
+#
+#   -q  a quick run, with fewer cases and rounds
+#   -z  compress the cards
+#   -n  the number of cards to send per case (default 10)
+#   -p  comma separated filedata payload sizes in kB (default 0,64,512)
+#   -i  comma separated picture file sizes in kB (default 0,100,1000)
+#   -l  comma separated links as <rtt ms>/<bandwidth kB/s>, with 0
+#       bandwidth meaning unlimited (default 0/0,100/256,300/32)
+#
+# The engine is run against stand-ins for the Symbian specific modules
+# it imports. Most of them are empty, but the "pyaosocket" stand-in has
+# "AoSocketServ", "AoConnection" and "AoSocket" working over real local
+# sockets, driven by an event loop in place of the active scheduler.
+# The link is simulated within "AoSocket": connecting and getting a
+# response each take a round trip, and writes complete at the rate
+# the bandwidth allows. Simulated delays do not make us wait; instead
+# the clock of the loop (which the engine also sees) skips ahead. It
+# does not skip ahead to the timers of the engine, such as its
+# response watchdog, while data from the server may yet arrive. The
+# cards are sent to "upload_standin" running in this process.
+#
+# Each case runs in a process of its own, so that its peak memory use
+# can be measured. For each case, we report the median and 99th
+# percentile of the time it took to serialize and send a card, the
+# median throughput, and the peak resident memory of the case process,
+# along with the growth in it from before the first card was sent.
+
+import getopt
+import heapq
+import os
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import types
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+app_dir = os.path.dirname(tools_dir)
+
+KErrEof = -25
+KErrCouldNotConnect = -34
+KErrDisconnected = -36
+
+class BenchError(Exception):
+    pass
+
+class Loop:
+    """
+    Runs callbacks in place of the active scheduler, with a clock that
+    skips over any time spent waiting for nothing but simulated delays.
+    """
+    def __init__(self):
+        self.timers = [] # heap of (time, seq, callable, args)
+        self.seq = 0
+        self.readers = {} # fileno -> callable
+        self.skew = 0.0
+
+    def now(self):
+        return time.time() + self.skew
+
+    def call_at(self, when, func, *args):
+        """
+        Calls the function at the given time, which is that of a
+        simulated delay, so the clock may skip ahead to it.
+        """
+        self.seq += 1
+        entry = [when, self.seq, func, args, True]
+        heapq.heappush(self.timers, entry)
+        return entry
+
+    def call_at_deadline(self, when, func, *args):
+        """
+        Like "call_at", but for a timer of the engine, such as a
+        response watchdog. Such a time is not simulated, so the clock
+        does not skip ahead to it while there may still be real data
+        to come.
+        """
+        entry = self.call_at(when, func, *args)
+        entry[4] = False
+        return entry
+
+    def call_soon(self, func, *args):
+        return self.call_at(self.now(), func, *args)
+
+    def cancel(self, entry):
+        if entry is not None:
+            entry[2] = None
+
+    def add_reader(self, fileno, func):
+        self.readers[fileno] = func
+
+    def remove_reader(self, fileno):
+        if self.readers.has_key(fileno):
+            del self.readers[fileno]
+
+    def run_once(self):
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+        timeout = None
+        if self.timers:
+            timeout = max(0.0, self.timers[0][0] - self.now())
+        if self.readers:
+            # We must wait for real for any data from the server,
+            # but only briefly if there is a simulated delay
+            # pending, since the server is local. Before a deadline
+            # we wait for real until it is reached, as the data
+            # should arrive well before.
+            if timeout is not None and self.timers[0][4]:
+                timeout = min(timeout, 0.002)
+            fds = self.readers.keys()
+            ready = select.select(fds, [], [], timeout)[0]
+            for fd in ready:
+                func = self.readers.get(fd)
+                if func:
+                    func()
+            if ready:
+                return
+        elif timeout is None:
+            raise BenchError("nothing to wait for")
+        if self.timers:
+            entry = self.timers[0]
+            delay = entry[0] - self.now()
+            if delay > 0:
+                self.skew += delay
+            heapq.heappop(self.timers)
+            func, args = entry[2], entry[3]
+            if func is not None:
+                func(*args)
+
+    def run_until(self, pred):
+        while not pred():
+            self.run_once()
+
+class Link:
+    def __init__(self, rtt = 0.0, bandwidth = 0):
+        """
+        rtt:: The round trip time in seconds.
+        bandwidth:: The uplink bandwidth in bytes per second, or 0 for
+                    no limit.
+        """
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+
+loop = Loop()
+link = Link()
+
+# --------------------------------------------------------------------
+# stand-ins for Symbian specific modules...
+
+class Clock:
+    """
+    The "time" module, as seen by the engine, with the clock of the
+    loop.
+    """
+    def time(self):
+        return loop.now()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class Ao_timer:
+    def __init__(self):
+        self.entry = None
+
+    def after(self, secs, cb):
+        if self.entry is not None:
+            raise BenchError("timer already pending")
+        self.entry = loop.call_at_deadline(loop.now() + secs,
+                                           self._expired, cb)
+
+    def _expired(self, cb):
+        self.entry = None
+        cb()
+
+    def cancel(self):
+        loop.cancel(self.entry)
+        self.entry = None
+
+class Ao_lock:
+    def __init__(self):
+        self.signaled = False
+
+    def wait(self):
+        loop.run_until(lambda: self.signaled)
+        self.signaled = False
+
+    def signal(self):
+        self.signaled = True
+
+def ao_yield():
+    loop.call_soon(lambda: None)
+    loop.run_once()
+
+def ao_sleep(secs, cb = None):
+    if cb:
+        loop.call_at(loop.now() + secs, cb)
+    else:
+        done = []
+        loop.call_at(loop.now() + secs, lambda: done.append(1))
+        loop.run_until(lambda: done)
+
+class AoSocketServ:
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+class AoConnection:
+    def open(self, serv, apid):
+        pass
+
+    def close(self):
+        pass
+
+class AoImmediate:
+    def __init__(self):
+        self.entry = None
+
+    def open(self):
+        pass
+
+    def complete(self, cb, arg):
+        self.entry = loop.call_soon(self._completed, cb, arg)
+
+    def _completed(self, cb, arg):
+        self.entry = None
+        cb(0, arg)
+
+    def cancel(self):
+        loop.cancel(self.entry)
+        self.entry = None
+
+    def close(self):
+        self.cancel()
+
+class AoResolver:
+    def open(self):
+        pass
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        pass
+
+class AoSocket:
+    """
+    A TCP socket with the "pyaosocket" interface, over a real socket,
+    with the simulated link. All requests complete asynchronously.
+    """
+    def __init__(self):
+        self.sock = None
+        self.entry = None
+        self.reading = False
+        self.link_free = 0.0 # when the uplink is next free
+        self.reply_time = 0.0 # when any response data can arrive
+
+    def set_socket_serv(self, serv):
+        pass
+
+    def set_connection(self, conn):
+        pass
+
+    def open_tcp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Writes are paced by the simulated link, not by the stack.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connect_tcp(self, host, port, cb, udata):
+        try:
+            self.sock.connect((str(host), port))
+            err = 0
+        except socket.error:
+            err = KErrCouldNotConnect
+        self.entry = loop.call_at(loop.now() + link.rtt,
+                                  self._completed, cb, err, udata)
+
+    def _completed(self, cb, err, udata):
+        self.entry = None
+        cb(err, udata)
+
+    def write_data(self, data, cb, udata):
+        now = loop.now()
+        try:
+            self.sock.sendall(data)
+            err = 0
+        except socket.error:
+            err = KErrDisconnected
+        done = max(now, self.link_free)
+        if link.bandwidth:
+            done = done + float(len(data)) / link.bandwidth
+        self.link_free = done
+        self.reply_time = done + link.rtt
+        self.entry = loop.call_at(done, self._completed, cb, err, udata)
+
+    def read_some(self, n, cb, udata):
+        self.reading = True
+        loop.add_reader(self.sock.fileno(),
+                        lambda: self._readable(n, cb, udata))
+
+    def _readable(self, n, cb, udata):
+        loop.remove_reader(self.sock.fileno())
+        try:
+            data = self.sock.recv(n)
+            err = 0
+            if not data:
+                err = KErrEof
+        except socket.error:
+            data, err = "", KErrDisconnected
+        self.entry = loop.call_at(max(loop.now(), self.reply_time),
+                                  self._read_completed, cb, err, data, udata)
+
+    def _read_completed(self, cb, err, data, udata):
+        self.entry = None
+        self.reading = False
+        cb(err, data, udata)
+
+    def cancel(self):
+        loop.cancel(self.entry)
+        self.entry = None
+        if self.reading and self.sock:
+            loop.remove_reader(self.sock.fileno())
+            self.reading = False
+
+    def close(self):
+        self.cancel()
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+class App:
+    def full_name(self):
+        return os.path.join(app_dir, "tpytwink_main.py")
+
+def new_module(name, attrs):
+    module = types.ModuleType(name)
+    for key, value in attrs.items():
+        setattr(module, key, value)
+    sys.modules[name] = module
+    return module
+
+def gsm_location():
+    """
+    Returns the "cell" of the stand-in "location" module, which may
+    be set to simulate moving about.
+    """
+    return sys.modules["location"].cell
+
+def install_standins():
+    new_module("appuifw", {"app": App()})
+    new_module("e32", {"Ao_timer": Ao_timer, "Ao_lock": Ao_lock,
+                       "ao_yield": ao_yield, "ao_sleep": ao_sleep})
+    new_module("pyaosocket", {"AoSocketServ": AoSocketServ,
+                              "AoConnection": AoConnection,
+                              "AoSocket": AoSocket,
+                              "AoImmediate": AoImmediate,
+                              "AoResolver": AoResolver})
+    new_module("location", {"gsm_location": gsm_location,
+                            "cell": (244, 5, 4020, 2312391)})
+    for name in ("pyinbox", "pynewfile", "key_codes",
+                 "graphics", "globalui", "contacts", "pytwink"):
+        new_module(name, {})
+    try:
+        import simplejson
+    except ImportError:
+        import json
+        sys.modules["simplejson"] = json
+
+def import_engine():
+    install_standins()
+    sys.path.insert(0, app_dir)
+    import tpytwink_engine
+    tpytwink_engine.time = Clock()
+    return tpytwink_engine
+
+# --------------------------------------------------------------------
+# measurement...
+
+def read_status_kb(field):
+    """
+    Returns the given memory figure of this process, in kB, or None if
+    it is not available.
+    """
+    try:
+        fp = open("/proc/self/status")
+        try:
+            for line in fp.readlines():
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+        finally:
+            fp.close()
+    except IOError:
+        pass
+    if field == "VmHWM":
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None
+
+def reset_peak_memory():
+    """
+    Makes the peak resident memory figure start over from the current
+    one, if supported (Linux 4.0 onwards). Returns True if it did.
+    """
+    try:
+        fp = open("/proc/self/clear_refs", "w")
+        try:
+            fp.write("5")
+        finally:
+            fp.close()
+        return True
+    except IOError:
+        return False
+
+def percentile(values, pct):
+    """
+    The nearest-rank percentile of the given values.
+    """
+    values = list(values)
+    values.sort()
+    if not values:
+        return 0.0
+    rank = int((pct / 100.0) * len(values) + 0.999999)
+    return values[min(max(rank, 1), len(values)) - 1]
+
+def write_file(fname, size):
+    """
+    Writes a file of pseudorandom, incompressible data.
+    """
+    block = os.urandom(65536)
+    fp = open(fname, "wb")
+    try:
+        while size > 0:
+            fp.write(block[:size])
+            size -= len(block)
+    finally:
+        fp.close()
+
+class BenchCard:
+    """
+    The parts of a "Card" that "serialize_card" needs.
+    """
+    def __init__(self, picfile, filedatafile):
+        self.picfile = picfile
+        self.upload_picfile = None
+        self.filedatafile = filedatafile
+        self.filedata = None
+        self.filedataname = filedatafile and u"payload.dat" or None
+        self.metadata = {
+            "sender": {"email_address": u"sender@myhost.mydomain"},
+            "receiver": {"email_address": u"receiver@myhost.mydomain"},
+            "status": u"benchmarking",
+            "gsm": {"country code": 244, "network code": 5,
+                    "area code": 1234, "cell id": 56789},
+            "bt scan": [[u"00:11:22:33:44:%02x" % i, u"device %d" % i]
+                        for i in range(10)],
+            "time": {"time": 0.0, "timezone": 0, "daylight": False}}
+        if picfile:
+            self.metadata["photo filename"] = u"picture.jpg"
+        if filedatafile:
+            self.metadata["data filename"] = self.filedataname
+
+    def has_filedata(self):
+        return self.filedatafile is not None
+
+    def encode_metadata(self, codec):
+        engine = sys.modules["tpytwink_engine"]
+        return codec.encode(engine.filter_nan(self.metadata))
+
+def run_case(port, payload, picsize, rtt, bandwidth, rounds, compress):
+    """
+    Sends "rounds" cards over one "Uploader", and returns a dict of
+    results.
+    """
+    engine = import_engine()
+    link.rtt = rtt
+    link.bandwidth = bandwidth
+    tmpdir = tempfile.mkdtemp()
+    try:
+        engine.configdb_file = os.path.join(tmpdir, "settings.txt")
+        engine.dest_info = ("127.0.0.1", port, "/upload.php")
+        config = engine.Config()
+        picfile = filedatafile = None
+        if picsize:
+            picfile = os.path.join(tmpdir, "picture.jpg")
+            write_file(picfile, picsize)
+        if payload:
+            filedatafile = os.path.join(tmpdir, "payload.dat")
+            write_file(filedatafile, payload)
+        card = BenchCard(picfile, filedatafile)
+        uploader = engine.Uploader(config)
+
+        reset_peak_memory()
+        base_rss = read_status_kb("VmRSS")
+        latencies = []
+        rates = []
+        wire_bytes = 0
+        for i in range(rounds):
+            result = []
+            def cb(serr, equ):
+                result.append((serr, equ))
+            start = loop.now()
+            request = engine.serialize_card(card, compress)
+            uploader.send(request, cb)
+            loop.run_until(lambda: result)
+            elapsed = loop.now() - start
+            serr, equ = result[0]
+            if serr or equ != "accepted":
+                raise BenchError("card not accepted: %s %s" % (serr, equ))
+            latencies.append(elapsed)
+            wire_bytes += uploader.total
+            if elapsed > 0:
+                rates.append(uploader.total / elapsed)
+        uploader.close()
+        return {"p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "bps": percentile(rates, 50),
+                "bytes": wire_bytes,
+                "peak_kb": read_status_kb("VmHWM"),
+                "growth_kb": read_status_kb("VmHWM") - base_rss}
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+def case_main(args):
+    port, payload, picsize, rtt, bandwidth, rounds, compress = args
+    res = run_case(int(port), int(payload), int(picsize), float(rtt),
+                   int(bandwidth), int(rounds), compress == "1")
+    items = res.items()
+    items.sort()
+    sys.stdout.write(" ".join([ "%s=%r" % item for item in items ]) + "\n")
+
+def spawn_case(port, payload, picsize, rtt, bandwidth, rounds, compress):
+    import subprocess
+    args = [sys.executable, os.path.abspath(__file__), "--case",
+            str(port), str(payload), str(picsize), repr(rtt),
+            str(bandwidth), str(rounds), compress and "1" or "0"]
+    proc = subprocess.Popen(args, stdout = subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise BenchError("case failed: %s" % " ".join(args[4:]))
+    res = {}
+    for item in out.strip().split("\n")[-1].split():
+        name, value = item.split("=", 1)
+        res[name] = float(value)
+    return res
+
+# --------------------------------------------------------------------
+# the sweep...
+
+def start_receiver():
+    sys.path.insert(0, tools_dir)
+    import upload_standin
+
+    class CountingStore(upload_standin.Store):
+        """
+        Only counts the cards, as we send a great many of them.
+        """
+        num_cards = 0
+
+        def add_card(self, card_id, fields):
+            self.lock.acquire()
+            try:
+                self.num_cards += 1
+            finally:
+                self.lock.release()
+            return True
+
+    upload_standin.Handler.verbose = False
+    return upload_standin.start_server(store = CountingStore())
+
+def parse_sizes(text):
+    return [ int(float(x) * 1024) for x in text.split(",") ]
+
+def parse_links(text):
+    links = []
+    for item in text.split(","):
+        rtt, bw = item.split("/")
+        links.append((float(rtt) / 1000.0, int(float(bw) * 1024)))
+    return links
+
+def usage():
+    sys.stderr.write("usage: upload_bench.py [-q] [-z] [-n rounds] [-p sizes] [-i sizes] [-l links]\n")
+    sys.exit(2)
+
+def main():
+    if sys.argv[1:2] == ["--case"]:
+        case_main(sys.argv[2:])
+        return
+
+    rounds = 10
+    payloads = parse_sizes("0,64,512")
+    picsizes = parse_sizes("0,100,1000")
+    links = parse_links("0/0,100/256,300/32")
+    compress = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "qzn:p:i:l:")
+    except getopt.GetoptError:
+        usage()
+    if args:
+        usage()
+    for opt, value in opts:
+        if opt == "-q":
+            rounds = 3
+            payloads = parse_sizes("0,64")
+            picsizes = parse_sizes("0,100")
+            links = parse_links("0/0,300/32")
+        elif opt == "-z":
+            compress = True
+        elif opt == "-n":
+            rounds = int(value)
+        elif opt == "-p":
+            payloads = parse_sizes(value)
+        elif opt == "-i":
+            picsizes = parse_sizes(value)
+        elif opt == "-l":
+            links = parse_links(value)
+
+    server = start_receiver()
+    port = server.server_address[1]
+    heading = "%8s %8s %6s %7s %9s %9s %9s %9s %9s\n"
+    sys.stdout.write(heading % ("payload", "picture", "rtt", "bw",
+                                "p50", "p99", "kB/s", "peak", "growth"))
+    sys.stdout.write(heading % ("kB", "kB", "ms", "kB/s", "ms", "ms",
+                                "", "kB", "kB"))
+    try:
+        for rtt, bandwidth in links:
+            for payload in payloads:
+                for picsize in picsizes:
+                    res = spawn_case(port, payload, picsize, rtt,
+                                     bandwidth, rounds, compress)
+                    sys.stdout.write(
+                        "%8d %8d %6d %7s %9.1f %9.1f %9.1f %9d %9d\n" %
+                          (payload / 1024, picsize / 1024, rtt * 1000,
+                           bandwidth and str(bandwidth / 1024) or "-",
+                           res["p50"] * 1000, res["p99"] * 1000,
+                           res["bps"] / 1024, res["peak_kb"],
+                           res["growth_kb"]))
+                    sys.stdout.flush()
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+#
+# Copyright 2007 Helsinki Institute for Information Technology (HIIT)
+# and the authors.  All rights reserved.
+#
+# Authors: Tero Hasu <tero.hasu@hut.fi>
+#
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# A stand-in for the "/upload.php" card receiver, for trying out and
+# testing the upload code of the application on a PC. Runs with both
+# Python 2 and Python 3. This is not meant to be a real server, and
+# everything is kept in memory.
+#
+#   python upload_standin.py [port]
+#
+# What is supported:
+# * multipart/form-data card POSTs, with "Content-Encoding: deflate"
+#   parts, and multipart/mixed batches of cards
+# * "X-Card-Id" based detection of duplicate cards
+# * persistent connections
+# * "GET /upload.php?blob=<digest>" queries, answered with an
+#   "X-Blob-Present: <digest>" header if the blob is there, and
+#   "<name>-ref" parts referring to an earlier uploaded attachment
+#   by its digest
+# * attachments uploaded in parts with
+#   "POST /upload.php?blob=<digest>&part=<n>&offset=<n>&total=<n>",
+#   with the received ranges recorded per digest
+
+import hashlib
+import re
+import sys
+import threading
+import zlib
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+upload_path = "/upload.php"
+
+def compute_digest(algorithm, data):
+    return algorithm + ":" + hashlib.new(algorithm, data).hexdigest()
+
+def split_ctype(value):
+    """
+    Returns the media type and the boundary, if any. We accept both
+    a "," and a ";" before the parameters, as the application uses
+    the former.
+    """
+    value = value or ""
+    m = re.search(r"boundary=\"?([^\";,]+)\"?", value)
+    ctype = re.split(r"[;,]", value)[0].strip().lower()
+    if m:
+        return ctype, m.group(1).encode("latin-1")
+    return ctype, None
+
+def parse_headers(data):
+    headers = {}
+    for line in data.split(b"\r\n"):
+        if b":" in line:
+            name, value = line.split(b":", 1)
+            headers[name.strip().lower().decode("latin-1")] = \
+                value.strip().decode("latin-1")
+    return headers
+
+def split_multipart(body, boundary):
+    """
+    Returns a list of (headers, body) pairs.
+    """
+    delim = b"--" + boundary
+    parts = []
+    segments = body.split(b"\r\n" + delim)
+    first = segments[0]
+    if first.startswith(delim):
+        segments[0] = first[len(delim):]
+    else:
+        raise ValueError("no opening boundary")
+    for seg in segments:
+        if seg.startswith(b"--"):
+            break
+        if seg.startswith(b"\r\n"):
+            seg = seg[2:]
+        pos = seg.find(b"\r\n\r\n")
+        if pos == -1:
+            raise ValueError("no end of part headers")
+        headers = parse_headers(seg[:pos])
+        pbody = seg[pos+4:]
+        if headers.get("content-encoding", "").lower() == "deflate":
+            pbody = zlib.decompress(pbody)
+        parts.append((headers, pbody))
+    return parts
+
+def part_name(headers):
+    m = re.search(r"name=\"([^\"]*)\"",
+                  headers.get("content-disposition", ""))
+    return m and m.group(1) or None
+
+class Store:
+    """
+    The state of the receiver. Shared between the request handler
+    threads, hence the lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blobs = {} # digest -> data
+        self.cards = [] # list of dicts of part name -> data
+        self.card_ids = {}
+        self.duplicates = 0
+        self.bytes_received = 0
+        self.partial = {} # digest -> data received so far
+        self.ranges = {} # digest -> list of (part, offset, size)
+
+    def add_card(self, card_id, fields):
+        """
+        Returns False if the card is a duplicate.
+        """
+        self.lock.acquire()
+        try:
+            if card_id is not None:
+                if card_id in self.card_ids:
+                    self.duplicates += 1
+                    return False
+                self.card_ids[card_id] = True
+            self.cards.append(fields)
+            return True
+        finally:
+            self.lock.release()
+
+    def add_blob(self, data):
+        self.lock.acquire()
+        try:
+            for algorithm in ("sha1", "md5"):
+                self.blobs[compute_digest(algorithm, data)] = data
+        finally:
+            self.lock.release()
+
+    def get_blob(self, digest):
+        self.lock.acquire()
+        try:
+            return self.blobs.get(digest, None)
+        finally:
+            self.lock.release()
+
+    def blob_offset(self, digest):
+        self.lock.acquire()
+        try:
+            return len(self.partial.get(digest, b""))
+        finally:
+            self.lock.release()
+
+    def add_blob_part(self, digest, part, offset, total, data):
+        """
+        Appends a part to a partially received attachment. Returns the
+        amount now received, and whether the attachment is complete.
+        Raises "RangeError" if the part does not continue from where
+        we are, and "CardError" if the completed attachment does not
+        match its digest.
+        """
+        self.lock.acquire()
+        try:
+            have = self.partial.get(digest, b"")
+            if offset != len(have):
+                raise RangeError(len(have))
+            have = have + data
+            self.ranges.setdefault(digest, []).append(
+                (part, offset, len(data)))
+            if len(have) < total:
+                self.partial[digest] = have
+                return len(have), False
+            if digest in self.partial:
+                del self.partial[digest]
+            algorithm = digest.split(":", 1)[0]
+            if len(have) != total or \
+               compute_digest(algorithm, have) != digest:
+                raise CardError("digest mismatch for %s" % digest)
+        finally:
+            self.lock.release()
+        self.add_blob(have)
+        return total, True
+
+class CardError(Exception):
+    pass
+
+class RangeError(Exception):
+    """
+    Raised with the expected offset when a part does not continue an
+    attachment from where it was left.
+    """
+    pass
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # The response is written a header at a time, so this avoids
+    # stalling on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    # Set to the "Store" to use.
+    store = None
+
+    # Whether to log requests.
+    verbose = True
+
+    # If set, a connection is dropped without a response upon the
+    # request for the attachment part with this number, after the
+    # part has been received, the first time only. For testing resuming.
+    drop_after_part = None
+    dropped = False
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def respond(self, code, text, headers = None):
+        body = text.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def path_and_query(self):
+        if "?" in self.path:
+            path, query = self.path.split("?", 1)
+        else:
+            path, query = self.path, ""
+        params = {}
+        for item in query.split("&"):
+            if "=" in item:
+                name, value = item.split("=", 1)
+                params[name] = value
+        return path, params
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length)
+        self.store.bytes_received += length
+        return data
+
+    def do_GET(self):
+        path, params = self.path_and_query()
+        if path != upload_path:
+            self.respond(404, u"Not found")
+        elif "blob" in params:
+            digest = params["blob"]
+            if self.store.get_blob(digest) is None:
+                offset = self.store.blob_offset(digest)
+                self.respond(404, u"No such blob",
+                             {"X-Blob-Offset": str(offset)})
+            else:
+                self.respond(200, u"Have blob", {"X-Blob-Present": digest})
+        else:
+            self.respond(400, u"Bad query")
+
+    def do_POST(self):
+        path, params = self.path_and_query()
+        body = self.read_body()
+        if path != upload_path:
+            self.respond(404, u"Not found")
+            return
+        if "blob" in params:
+            self.post_blob_part(params, body)
+            return
+        try:
+            ctype, boundary = split_ctype(self.headers.get("Content-Type"))
+            if ctype == "multipart/mixed":
+                cards = []
+                for headers, pbody in split_multipart(body, boundary):
+                    pctype, pboundary = split_ctype(headers.get("content-type"))
+                    cards.append((headers.get("x-card-id"),
+                                  self.parse_card(pbody, pboundary)))
+            else:
+                cards = [(self.headers.get("X-Card-Id"),
+                          self.parse_card(body, boundary))]
+        except (CardError, ValueError, zlib.error):
+            e = sys.exc_info()[1]
+            self.respond(400, u"Bad card: %s" % e)
+            return
+
+        for card_id, fields in cards:
+            if not self.store.add_card(card_id, fields):
+                self.log_message("duplicate card %s", card_id)
+        self.respond(200, u"OK", {"X-Card-Count": str(len(cards))})
+
+    def post_blob_part(self, params, body):
+        try:
+            digest = params["blob"]
+            part = int(params.get("part", "0"))
+            offset = int(params["offset"])
+            total = int(params["total"])
+        except (KeyError, ValueError):
+            self.respond(400, u"Bad part")
+            return
+        try:
+            offset, complete = self.store.add_blob_part(
+                digest, part, offset, total, body)
+        except RangeError:
+            expected = sys.exc_info()[1].args[0]
+            self.respond(409, u"Expected offset %d" % expected,
+                         {"X-Blob-Offset": str(expected)})
+            return
+        except CardError:
+            e = sys.exc_info()[1]
+            self.respond(400, u"Bad blob: %s" % e)
+            return
+        if part == self.drop_after_part and not self.__class__.dropped:
+            self.__class__.dropped = True
+            self.log_message("dropping connection after part %d", part)
+            self.close_connection = True
+            return
+        headers = {"X-Blob-Offset": str(offset)}
+        if complete:
+            headers["X-Blob-Complete"] = "1"
+        self.respond(200, u"OK", headers)
+
+    def parse_card(self, body, boundary):
+        if boundary is None:
+            raise CardError("no boundary")
+        fields = {}
+        for headers, pbody in split_multipart(body, boundary):
+            name = part_name(headers)
+            if name is None:
+                raise CardError("unnamed part")
+            if name.endswith("-ref"):
+                digest = pbody.decode("latin-1")
+                data = self.store.get_blob(digest)
+                if data is None:
+                    raise CardError("unknown attachment %s" % digest)
+                fields[name[:-4]] = data
+            else:
+                fields[name] = pbody
+                if name in ("picture", "filedata"):
+                    self.store.add_blob(pbody)
+        if "metadata" not in fields:
+            raise CardError("no metadata")
+        return fields
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def make_server(port = 0, store = None, handler = Handler):
+    """
+    Returns a server listening on localhost. With "port" 0, a free
+    port is chosen; see "server_address".
+    """
+    if store is None:
+        store = Store()
+    handler.store = store
+    server = Server(("127.0.0.1", port), handler)
+    server.store = store
+    return server
+
+def start_server(port = 0, store = None, handler = Handler):
+    """
+    Starts a server on a background thread, and returns it. Use
+    "shutdown" to stop it.
+    """
+    server = make_server(port, store, handler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def main():
+    port = 8080
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    server = make_server(port)
+    sys.stderr.write("listening on port %d\n" % server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
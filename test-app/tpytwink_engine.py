@@ -25,29 +25,64 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from __future__ import generators
+
 import sys
 import appuifw
 import time
 import e32
 import os
-import simplejson
 import pyinbox
 import location
 import pynewfile
 import key_codes
 import binascii
+import graphics
+import random
+import array
 from pyaosocket import AoSocketServ, AoSocket, AoResolver
 from pyaosocket import AoConnection
 from pyaosocket import AoImmediate
+try:
+    from pytwink import BtInquirer
+except ImportError:
+    # An older "pytwink" without it.
+    BtInquirer = None
+try:
+    from pytwink import Positioner
+except ImportError:
+    Positioner = None
 import socket
 import globalui
 import contacts
 
 import tpytwink_utils as ut
+import tpytwink_metadata as meta
 
 test_picfile = u"e:\\data\\%s.jpg" % "H\xe4h\xe4\xe4".decode("latin1")
 test_filedata = u"e:\\data\\document.doc"
 
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+try:
+    import thread
+except ImportError:
+    thread = None
+
+# The digest algorithm name is included in any attachment digests we
+# give out, so that the server knows how to check them.
+try:
+    import sha
+    digest_algorithm = "sha1"
+    new_digest = sha.new
+except ImportError:
+    import md5
+    digest_algorithm = "md5"
+    new_digest = md5.new
+
 def my_select_access_point():
     ap_list = socket.access_points()
     names = [ unicode(m["name"]) for m in ap_list ]
@@ -158,6 +193,249 @@ class GpsScanner:
     def close(self):
         self.stop()
 
+class PositionAcquirer:
+    """
+    Asks for a position from several positioning modules at once, as
+    which of them gets a fix first depends on where we are: network
+    based positioning also works indoors, but is inaccurate, whereas
+    GPS is accurate, but only works outdoors, and is slow to start.
+    The first fix that is accurate enough is taken, and the other
+    requests are cancelled. At the deadline, or once all the modules
+    have answered, the most accurate fix so far, if any, is taken
+    instead.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.timer = e32.Ao_timer()
+        # A positioner per module, kept for reuse, as a positioner
+        # may not be closed in its own callback.
+        self.positioners = {} # module ID -> Positioner
+        self.asking = []
+        self.best = None
+        self.cb = None
+
+    def acquire(self, cb):
+        """
+        cb:: Called with the position, as returned by
+             "Positioner.get_position", or None.
+        """
+        self.cancel()
+        self.cb = cb
+        self.best = None
+        deadline = self.config.get_position_deadline()
+        names = self.config.get_position_modules()
+        for entry in positioning.modules():
+            if not entry["available"]:
+                continue
+            if names is not None and entry["name"] not in names:
+                continue
+            positioner = self.positioners.get(entry["id"])
+            if positioner is None:
+                try:
+                    positioner = Positioner(entry["id"], deadline * 1000000,
+                                            self.config.get_context_max_age("gps") * 1000000)
+                except:
+                    ut.print_exception()
+                    continue
+                self.positioners[entry["id"]] = positioner
+            self.asking.append(positioner)
+        if not self.asking:
+            ut.report("no positioning modules")
+            # Not calling back before returning.
+            self.timer.after(0, self._deadline)
+            return
+        self.timer.after(deadline, self._deadline)
+        for positioner in self.asking:
+            positioner.ask_position(lambda code, p = positioner:
+                                    self._answered(p, code))
+
+    def _answered(self, positioner, code):
+        if positioner not in self.asking:
+            return
+        self.asking.remove(positioner)
+        if not code:
+            position = positioner.get_position()
+            accuracy = position["horizontal_accuracy"]
+            if not is_nan(accuracy):
+                if self.best is None or \
+                   accuracy < self.best["horizontal_accuracy"]:
+                    self.best = position
+                if accuracy <= self.config.get_position_accuracy():
+                    ut.report("position fix accurate to %d m" % accuracy)
+                    self._done(position)
+                    return
+        if not self.asking:
+            self._done(self.best)
+
+    def _deadline(self):
+        ut.report("position deadline")
+        self._done(self.best)
+
+    def stop(self):
+        """
+        Ends any acquisition in progress, passing the best fix so far
+        to the callback.
+        """
+        if self.cb:
+            self._done(self.best)
+
+    def _done(self, position):
+        cb = self.cb
+        self.cancel()
+        if cb:
+            cb(position)
+
+    def cancel(self):
+        self.cb = None
+        self.timer.cancel()
+        for positioner in self.asking:
+            positioner.cancel()
+        self.asking = []
+
+    def close(self):
+        self.cancel()
+        for positioner in self.positioners.values():
+            positioner.close()
+        self.positioners = {}
+
+class PositionStream:
+    """
+    Continuous positioning with a "Positioner", asking for a position
+    again every "position_interval" seconds. Fixes are kept as
+    (time, latitude, longitude, altitude, vertical_accuracy,
+    horizontal_accuracy) tuples in a ring buffer of a fixed size,
+    backed by an array of floats, and passed to the subscribers in
+    batches of "position_batch_size" fixes rather than one at a time.
+    A batch may also be had on demand with "flush", and the buffered
+    fixes with "fixes".
+    """
+    fields = 6
+
+    def __init__(self, config, module_id = None):
+        self.config = config
+        self.module_id = module_id
+        self.positioner = None
+        self.timer = e32.Ao_timer()
+        self.size = config.get_position_buffer_size()
+        self.buf = array.array("d", [0.0]) * (self.size * self.fields)
+        self.first = 0 # index of the oldest fix
+        self.count = 0
+        self.undelivered = 0
+        self.subscribers = []
+        self.running = False
+
+    def subscribe(self, cb):
+        """
+        cb:: Called with a list of the new fixes, oldest first.
+        """
+        if cb not in self.subscribers:
+            self.subscribers.append(cb)
+
+    def unsubscribe(self, cb):
+        if cb in self.subscribers:
+            self.subscribers.remove(cb)
+
+    def start(self):
+        """
+        Does nothing if there is no positioning support.
+        """
+        if self.running:
+            return
+        if not gps_avail or Positioner is None:
+            ut.report("no positioning for a position stream")
+            return
+        if self.positioner is None:
+            # A cold GPS may well take longer than an interval to get
+            # a fix, so the update timeout is a setting of its own.
+            timeout = self.config.get_position_update_timeout()
+            interval = self.config.get_position_interval()
+            module_id = self.module_id or positioning.default_module()
+            self.positioner = Positioner(module_id, timeout * 1000000,
+                                         interval * 1000000)
+        self.running = True
+        self._ask()
+
+    def _ask(self):
+        # Delivering here rather than in "_fixed", so that a
+        # subscriber may close us, which it may not do from the
+        # positioner's callback.
+        if self.undelivered >= self.config.get_position_batch_size():
+            self.flush()
+        if self.running:
+            self.positioner.ask_position(self._fixed)
+
+    def _fixed(self, code):
+        if not code:
+            self._put(self.positioner.get_fix())
+        elif code != -3: # KErrCancel
+            ut.report("positioning error %d" % code)
+        if self.running:
+            self.timer.after(self.config.get_position_interval(), self._ask)
+
+    def _put(self, fix):
+        if self.count == self.size:
+            i = self.first
+            self.first = (self.first + 1) % self.size
+        else:
+            i = (self.first + self.count) % self.size
+            self.count = self.count + 1
+        i = i * self.fields
+        buf = self.buf
+        buf[i] = time.time()
+        for j in range(5):
+            buf[i + 1 + j] = fix[j]
+        self.undelivered = min(self.undelivered + 1, self.size)
+
+    def fixes(self, n = None):
+        """
+        Returns the latest "n" buffered fixes, or all of them, oldest
+        first.
+        """
+        if n is None or n > self.count:
+            n = self.count
+        result = []
+        fields = self.fields
+        for k in range(self.count - n, self.count):
+            i = ((self.first + k) % self.size) * fields
+            result.append(tuple(self.buf[i:i + fields]))
+        return result
+
+    def latest(self):
+        """
+        Returns the latest fix, or None if there is none.
+        """
+        if not self.count:
+            return None
+        return self.fixes(1)[0]
+
+    def flush(self):
+        """
+        Passes any fixes not yet delivered to the subscribers.
+        """
+        if not self.undelivered:
+            return
+        batch = self.fixes(self.undelivered)
+        self.undelivered = 0
+        for cb in self.subscribers[:]:
+            cb(batch)
+
+    def stop(self):
+        """
+        Stops positioning, delivering any remaining fixes.
+        """
+        self.running = False
+        self.timer.cancel()
+        if self.positioner:
+            self.positioner.cancel()
+        self.flush()
+
+    def close(self):
+        self.stop()
+        self.subscribers = []
+        if self.positioner:
+            self.positioner.close()
+            self.positioner = None
+
 def get_gsm():
     try:
         gsm = location.gsm_location()
@@ -187,62 +465,566 @@ class GsmScanner:
     def _imm_completed(self, code, user_cb):
         user_cb(self.gsm)
 
+class CellTracker:
+    """
+    Samples the GSM cell on the background, so that the current cell
+    is known without a lookup when sending, and keeps a log of the
+    cell changes, with the time of each. Sampling is frequent right
+    after a change, as on the move one change tends to follow
+    another, and gets less frequent, up to a configured maximum
+    interval, while the cell stays the same.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.timer = e32.Ao_timer()
+        self.cell = None
+        self.changes = [] # (time, cell), oldest first
+        self.interval = config.get_gsm_min_interval()
+        self.running = False
+
+    def start(self):
+        """
+        It is safe to call this even when already running.
+        """
+        if self.running:
+            return
+        self.running = True
+        self.interval = self.config.get_gsm_min_interval()
+        self._sample()
+
+    def stop(self):
+        """
+        The current cell is forgotten, as it will not be kept up to
+        date. The change log is kept.
+        """
+        self.running = False
+        self.timer.cancel()
+        self.cell = None
+
+    def _sample(self):
+        cell = get_gsm()
+        self.cell = cell
+        if not self.changes or cell != self.changes[-1][1]:
+            self.changes.append((time.time(), cell))
+            del self.changes[:-self.config.get_gsm_log_size()]
+            self.interval = self.config.get_gsm_min_interval()
+        else:
+            self.interval = min(self.interval * 2,
+                                self.config.get_gsm_max_interval())
+        self.timer.after(self.interval, self._sample)
+
+    def history(self, window):
+        """
+        Returns the cell changes within the given number of seconds,
+        for card metadata, as lists of the time and the four cell ID
+        fields, which are None if there was no cell.
+        """
+        since = time.time() - window
+        result = []
+        for t, cell in self.changes:
+            if t >= since:
+                if cell is None:
+                    cell = (None, None, None, None)
+                result.append([int(t)] + list(cell))
+        return result
+
 def add_colons(s):
     s = str(s)
     return s[0:2] + ":" + s[2:4] + ":" + s[4:6] + ":" + \
            s[6:8] + ":" + s[8:10] + ":" + s[10:12]
 
-class BtproxScanner:
+# Each distinct Bluetooth device name is kept only once, as many of
+# the devices around share their names.
+bt_name_table = {}
+
+def intern_bt_name(name):
+    if len(bt_name_table) >= 1000:
+        bt_name_table.clear()
+    return bt_name_table.setdefault(name, name)
+
+# The colon separated forms of packed Bluetooth addresses, made only
+# once per device.
+bt_mac_strings = {}
+
+def unpack_bt_mac(packed):
+    s = bt_mac_strings.get(packed)
+    if s is None:
+        if len(bt_mac_strings) >= 1000:
+            bt_mac_strings.clear()
+        s = bt_mac_strings[packed] = add_colons("%012x" % packed)
+    return s
+
+class BtDevices:
+    """
+    The Bluetooth devices found by a scan, without duplicates. Each
+    device is stored as its address packed into an integer, and its
+    name, as interned by "intern_bt_name". The form that goes into
+    card metadata, a list of dictionaries with the address in colon
+    separated hex, is only made by "expand", when serializing.
+    """
     def __init__(self):
+        self.macs = []
+        self.names = []
+        self.index = {} # packed address -> position in the lists
+        self.expanded = None
+
+    def add(self, packed, name):
+        """
+        Adds a device, unless it is already there, in which case any
+        name it is missing is filled in. Returns a true value if the
+        device was not there.
+        """
+        i = self.index.get(packed)
+        if i is None:
+            self.index[packed] = len(self.macs)
+            self.macs.append(packed)
+            self.names.append(intern_bt_name(name))
+            self.expanded = None
+            return True
+        if name and not self.names[i]:
+            self.names[i] = intern_bt_name(name)
+            self.expanded = None
+        return False
+
+    def items(self):
+        return zip(self.macs, self.names)
+
+    def __len__(self):
+        return len(self.macs)
+
+    def __eq__(self, other):
+        return isinstance(other, BtDevices) and \
+               self.macs == other.macs and self.names == other.names
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def expand(self):
+        if self.expanded is None:
+            self.expanded = [ {"mac": unpack_bt_mac(mac), "name": name}
+                              for mac, name in self.items() ]
+        return self.expanded
+
+class BtNameCache:
+    """
+    Remembers the names of Bluetooth devices by packed address,
+    across runs, so that scans need not ask devices for their names,
+    which takes seconds per device.
+    """
+    max_size = 200
+
+    def __init__(self, config):
+        self.config = config
+        # packed address -> (name, time last seen)
+        self.names = {}
+        self.unknown = {} # packed addresses of devices with no name
+        self.changed = False
+        for packed, entry in config.db.get("bt_names", {}).items():
+            if len(entry) == 3:
+                # Saved by an earlier version, keyed by the address
+                # as hex digits, with its colon separated form.
+                try:
+                    packed = long(str(packed), 16)
+                except ValueError:
+                    continue
+                entry = entry[1:]
+                self.changed = True
+            self.names[packed] = (intern_bt_name(entry[0]), entry[1])
+
+    def name(self, packed, name):
+        """
+        Returns the name to give a device found by a scan. An empty
+        name means that the scan did not get the name of the device,
+        in which case any cached name is used.
+        """
+        entry = self.names.get(packed)
+        if not name:
+            if entry is None:
+                self.unknown[packed] = True
+                return name
+            name = entry[0]
+        elif entry is None or name != entry[0]:
+            self.set(packed, name)
+            return self.names[packed][0]
+        self.names[packed] = (name, time.time())
+        return name
+
+    def set(self, packed, name):
+        self.names[packed] = (intern_bt_name(name), time.time())
+        if self.unknown.has_key(packed):
+            del self.unknown[packed]
+        self.changed = True
+
+    def save(self):
+        """
+        Saves any new names, dropping the devices seen longest ago if
+        there are too many.
+        """
+        if not self.changed:
+            return
+        if len(self.names) > self.max_size:
+            seen = [ (entry[1], packed) for packed, entry in self.names.items() ]
+            seen.sort()
+            for t, packed in seen[:len(seen) - self.max_size]:
+                del self.names[packed]
+        self.config.db["bt_names"] = self.names
+        self.config.save_later()
+        self.changed = False
+
+class BtproxScanner:
+    """
+    Given a configuration, the scanner ends a scan early once no new
+    device has turned up for a quiet interval, or once a configured
+    number of devices has been found. The quiet interval is learned
+    from the gaps between device arrivals (the first one counting
+    from the start of the scan) in earlier scans that ran to the end.
+    As only such scans tell us how long the gaps really get, every
+    so often a scan is run to the end regardless.
+
+    Given a name cache, the scanner takes device names from it. If
+    "pytwink" can discover devices without asking their names, and
+    the configuration allows, discovery is then done that way, and
+    the names of devices not in the cache are looked up later with
+    "resolve_names", once the result of the scan has been used.
+    """
+    max_duration = 25
+
+    def __init__(self, config = None, names = None):
+        self.config = config
+        self.names = names
         self.timer = e32.Ao_timer()
-        self.resolver = AoResolver()
-        self.resolver.open()
+        self.quiet_timer = e32.Ao_timer()
+        self.inquiry_only = (BtInquirer is not None and names is not None and
+                             config.get_btprox_inquiry_only())
+        if self.inquiry_only:
+            self.resolver = BtInquirer()
+        else:
+            self.resolver = AoResolver()
+            self.resolver.open()
         self.active = False
+        self.resolving = False
 
     def scan(self, cb):
-        if self.active:
+        if self.active or self.resolving:
             self.cancel()
         self.cb = cb
-        self.list = []
-        self.resolver.discover(self._cb, None)
-        self.timer.after(25, self._timeout)
+        self.devices = BtDevices()
+        self.gaps = []
+        self.last_arrival = time.time()
+        self.quiet = self._quiet_interval()
+        if self.inquiry_only:
+            self.resolver.discover(False, self._cb)
+        else:
+            self.resolver.discover(self._cb, None)
+        self.timer.after(self.max_duration, self._timeout)
+        if self.quiet:
+            self.quiet_timer.after(self.quiet, self._quiet)
         self.active = True
 
+    def _quiet_interval(self):
+        """
+        Returns 1.5 times the 90th percentile of the recorded arrival
+        gaps, or None if the scan is to run to the end.
+        """
+        if self.config is None or random.random() < 0.1:
+            return None
+        gaps = self.config.db.get("btprox_gaps", [])
+        if len(gaps) < 10:
+            return None
+        gaps = gaps[:]
+        gaps.sort()
+        quiet = max(gaps[(len(gaps) * 9) / 10] * 1.5, 2)
+        if quiet >= self.max_duration:
+            return None
+        return quiet
+
+    def _learn(self):
+        """
+        Records the arrival gaps of a scan that ran to the end.
+        """
+        if self.config is None or self.quiet:
+            return
+        gaps = self.config.db.get("btprox_gaps", []) + self.gaps
+        self.config.db["btprox_gaps"] = gaps[-200:]
+        self.config.save_later()
+
     def _timeout(self):
         """
         We use a timer to restrict the scan duration to something
         reasonable.
         """
-        self.active = False
         ut.report("btprox scan timeout")
+        self._learn()
+        self.stop()
+
+    def _quiet(self):
+        ut.report("btprox scan quiet for %d s" % self.quiet)
+        self.stop()
+
+    def stop(self):
+        """
+        Ends any scan in progress, passing the devices found so far
+        to the callback.
+        """
+        if not self.active:
+            return
+        self.active = False
+        self.timer.cancel()
+        self.quiet_timer.cancel()
         self.resolver.cancel()
-        self.cb(self.list) # anything so far
+        self._save_names()
+        self.cb(self.devices) # anything so far
+
+    def _save_names(self):
+        if self.names is not None:
+            self.names.save()
 
-    def _cb(self, error, mac, name, dummy):
+    def _cb(self, error, mac, name, dummy = None):
         ut.report([error, mac, name, dummy])
         self.active = False
         if error == -25: # KErrEof (no more devices)
             self.timer.cancel()
-            self.cb(self.list)
+            self.quiet_timer.cancel()
+            self._learn()
+            self._save_names()
+            self.cb(self.devices)
         elif error:
             self.timer.cancel()
+            self.quiet_timer.cancel()
             ut.report("BT scan error %d" % error)
             appuifw.note(u"Bluetooth scan failed", "error")
             self.cb(None)
         else:
-            self.list.append({"mac": add_colons(mac), "name": name})
-            self.resolver.next()
+            packed = long(str(mac), 16)
+            if self.names is not None:
+                name = self.names.name(packed, name)
             self.active = True
+            if not self.devices.add(packed, name):
+                # A device may well respond more than once.
+                self.resolver.next()
+                return
+            now = time.time()
+            self.gaps.append(now - self.last_arrival)
+            self.last_arrival = now
+            if self.config is not None and \
+               len(self.devices) >= self.config.get_btprox_max_devices():
+                ut.report("btprox scan found enough devices")
+                self.stop()
+                return
+            self.resolver.next()
+            if self.quiet:
+                self.quiet_timer.cancel()
+                self.quiet_timer.after(self.quiet, self._quiet)
+
+    def resolve_names(self):
+        """
+        Looks up the names of the devices found without one, one at a
+        time, on the background. A scan cuts this short.
+        """
+        if not self.inquiry_only or self.active or self.resolving:
+            return
+        self._resolve_next()
+
+    def _resolve_next(self):
+        macs = self.names.unknown.keys()
+        if not macs:
+            self.resolving = False
+            self._save_names()
+            return
+        self.resolving = True
+        self.lookup_mac = macs[0]
+        self.resolver.lookup_name("%012x" % self.lookup_mac, self._resolved)
+
+    def _resolved(self, error, dummy, name):
+        if not self.resolving:
+            return
+        mac = self.lookup_mac
+        if error or not name:
+            ut.report("no name for %s (%d)" % (mac, error))
+            # Until it is seen again.
+            if self.names.unknown.has_key(mac):
+                del self.names.unknown[mac]
+        else:
+            self.names.set(mac, name)
+        self._resolve_next()
 
     def cancel(self):
         self.resolver.cancel()
         self.timer.cancel()
+        self.quiet_timer.cancel()
         self.active = False
+        self.resolving = False
 
     def close(self):
         self.cancel()
         self.resolver.close()
 
+class BtproxMonitor:
+    """
+    Scans for Bluetooth devices on the background, on a duty cycle,
+    and keeps a table of the devices seen, with the times at which
+    each was first and last seen, so that a card can be given the
+    devices around us without waiting for a scan.
+
+    While the set of devices found stays the same from one scan to
+    the next, the interval between scans is doubled, up to a
+    configured maximum. As soon as the set changes, the interval
+    drops back to the minimum.
+    """
+    def __init__(self, config, names = None):
+        self.config = config
+        self.names = names
+        self.timer = e32.Ao_timer()
+        self.scanner = None
+        self.failed_scanner = None
+        self.devices = {} # packed address -> [name, first seen, last seen]
+        self.last_macs = None
+        self.last_scan = None # start time of the latest completed scan
+        self.scan_start = None
+        self.interval = config.get_btprox_interval()
+        self.waiters = []
+        self.running = False
+        self.scanning = False
+
+    def start(self):
+        """
+        It is safe to call this even when already running.
+        """
+        if self.running:
+            return
+        self.running = True
+        self.interval = self.config.get_btprox_interval()
+        self._scan()
+
+    def stop(self):
+        self.running = False
+        self.timer.cancel()
+        if self.scanning:
+            self.scanner.cancel()
+            self.scanning = False
+        self._notify()
+
+    def close(self):
+        self.stop()
+        if self.scanner:
+            self.scanner.close()
+            self.scanner = None
+        self._close_failed()
+
+    def _close_failed(self):
+        if self.failed_scanner:
+            self.failed_scanner.close()
+            self.failed_scanner = None
+
+    def recent(self):
+        """
+        Returns the devices seen within the configured window, or in
+        the latest scan if that was longer ago, as "BtDevices". Returns
+        None if no scan has completed.
+        """
+        if self.last_scan is None:
+            return None
+        cutoff = min(time.time() - self.config.get_btprox_window(),
+                     self.last_scan)
+        found = []
+        for mac, entry in self.devices.items():
+            if entry[2] >= cutoff:
+                found.append((entry[1], mac, entry[0]))
+        found.sort()
+        devices = BtDevices()
+        for first, mac, name in found:
+            devices.add(mac, name)
+        return devices
+
+    def wait(self, cb):
+        """
+        Has the callback called with the "recent" devices once the
+        next scan completes, starting one right away if none is in
+        progress.
+        """
+        self.waiters.append(cb)
+        if self.running and not self.scanning:
+            self._scan()
+
+    def stop_waiting(self, cb):
+        if cb in self.waiters:
+            self.waiters.remove(cb)
+
+    def _notify(self):
+        waiters = self.waiters
+        self.waiters = []
+        for cb in waiters:
+            cb(self.recent())
+
+    def _scan(self):
+        self.timer.cancel()
+        self._close_failed()
+        if not self.running:
+            return
+        if self.config.get_noscan() or not self.config.get_btprox_scan():
+            self._notify()
+            self.timer.after(self.interval, self._scan)
+            return
+        if not self.scanner:
+            try:
+                self.scanner = BtproxScanner(self.config, self.names)
+            except:
+                ut.report("BT monitor could not create a scanner")
+                self.scanner = None
+        if not self.scanner:
+            self.interval = self.config.get_btprox_max_interval()
+            self._notify()
+            self.timer.after(self.interval, self._scan)
+            return
+        self.scanning = True
+        self.scan_start = time.time()
+        self.scanner.scan(self._scanned)
+
+    def _scanned(self, btdata):
+        self.scanning = False
+        if btdata is None:
+            # Closed before the next scan, as the scanner may not be
+            # closed from within its own callback.
+            self.failed_scanner = self.scanner
+            self.scanner = None
+            self.interval = self.config.get_btprox_max_interval()
+        else:
+            now = time.time()
+            macs = {}
+            for mac, name in btdata.items():
+                macs[mac] = True
+                entry = self.devices.get(mac)
+                if entry is None:
+                    self.devices[mac] = [name, now, now]
+                else:
+                    entry[0] = name
+                    entry[2] = now
+            if macs == self.last_macs:
+                self.interval = min(self.interval * 2,
+                                    self.config.get_btprox_max_interval())
+            else:
+                self.interval = self.config.get_btprox_interval()
+            self.last_macs = macs
+            self.last_scan = self.scan_start
+            self._prune()
+        ut.report("BT monitor: %d devices, next scan in %d s" %
+                  (len(self.devices), self.interval))
+        if self.running:
+            self.timer.after(self.interval, self._scan)
+        self._notify()
+        if self.scanner and self.running:
+            self.scanner.resolve_names()
+
+    def _prune(self):
+        """
+        Drops the devices that "recent" would no longer return.
+        """
+        cutoff = min(time.time() - self.config.get_btprox_window(),
+                     self.last_scan)
+        for mac, entry in self.devices.items():
+            if entry[2] < cutoff:
+                del self.devices[mac]
+
 class Value:
     def __init__(self, value):
         self.value = value
@@ -323,6 +1105,106 @@ def read_file(fname):
     finally:
         fp.close()
 
+# The size of the blocks in which we read files that are being sent.
+file_block_size = 8192
+
+def file_size(fname):
+    return os.path.getsize(ut.to_str(fname))
+
+def read_file_blocks(fname, blocksize, offset = 0, size = None):
+    """
+    A generator that yields the contents of the named file in blocks
+    of at most "blocksize" bytes. If "offset" and "size" are given,
+    only that range of the file is read.
+    
+    Note that in Python 2.2 we cannot yield within a try-finally
+    block, so should the consumer stop iterating before we are done,
+    the file only gets closed once the generator gets garbage
+    collected.
+    """
+    fp = open(ut.to_str(fname), "rb")
+    if offset:
+        fp.seek(offset)
+    while size is None or size > 0:
+        if size is None:
+            block = fp.read(blocksize)
+        else:
+            block = fp.read(min(blocksize, size))
+            size -= len(block)
+        if not block:
+            break
+        yield block
+    fp.close()
+
+def file_digest(fname, blocksize):
+    """
+    Returns a digest of the contents of the named file, in the form
+    "<algorithm>:<hex digest>". The file is read a block at a time.
+    """
+    d = new_digest()
+    for block in read_file_blocks(fname, blocksize):
+        d.update(block)
+    return digest_algorithm + ":" + d.hexdigest()
+
+# The maximum number of file digests to remember.
+max_cached_digests = 50
+
+class DigestCache:
+    """
+    Remembers the digests of files, so that a file need only be read
+    for computing its digest when it has changed, as determined by
+    its modification time and size. The cache is persisted in the
+    configuration.
+    """
+    def __init__(self, config):
+        self.config = config
+
+    def get(self, fname):
+        st = os.stat(ut.to_str(fname))
+        key = (st[8], st[6]) # mtime, size
+        cache = self.config.db.get("digest_cache", {})
+        entry = cache.get(fname, None)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        digest = file_digest(fname, file_block_size)
+        if len(cache) >= max_cached_digests:
+            # Not worth the trouble keeping track of what is the
+            # least recently used entry.
+            cache = {}
+        cache[fname] = (key, digest)
+        self.config.db["digest_cache"] = cache
+        self.config.save_later()
+        return digest
+
+# The zlib compression level for compressed parts. Higher levels do
+# not gain much for our kind of data, but cost phone CPU time.
+deflate_level = 6
+
+def deflate_blocks(blocks):
+    """
+    A generator that deflates a sequence of strings on the fly,
+    yielding the compressed data in zlib format (which is what HTTP
+    calls "deflate").
+    """
+    co = zlib.compressobj(deflate_level)
+    for block in blocks:
+        data = co.compress(block)
+        if data:
+            yield data
+    yield co.flush()
+
+def deflated_file_size(fname, blocksize, offset = 0, size = None):
+    """
+    Returns the size of the named file (range) once deflated. The
+    compressed data is discarded as it is produced, so this costs
+    time, but not memory.
+    """
+    total = 0
+    for data in deflate_blocks(read_file_blocks(fname, blocksize,
+                                                offset, size)):
+        total += len(data)
+    return total
+
 dest_info = ("myhost.mydomain", 80, "/upload.php")
 
 def filename_str_encode(s):
@@ -344,110 +1226,1131 @@ INFINITY = float('1e66666')
 def is_nan(o):
     return (o != o) or (o == INFINITY) or (o == -INFINITY)
 
+# What "strip_nan" returns for a NaN or infinite float.
+NAN_VALUE = []
+
+def strip_nan(o):
+    """
+    Returns the given value with any NaN or infinite floats (which
+    JSON cannot represent) removed from any dicts, and replaced with
+    None in any lists and tuples, at any depth. Only the dicts, lists
+    and tuples that contain such floats, directly or indirectly, are
+    copied, and hence a clean value is returned as is. Returns
+    "NAN_VALUE" if the value itself is such a float.
+    """
+    t = type(o)
+    if t is float:
+        if (o != o) or (o == INFINITY) or (o == -INFINITY):
+            return NAN_VALUE
+        return o
+    elif t is dict:
+        new = None
+        for k, v in o.iteritems():
+            # Most values are strings or numbers, which we check
+            # without a call.
+            tv = type(v)
+            if tv is float:
+                if (v == v) and (v != INFINITY) and (v != -INFINITY):
+                    continue
+                nv = NAN_VALUE
+            elif tv is dict or tv is list or tv is tuple:
+                nv = strip_nan(v)
+                if nv is v:
+                    continue
+            else:
+                continue
+            if new is None:
+                new = o.copy()
+            if nv is NAN_VALUE:
+                del new[k]
+            else:
+                new[k] = nv
+        if new is None:
+            return o
+        return new
+    elif t is list or t is tuple:
+        new = None
+        i = -1
+        for v in o:
+            i += 1
+            tv = type(v)
+            if tv is float:
+                if (v == v) and (v != INFINITY) and (v != -INFINITY):
+                    continue
+                nv = None
+            elif tv is dict or tv is list or tv is tuple:
+                nv = strip_nan(v)
+                if nv is v:
+                    continue
+            else:
+                continue
+            if new is None:
+                new = list(o)
+            new[i] = nv
+        if new is None:
+            return o
+        if t is tuple:
+            return tuple(new)
+        return new
+    return o
+
 def filter_nan(d):
-    new_d = {}
-    for k, v in d.iteritems():
-        if type(v) == dict:
-            new_d[k] = filter_nan(v)
-        elif is_nan(v):
-            pass
+    """
+    Like "strip_nan", for a dict, with the same sharing of unchanged
+    parts.
+    """
+    return strip_nan(d)
+
+class MultipartRequest:
+    """
+    A multipart/form-data POST request, made up of a list of pieces,
+    each of which is either a string or (a range of) the contents of
+    a file. Files are only stat'ed as they are added, and are read a block at a time
+    as the request is being written out, and hence the request never
+    has to be in memory as a whole. The request may be written out
+    any number of times.
+
+    Parts may be compressed, in which case they get a
+    "Content-Encoding: deflate" header, and compressed files are
+    deflated on the fly as they are read. Compressing a file
+    requires an extra pass over it to find out the compressed size
+    for "Content-Length".
+    """
+    lf = "\r\n"
+    content_type = "multipart/form-data"
+    boundary = "-----AaB03xeql7ds"
+
+    def __init__(self, host, port, path):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.pieces = []
+        self.body_len = 0
+        self.num_parts = 0
+        self.finished = False
+
+        # Whether to ask the server to keep the connection open after
+        # responding. Must not be changed while the request is being
+        # written out.
+        self.keep_alive = False
+
+        # Identifies the card being sent, so that the server can
+        # ignore any duplicates of it.
+        self.card_id = None
+
+        # The total size of all compressed part bodies, before and
+        # after compression.
+        self.raw_len = 0
+        self.deflated_len = 0
+
+        # Any attachments that the server might already have, as a
+        # list of [digest, part name, part filename, piece index, part
+        # number] lists. Once the server has been asked about a digest, it
+        # is removed from here.
+        self.attachments = []
+
+    def _add_str(self, s):
+        self.pieces.append((s, None, 0, len(s), False))
+        self.body_len += len(s)
+
+    def _add_file(self, fname, offset = 0, size = None, deflated = False):
+        """
+        If "deflated" is true, "size" must be given, and it is the
+        size of the file range once deflated.
+        """
+        if size is None:
+            size = file_size(fname) - offset
+        self.pieces.append((None, fname, offset, size, deflated))
+        self.body_len += size
+
+    def _part_prefix(self, index):
+        hb = "--" + self.boundary + self.lf
+        if index > 0:
+            hb = self.lf + hb
+        return hb
+
+    def _begin_part(self, head):
+        if self.finished: raise "assertion failure"
+        hb = self._part_prefix(self.num_parts)
+        self.num_parts += 1
+        self._add_str(hb + head + self.lf)
+
+    def add_part(self, head, body, compress = False):
+        """
+        head:: The part headers, each terminated by CRLF.
+        body:: The part body as a string.
+        compress:: Whether to deflate the body, if that makes it
+                   any smaller.
+        """
+        if compress and zlib:
+            data = zlib.compress(body, deflate_level)
+            if len(data) < len(body):
+                self.raw_len += len(body)
+                self.deflated_len += len(data)
+                head = head + "Content-Encoding: deflate\r\n"
+                body = data
+        self._begin_part(head)
+        self._add_str(body)
+
+    def add_file_part(self, head, fname, compress = False):
+        """
+        Like "add_part", but the part body is the contents of the
+        named file, which must not change before the request has been
+        written out.
+        """
+        if compress and zlib:
+            raw_size = file_size(fname)
+            size = deflated_file_size(fname, file_block_size)
+            if size < raw_size:
+                self.raw_len += raw_size
+                self.deflated_len += size
+                self._begin_part(head + "Content-Encoding: deflate\r\n")
+                self._add_file(fname, 0, size, True)
+                return
+        self._begin_part(head)
+        self._add_file(fname)
+
+    def add_attachment_part(self, name, filename, ctype, fname, digest):
+        """
+        Adds a part with the contents of the named file as its body,
+        such that should it turn out that the server already has an
+        attachment with the given digest, the body can be replaced by
+        a mere reference to it, using "use_reference".
+        
+        name:: The form field name of the part.
+        filename:: The filename of the part, already encoded.
+        """
+        head = "Content-Disposition: form-data; name=\"%s\"; filename=%s\r\nContent-Type: %s\r\nContent-Transfer-Encoding: binary\r\n" % (name, filename, ctype)
+        index = len(self.pieces)
+        self.attachments.append([digest, name, filename, index,
+                                 self.num_parts])
+        self._begin_part(head)
+        self._add_file(fname)
+
+    def pending_digests(self):
+        return [ a[0] for a in self.attachments ]
+
+    def attachment_file(self, digest):
+        """
+        Returns the name and size of the file of the attachment with
+        the given digest.
+        """
+        for a in self.attachments:
+            if a[0] == digest:
+                piece = self.pieces[a[3]+1]
+                return piece[1], piece[3]
+        raise "no such attachment"
+
+    def use_reference(self, digest):
+        """
+        Replaces the attachment with the given digest with a
+        "<name>-ref" part whose body is the digest. The request must
+        not be being written out at the time. Returns the change in
+        request size, header included.
+        """
+        old_total = self.length()
+        delta = 0
+        for a in self.attachments:
+            if a[0] != digest:
+                continue
+            dg, name, filename, index, partno = a
+            head = "Content-Disposition: form-data; name=\"%s-ref\"; filename=%s\r\nContent-Type: text/plain\r\n" % (name, filename)
+            old_len = self.pieces[index][3] + self.pieces[index+1][3]
+            hs = self._part_prefix(partno) + head + self.lf
+            self.pieces[index] = (hs, None, 0, len(hs), False)
+            self.pieces[index+1] = (digest, None, 0, len(digest), False)
+            delta += (len(hs) + len(digest)) - old_len
+        self.body_len += delta
+        self.resolved(digest)
+        return self.length() - old_total
+
+    def resolved(self, digest):
+        """
+        Records that there is no need to ask the server about the
+        given digest (any more).
+        """
+        self.attachments = [ a for a in self.attachments
+                             if a[0] != digest ]
+
+    def compression_ratio(self):
+        """
+        Returns the size of the compressed parts relative to their
+        original size, or None if nothing was compressed.
+        """
+        if not self.raw_len:
+            return None
+        return float(self.deflated_len) / self.raw_len
+
+    def finish(self):
+        self._add_str(self.lf + "--" + self.boundary + "--" + self.lf)
+        self.finished = True
+
+    def header(self):
+        conn = (self.keep_alive and "keep-alive" or "close")
+        if self.card_id is None:
+            idhead = ""
         else:
-            new_d[k] = v
-    return new_d
+            idhead = "X-Card-Id: %s\r\n" % self.card_id
+        return "POST %s HTTP/1.1\r\nHost: %s:%d\r\nConnection: %s\r\n%sContent-type: %s, boundary=%s\r\nContent-Length: %d\r\n\r\n" % (self.path, self.host, self.port, conn, idhead, self.content_type, self.boundary, self.body_len)
+
+    def length(self):
+        return len(self.header()) + self.body_len
+
+    def chunks(self, blocksize):
+        """
+        A generator that yields the request as a sequence of strings.
+        File contents are yielded in blocks of at most "blocksize"
+        bytes, but other pieces are yielded as they are.
+        """
+        if not self.finished: raise "assertion failure"
+        yield self.header()
+        for s, fname, offset, size, deflated in self.pieces:
+            if fname is None:
+                yield s
+            elif deflated:
+                # Here "size" is the deflated size, so read the rest.
+                blocks = read_file_blocks(fname, blocksize, offset)
+                for data in deflate_blocks(blocks):
+                    yield data
+            else:
+                for block in read_file_blocks(fname, blocksize,
+                                              offset, size):
+                    yield block
+
+class BatchRequest(MultipartRequest):
+    """
+    A multipart/mixed POST request that carries several card requests
+    as its parts, each with its own multipart/form-data body, so that
+    a number of cards can be posted in one go. Attachment references
+    are not supported within batches.
+    """
+    content_type = "multipart/mixed"
+    boundary = "-----AaB03xbatch"
+
+    def add_request_part(self, request):
+        if not request.finished: raise "assertion failure"
+        head = "Content-Type: %s, boundary=%s\r\n" % \
+               (request.content_type, request.boundary)
+        if request.card_id is not None:
+            head = head + ("X-Card-Id: %s\r\n" % request.card_id)
+        self._begin_part(head)
+        self.pieces.extend(request.pieces)
+        self.body_len += request.body_len
+        self.raw_len += request.raw_len
+        self.deflated_len += request.deflated_len
+
+class BlobQuery:
+    """
+    A GET request for asking the server whether it has an attachment
+    with the given digest. It answers 200 with the digest in an
+    "X-Blob-Present" header if it does, and 404 if it does not, in
+    which case any "X-Blob-Offset" header tells how much of the
+    attachment it has received so far in "BlobPart"s. Any other
+    answer, such as a 200 from a server that does not know about
+    blobs, is taken to mean that the server does not have it.
+    """
+    def __init__(self, host, port, path, digest):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.digest = digest
+        self.keep_alive = False
+
+    def header(self):
+        conn = (self.keep_alive and "keep-alive" or "close")
+        return "GET %s?blob=%s HTTP/1.1\r\nHost: %s:%d\r\nConnection: %s\r\n\r\n" % (self.path, self.digest, self.host, self.port, conn)
+
+    def length(self):
+        return len(self.header())
+
+    def chunks(self, blocksize):
+        return [self.header()]
+
+class BlobPart:
+    """
+    A POST request that uploads a range of an attachment, to be
+    appended to what the server has already received of it. The
+    server answers with the total amount it now has contiguously in
+    "X-Blob-Offset", and with "X-Blob-Complete" once it has the whole
+    attachment (and has verified the digest). If the offset is not
+    what the server expected, it answers 409, again giving the offset
+    it wants.
+    """
+    def __init__(self, host, port, path, digest, fname, total,
+                 offset, size, partno):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.digest = digest
+        self.fname = fname
+        self.total = total
+        self.offset = offset
+        self.size = size
+        self.partno = partno
+        self.keep_alive = False
+
+    def header(self):
+        conn = (self.keep_alive and "keep-alive" or "close")
+        return "POST %s?blob=%s&part=%d&offset=%d&total=%d HTTP/1.1\r\nHost: %s:%d\r\nConnection: %s\r\nContent-Type: application/octet-stream\r\nContent-Length: %d\r\n\r\n" % (self.path, self.digest, self.partno, self.offset, self.total, self.host, self.port, conn, self.size)
+
+    def length(self):
+        return len(self.header()) + self.size
+
+    def chunks(self, blocksize):
+        yield self.header()
+        for block in read_file_blocks(self.fname, blocksize,
+                                      self.offset, self.size):
+            yield block
+
+class HostResolver:
+    """
+    Caches the IP addresses of hosts, so that we can connect by
+    address, and need not have the host looked up every time. Cached
+    addresses expire after a configured time. The last address that
+    we successfully connected to is persisted in the configuration,
+    and used until a fresh lookup replaces it, so that sending is fast
+    right after startup as well. Having connected to an address that
+    did not come from a fresh lookup, we look the host up anew, so
+    that a change in its address gets noticed even while the old one
+    still accepts connections.
+
+    "AoResolver" only does Bluetooth device discovery, so lookups are
+    done with "socket.gethostbyname", in a thread of their own, as it
+    blocks.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.cache = {} # host -> (address, expiry time)
+        self.pending = {}
+        self.callgate = None
+
+    def get(self, host):
+        """
+        Returns a cached address for the host, or None.
+        """
+        entry = self.cache.get(host)
+        if entry is None:
+            return self.config.db.get("host_addrs", {}).get(host)
+        if entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def good(self, host, addr):
+        """
+        Records that we could connect to the host at the given
+        address.
+        """
+        addrs = self.config.db.get("host_addrs", {})
+        if addrs.get(host) != addr:
+            addrs[host] = addr
+            self.config.db["host_addrs"] = addrs
+            self.config.save()
+
+    def forget(self, host):
+        """
+        Drops any cached address of the host, say after failing to
+        connect to it.
+        """
+        self.cache[host] = (None, 0)
+        addrs = self.config.db.get("host_addrs", {})
+        if addrs.has_key(host):
+            del addrs[host]
+            self.config.db["host_addrs"] = addrs
+            self.config.save()
+
+    def refresh(self, host, apid):
+        """
+        Starts looking up the host, unless we have a fresh address for
+        it, or are looking it up already. Lookups are only done over
+        a selected access point, as otherwise the user might get
+        asked for one.
+        """
+        entry = self.cache.get(host)
+        if (entry and entry[1] > time.time()) or \
+           self.pending.has_key(host) or (apid is None):
+            return
+        self.pending[host] = True
+        if thread is None or not hasattr(e32, "ao_callgate"):
+            self._looked_up(host, self._lookup(host, apid))
+            return
+        if self.callgate is None:
+            self.callgate = e32.ao_callgate(self._looked_up)
+        def run():
+            self.callgate(host, self._lookup(host, apid))
+        try:
+            thread.start_new_thread(run, ())
+        except:
+            ut.print_exception()
+            del self.pending[host]
+
+    def _lookup(self, host, apid):
+        try:
+            socket.set_default_access_point(socket.access_point(apid))
+            return socket.gethostbyname(host)
+        except:
+            return None
+
+    def _looked_up(self, host, addr):
+        ut.report("looked up %s: %s" % (host, addr))
+        if self.pending.has_key(host):
+            del self.pending[host]
+        if addr:
+            self.cache[host] = (addr, time.time() +
+                                self.config.get_dns_ttl())
+
+# Attachments at least this large are uploaded in parts of this
+# size, so that an interrupted upload can be resumed.
+resumable_min_size = 65536
+resumable_part_size = 32768
+
+# How many times in a row we reconnect to resume an attachment upload
+# before giving up.
+max_part_retries = 3
+
+class ResumeStore:
+    """
+    Persists the amount of each partially uploaded attachment that the
+    server has confirmed receiving, by digest, so that an upload can
+    be resumed even after a restart, and even if the server does not
+    tell us how far it got.
+    """
+    def __init__(self, config):
+        self.config = config
+
+    def get(self, digest):
+        return self.config.db.get("resume_offsets", {}).get(digest, 0)
+
+    def set(self, digest, offset):
+        offsets = self.config.db.get("resume_offsets", {})
+        offsets[digest] = offset
+        self.config.db["resume_offsets"] = offsets
+        self.config.save_later()
 
-def serialize_card(card):
+    def forget(self, digest):
+        offsets = self.config.db.get("resume_offsets", {})
+        if offsets.has_key(digest):
+            del offsets[digest]
+            self.config.db["resume_offsets"] = offsets
+            self.config.save_later()
+
+def new_card_id():
+    return "%08x%08x" % (int(time.time()), random.randint(0, 0x7fffffff))
+
+def load_stored_request(fname):
     """
-    We might consider making card sending more memory friendly by
-    building the serialized form as it is required. In particular,
-    reading the photo from a file in small chunks without storing the
-    whole thing in memory would be useful. We could use a generator
-    function, possibly, so that the sending function would repeatedly
-    invoke the generator as it should require more data to send.
+    Returns a "MultipartRequest" for a request stored in the named
+    file by "save_unsent_card". The body is read from the file as
+    the request is written out, but the header is regenerated, so
+    that we are free to decide on e.g. connection persistence.
     """
+    fp = open(ut.to_str(fname), "rb")
+    try:
+        head = fp.read(2048)
+    finally:
+        fp.close()
+    pos = head.find("\r\n\r\n")
+    if pos == -1:
+        raise "no end of header in stored request"
+    lines = head[:pos].split("\r\n")
+    path = lines[0].split(" ")[1]
+    fields = {}
+    for line in lines[1:]:
+        i = line.find(":")
+        if i != -1:
+            fields[line[:i].strip().lower()] = line[i+1:].strip()
+    host, port = fields["host"].split(":")
+    ctype, boundary = fields["content-type"].split(",", 1)
+    boundary = boundary.strip()
+    if boundary[:9] != "boundary=":
+        raise "no boundary in stored request"
+
+    request = MultipartRequest(host, int(port), path)
+    request.content_type = ctype.strip()
+    request.boundary = boundary[9:]
+    request.card_id = fields.get("x-card-id", None)
+    # Any compressed parts remain compressed as they were stored.
+    request._add_file(fname, pos + 4, int(fields["content-length"]))
+    request.finished = True
+    return request
+
+def make_batch_request(requests):
     host, port, path = dest_info
+    batch = BatchRequest(host, port, path)
+    for request in requests:
+        batch.add_request_part(request)
+    batch.finish()
+    return batch
 
-    lf = "\r\n"
-    boundary = "-----AaB03xeql7ds"
-    hb = "--" + boundary
-    pbegin = hb + lf
-    psep = lf + pbegin
-    pend = lf + hb + "--" + lf
-    parts = []
-
-    metaparthead = "Content-Disposition: form-data; name=\"metadata\"; filename=\"postcard-metadata.json\"\r\nContent-Type: application/json; charset=UTF-8\r\n"
-    metapartbody = simplejson.dumps(filter_nan(card.metadata))
-    metapart = lf.join([metaparthead, metapartbody])
-    parts.append(metapart)
-
-    if card.filedata is not None:
-        filedatapartbody = card.filedata
+# Attachments smaller than this are not worth asking the server
+# about, as the question costs about as much as sending them.
+dedup_min_size = 4096
+
+def serialize_card(card, compress = False, digests = None, codec = None):
+    """
+    Returns a "MultipartRequest" for sending the card. Any picture or
+    file data is not read here, but only as the request is being
+    written out, so that we can do with little memory even when the
+    attachments are large.
+
+    If "compress" is true, the metadata and any filedata are
+    compressed. The picture is never compressed, as JPEG data does
+    not compress any further.
+
+    If a "DigestCache" is given, the picture is added as an
+    attachment that need not be uploaded again if the server already
+    has it. Any "upload_picfile" of the card is sent in place of the
+    picture itself. Large uncompressed filedata files are likewise
+    added as attachments, so that they can be uploaded resumably.
+
+    The metadata is encoded with the given codec (see
+    "tpytwink_metadata"), JSON by default, and the Content-Type of the
+    metadata part tells the server which one was used.
+    """
+    host, port, path = dest_info
+    request = MultipartRequest(host, port, path)
+    request.card_id = new_card_id()
+
+    if codec is None:
+        codec = meta.json_codec
+    metaparthead = "Content-Disposition: form-data; name=\"metadata\"; filename=\"%s\"\r\nContent-Type: %s\r\n" % (codec.filename, codec.content_type)
+    if codec.binary:
+        metaparthead += "Content-Transfer-Encoding: binary\r\n"
+    metapartbody = card.encode_metadata(codec)
+    request.add_part(metaparthead, metapartbody, compress)
+
+    if card.has_filedata():
         filedataparthead = "Content-Disposition: form-data; name=\"filedata\"; filename=%s\r\nContent-Type: application/octet-stream\r\nContent-Transfer-Encoding: binary\r\n" % filename_str_encode(card.filedataname)
-        filedatapart = lf.join([filedataparthead, filedatapartbody])
-        parts.append(filedatapart)
+        if card.filedatafile is not None and digests and \
+           (not compress) and \
+           file_size(card.filedatafile) >= resumable_min_size:
+            request.add_attachment_part("filedata",
+                                        filename_str_encode(card.filedataname),
+                                        "application/octet-stream",
+                                        card.filedatafile,
+                                        digests.get(card.filedatafile))
+        elif card.filedatafile is not None:
+            request.add_file_part(filedataparthead, card.filedatafile,
+                                  compress)
+        else:
+            request.add_part(filedataparthead, card.filedata, compress)
 
     if card.picfile is not None:
-        #print repr(card.picfile)
-        picpartbody = read_file(card.picfile)
-        #print repr(picpartbody)
-        picparthead = "Content-Disposition: form-data; name=\"picture\"; filename=%s\r\nContent-Type: image/jpeg\r\nContent-Transfer-Encoding: binary\r\n" % filename_str_encode(ut.basename(card.picfile))
-        picpart = lf.join([picparthead, picpartbody])
-        parts.append(picpart)
-
-    uppartbody = "Upload"
+        picfilename = filename_str_encode(ut.basename(card.picfile))
+        picfile = card.upload_picfile or card.picfile
+        if digests and file_size(picfile) >= dedup_min_size:
+            request.add_attachment_part("picture", picfilename,
+                                        "image/jpeg", picfile,
+                                        digests.get(picfile))
+        else:
+            picparthead = "Content-Disposition: form-data; name=\"picture\"; filename=%s\r\nContent-Type: image/jpeg\r\nContent-Transfer-Encoding: binary\r\n" % picfilename
+            request.add_file_part(picparthead, picfile)
+
     upparthead = "Content-Disposition: form-data; name=\"upload\"\r\n"
-    uppart = lf.join([upparthead, uppartbody])
-    parts.append(uppart)
+    request.add_part(upparthead, "Upload")
 
-    body = "".join([pbegin, psep.join(parts), pend])
-    body_len = len(body)
-    header = "POST %s HTTP/1.1\r\nHost: %s:%d\r\nConnection: close\r\nContent-type: multipart/form-data, boundary=%s\r\nContent-Length: %d\r\n" % (path, host, port, boundary, body_len)
-    request = "".join([header, "\r\n", body])
+    request.finish()
     return request
 
-class ReadExp:
-    def __init__(self, max, sock, cb):
-        self.max = max
-        self.len = 0
+# The maximum amount of response data we ask for in one read.
+read_block_size = 1024
+
+# The maximum amount of response body we keep; any more is discarded.
+max_response_body = 4096
+
+# The maximum length of a status, header, or chunk size line.
+max_response_line = 2048
+
+KErrGeneral = -2
+KErrEof = -25
+KErrTimedOut = -33
+
+class HttpResponse:
+    def __init__(self):
+        self.version = None
+        self.status = None
+        self.reason = None
+        self.headers = {}
+        self.body = ""
+
+        # Whether the server is willing to take another request on
+        # the same connection.
+        self.reusable = False
+
+    def header(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+    def classify(self):
+        if self.status == 200:
+            return "accepted"
+        elif self.status == 400:
+            return "refused"
+        return "other"
+
+class HttpResponseParser:
+    """
+    An incremental HTTP/1.0 and HTTP/1.1 response parser. Data may be
+    fed in pieces of any size as it arrives, and the parser keeps
+    track of where it is. Any interim 1xx responses are skipped. The
+    body may be delimited by "Content-Length", by chunked transfer
+    coding, or by the end of the connection.
+
+    Once "state" is "done", the response is in "resp", and any data
+    received beyond its end is in "rest". A malformed response sets
+    "state" to "error".
+    """
+    def __init__(self):
+        self.state = "status"
+        self.resp = HttpResponse()
+        self.line = []
+        self.line_len = 0
+        self.body = []
+        self.body_len = 0
+        self.left = 0
+        self.rest = ""
+
+    def feed(self, data):
+        pos = 0
+        dlen = len(data)
+        while pos < dlen:
+            state = self.state
+            if state == "done":
+                self.rest += data[pos:]
+                return
+            elif state == "error":
+                return
+            elif state == "body" or state == "chunk":
+                take = min(self.left, dlen - pos)
+                self._body_data(data[pos:pos+take])
+                pos += take
+                self.left -= take
+                if self.left == 0:
+                    if state == "body":
+                        self._done()
+                    else:
+                        self.state = "chunk_end"
+            elif state == "body_eof":
+                self._body_data(data[pos:])
+                pos = dlen
+            else:
+                idx = data.find("\n", pos)
+                if idx == -1:
+                    piece = data[pos:]
+                    pos = dlen
+                else:
+                    piece = data[pos:idx]
+                    pos = idx + 1
+                self.line.append(piece)
+                self.line_len += len(piece)
+                if self.line_len > max_response_line:
+                    self.state = "error"
+                elif idx != -1:
+                    line = "".join(self.line)
+                    self.line = []
+                    self.line_len = 0
+                    if line[-1:] == "\r":
+                        line = line[:-1]
+                    self._line(line)
+
+    def eof(self):
+        """
+        To be called when the server has closed the connection.
+        """
+        if self.state == "body_eof":
+            self._done()
+        elif self.state != "done":
+            self.state = "error"
+
+    def _line(self, line):
+        state = self.state
+        if state == "status":
+            self._status_line(line)
+        elif state == "header":
+            if line == "":
+                self._end_of_head()
+            else:
+                self._header_line(line)
+        elif state == "chunk_size":
+            try:
+                self.left = int(line.split(";", 1)[0].strip(), 16)
+            except ValueError:
+                self.state = "error"
+                return
+            if self.left == 0:
+                self.state = "trailer"
+            else:
+                self.state = "chunk"
+        elif state == "chunk_end":
+            if line != "":
+                self.state = "error"
+            else:
+                self.state = "chunk_size"
+        elif state == "trailer":
+            if line == "":
+                self._done()
+
+    def _status_line(self, line):
+        words = line.split(" ", 2)
+        if len(words) < 2 or words[0][:5] != "HTTP/":
+            self.state = "error"
+            return
+        resp = self.resp
+        resp.version = words[0]
+        try:
+            resp.status = int(words[1])
+        except ValueError:
+            self.state = "error"
+            return
+        if len(words) > 2:
+            resp.reason = words[2]
+        self.state = "header"
+
+    def _header_line(self, line):
+        pos = line.find(":")
+        if pos == -1:
+            self.state = "error"
+            return
+        self.resp.headers[line[:pos].strip().lower()] = line[pos+1:].strip()
+
+    def _end_of_head(self):
+        resp = self.resp
+        status = resp.status
+
+        if status >= 100 and status < 200:
+            # An interim response, such as "100 Continue"; the real
+            # one is still to come.
+            self.resp = HttpResponse()
+            self.state = "status"
+            return
+
+        conn = resp.header("connection", "").lower()
+        if resp.version == "HTTP/1.0":
+            resp.reusable = (conn == "keep-alive")
+        else:
+            resp.reusable = (conn != "close")
+
+        coding = resp.header("transfer-encoding", "identity").lower()
+        length = resp.header("content-length")
+        if status == 204 or status == 304:
+            self._done()
+        elif coding != "identity":
+            if coding.split(",")[-1].strip() != "chunked":
+                self.state = "error"
+                return
+            self.state = "chunk_size"
+        elif length is not None:
+            try:
+                self.left = int(length)
+            except ValueError:
+                self.state = "error"
+                return
+            if self.left == 0:
+                self._done()
+            else:
+                self.state = "body"
+        else:
+            # The body extends to the end of the connection.
+            resp.reusable = False
+            self.state = "body_eof"
+
+    def _body_data(self, data):
+        room = max_response_body - self.body_len
+        if room > 0:
+            data = data[:room]
+            self.body.append(data)
+            self.body_len += len(data)
+
+    def _done(self):
+        self.resp.body = "".join(self.body)
+        self.body = []
+        self.state = "done"
+
+class ReadResponse:
+    """
+    Reads an HTTP response from a socket, using an
+    "HttpResponseParser". Reading stops at the end of the response,
+    so that the connection can be reused afterwards where the server
+    allows.
+    """
+    def __init__(self, sock, cb):
+        """
+        cb:: Called with a Symbian error code and an "HttpResponse",
+             or None if the response could not be parsed.
+        """
         self.sock = sock
-        self.data = ""
         self.cb = cb
+        self.parser = HttpResponseParser()
 
     def read(self):
-        amount = (ut.get_debug_on() and 1024 or (self.max - self.len))
-        self.sock.read_some(amount, self._read, None)
+        self.sock.read_some(read_block_size, self._read, None)
+
+    def cancel(self):
+        """
+        Makes sure that "cb" does not get called. Any read in progress
+        must be cancelled separately.
+        """
+        self.cb = None
 
     def _read(self, err, data, udata):
         ut.report((err, data, udata))
-        if err != 0:
+        if self.cb is None:
+            return
+        parser = self.parser
+        if err == KErrEof:
+            parser.eof()
+            if parser.state != "done":
+                self.cb(err, None)
+                return
+        elif err != 0:
             self.cb(err, None)
+            return
+        else:
+            parser.feed(data)
+
+        if parser.state == "done":
+            if parser.rest:
+                # Nothing should follow, as we only have one request
+                # outstanding at a time.
+                parser.resp.reusable = False
+            self.cb(0, parser.resp)
+        elif parser.state == "error":
+            self.cb(0, None)
         else:
-            self.data += data
-            self.len += len(data)
-            if self.len == self.max:
-                self.cb(err, self.data)
-            elif self.len > self.max:
-                self.cb(err, self.data[0:self.max])
+            self.read()
+
+# The maximum amount of data we hand to the socket in one write.
+write_block_size = 4096
+
+# The minimum interval (in seconds) between progress reports.
+progress_interval = 1.0
+
+def rechunk(chunks, blocksize):
+    """
+    A generator that turns a sequence of strings into a sequence of
+    strings of exactly "blocksize" bytes each, except that the last
+    one may be shorter. Small strings get coalesced, and large ones
+    split.
+    """
+    pending = []
+    plen = 0
+    for chunk in chunks:
+        off = 0
+        clen = len(chunk)
+        while off < clen:
+            take = min(blocksize - plen, clen - off)
+            if off == 0 and take == clen:
+                pending.append(chunk)
             else:
-                self.read()
+                pending.append(chunk[off:off+take])
+            plen += take
+            off += take
+            if plen == blocksize:
+                yield "".join(pending)
+                pending = []
+                plen = 0
+    if pending:
+        yield "".join(pending)
+
+class Uploader:
+    """
+    Sends requests over TCP, one at a time. The request is written a
+    block at a time, with the next write only issued once the
+    previous one has completed, so that we never have more than one
+    block of the request buffered at any one time.
+
+    If keep-alive is enabled in the configuration, the connection is
+    kept open after a response, and reused for the next request,
+    until it has been idle for a configured time. Should the server
+    have closed a kept connection in the meantime, the request is
+    retried over a new connection.
+
+    Before sending a request with attachments that the server might
+    already have, the server is asked about each of them with a
+    "BlobQuery", and any that it has are sent as references only.
+
+    If resumable uploads are enabled, any large attachments that the
+    server does not have are first uploaded separately as a sequence
+    of "BlobPart"s, starting from where any earlier attempt left off,
+    and then referred to from the request. Should the connection be
+    lost during this, we reconnect and carry on from the last part
+    the server acknowledged.
+
+    Connecting, the writing of each block, and waiting for the
+    response all have configurable deadlines, and the transfer is
+    also considered stalled if it is too slow over a while. Should
+    any of these be exceeded, the socket is cancelled, and the send
+    fails with "KErrTimedOut", with the phase in "timeout_phase".
+
+    The access point and the connection may be brought up ahead of
+    time with "prewarm", while the card is still being put together.
+    A send then picks up the connection, waiting for it to complete
+    if need be. An unused prewarmed connection is torn down after a
+    configured time.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.host, self.port, self.path = dest_info
+        self.serv = None
+        self.conn = None
+        self.sock = None
+        self.apid = None
+        self.requests = None
+        self.chunks = None
+        self.responses = []
+        self.busy = False
+        self.connecting = False
+        self.query = None
+        self.blob = None
+        self.resume = ResumeStore(config)
+        self.resolver = HostResolver(config)
+        self.reader = None
+        self.timeout_phase = None
+        self.idle_timer = e32.Ao_timer()
+        self.watchdog = e32.Ao_timer()
+
+    def send(self, request, cb, progress_cb = None):
+        """
+        request:: A "MultipartRequest" to send.
+        cb:: Called with a Symbian error code and a classification
+             of the server response.
+        progress_cb:: If given, called every now and then during
+                      writing with the number of bytes sent so far,
+                      the total number of bytes to send, and the
+                      current rate in bytes per second.
+        """
+        def batch_cb(serr, equs):
+            cb(serr, equs and equs[0] or None)
+        self.send_batch([request], batch_cb, progress_cb)
+
+    def send_batch(self, requests, cb, progress_cb = None,
+                   envelope = False):
+        """
+        Sends a number of requests back-to-back over the same
+        connection, if the server allows, or, if "envelope" is true,
+        as the parts of a single "BatchRequest".
+        
+        cb:: Called with a Symbian error code and a list of response
+             classifications, one per request. On error, the list
+             only covers the requests that got a response. The
+             "HttpResponse" objects themselves are in "responses",
+             for any caller interested in the details.
+        """
+        if self.busy:
+            raise "still sending"
+
+        if envelope:
+            batch = make_batch_request(requests)
+            def batch_cb(serr, equs):
+                if equs:
+                    equs = equs * len(requests)
+                cb(serr, equs)
+            self.send_batch([batch], batch_cb, progress_cb)
+            return
+
+        keep_alive = self.config.get_keep_alive()
+        for request in requests:
+            request.keep_alive = keep_alive
+
+        self.cb = cb
+        self.progress_cb = progress_cb
+        self.requests = list(requests)
+        self.equs = []
+        self.responses = []
+        self.total = 0
+        for request in requests:
+            self.total += request.length()
+        self.sent = 0
+        self.bps = 0.0
+        self.blob = None
+        self.part_retries = 0
+        self.timeout_phase = None
+        self.busy = True
+        self.idle_timer.cancel()
+        self._send_next()
+
+    def prewarm(self, connect = True):
+        """
+        Brings up the access point, and if "connect" is true, also
+        connects to the server, unless there already is a connection.
+        Errors are not reported, as the connection will be
+        (re)attempted when sending anyway.
+        """
+        if self.busy or self.sock:
+            return
+        try:
+            self._open_link()
+            if connect:
+                self._open_sock(self._prewarmed)
+                self.connecting = True
+            else:
+                self.resolver.refresh(self.host, self.apid)
+        except:
+            ut.print_exception()
+            return
+        self.idle_timer.cancel()
+        self.idle_timer.after(self.config.get_prewarm_idle(),
+                              self._prewarm_expired)
 
-http_accepted = "HTTP/1.1 200 "
-http_refused = "HTTP/1.1 400 "
+    def _prewarmed(self, err, udata):
+        ut.report("prewarm connect done (%d)" % err)
+        self.connecting = False
+        if err:
+            self._close_sock()
+        if not self.busy:
+            if err:
+                self.idle_timer.after(self.config.get_prewarm_idle(),
+                                      self._prewarm_expired)
+            return
+        # A send is waiting for the connection.
+        if err:
+            self.fresh = True
+            try:
+                self._connect()
+            except:
+                ut.print_exception()
+                self._finish(err, None)
+        else:
+            self._write_request()
 
-class Uploader:
-    def __init__(self, config):
-        self.config = config
-        self.host, self.port, self.path = dest_info
-        self.serv = None
-        self.conn = None
-        self.sock = None
-        self.apid = None
+    def _prewarm_expired(self):
+        """
+        Tears down an unused prewarmed connection, and the access
+        point connection with it.
+        """
+        ut.report("prewarmed connection unused")
+        self._close_sock()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def _send_next(self):
+        if self.connecting:
+            # A prewarm connect still in progress, which we continue
+            # from once it completes.
+            self.fresh = True
+            self._watch("connect", self.config.get_connect_timeout())
+        elif self.sock:
+            # Reusing a kept or prewarmed connection, which the
+            # server may have closed by now.
+            self.fresh = False
+            self._write_request()
+        else:
+            self.fresh = True
+            self._connect()
 
-    def send(self, card_data, cb):
-        if self.sock:
-            raise "still sending"
+    def _connect(self):
+        try:
+            self._open_link()
+            self._open_sock(self._connected)
+        except:
+            self.busy = False
+            raise
+        self._watch("connect", self.config.get_connect_timeout())
 
-        self.cb = cb
-        self.data = card_data
+    def _open_link(self):
+        """
+        Sets up the socket server session, and the access point
+        connection, if an access point has been selected.
+        """
         apid = self.config.get_apid()
 
         if not self.serv:
@@ -467,6 +2370,13 @@ class Uploader:
                 self.conn = None
                 ut.print_exception()
 
+    def _open_sock(self, cb):
+        """
+        Connects to the server, by any cached address, calling "cb"
+        once done.
+        """
+        self.connect_cb = cb
+        self.addr = self.resolver.get(self.host)
         self.sock = AoSocket()
         try:
             self.sock.set_socket_serv(self.serv)
@@ -474,47 +2384,326 @@ class Uploader:
                 self.sock.set_connection(self.conn)
             self.sock.open_tcp()
             #print "making connect request"
-            self.sock.connect_tcp(unicode(self.host), self.port, self._connected, None)
+            self.sock.connect_tcp(unicode(self.addr or self.host),
+                                  self.port, self._sock_connected,
+                                  self.sock)
             #print "now connecting"
         except:
             self.sock.close()
             self.sock = None
+            raise
+
+    def _sock_connected(self, err, udata):
+        if udata is not self.sock:
+            # For a socket we have given up on.
+            return
+        if self.addr is None:
+            if not err:
+                self.resolver.refresh(self.host, self.apid)
+        elif err:
+            # The cached address may no longer be valid, so try again
+            # by name, and have the name looked up anew.
+            ut.report("connect to %s failed (%d)" % (self.addr, err))
+            self.resolver.forget(self.host)
+            self.sock.close()
+            self.sock = None
+            try:
+                self._open_sock(self.connect_cb)
+                return
+            except:
+                ut.print_exception()
+        else:
+            self.resolver.good(self.host, self.addr)
+            # Does nothing if the address is from a fresh lookup.
+            self.resolver.refresh(self.host, self.apid)
+        self.connect_cb(err, udata)
 
     def _connected(self, *args):
         #print repr(["_connected", args])
         err, udata = args
         if err:
-            self.cancel()
-            self.cb(err, None)
+            self._fail(err)
         else:
-            self.sock.write_data(self.data, self._written, None)
+            self._write_request()
+
+    def _write_request(self):
+        self.req_sent = 0
+        request = self.requests[0]
+        self.query = None
+        digests = request.pending_digests()
+        if self.blob:
+            digest, fname, total, offset = self.blob[:4]
+            size = min(resumable_part_size, total - offset)
+            self.query = BlobPart(self.host, self.port, self.path,
+                                  digest, fname, total, offset, size,
+                                  offset / resumable_part_size)
+        elif digests:
+            self.query = BlobQuery(self.host, self.port, self.path,
+                                   digests[0])
+        if self.query:
+            self.query.keep_alive = request.keep_alive
+            request = self.query
+        self.chunks = rechunk(request.chunks(file_block_size),
+                              write_block_size)
+        self.rate_time = time.time()
+        self.rate_sent = self.sent
+        self.stall_time = self.rate_time
+        self.stall_sent = self.sent
+        self._write_next()
+
+    def _write_next(self):
+        """
+        Writes out the next block of the request, if any, or starts
+        reading the response otherwise.
+        """
+        try:
+            block = self.chunks.next()
+        except StopIteration:
+            self.chunks = None
+            self._report_progress(True)
+            self._watch("response", self.config.get_response_timeout())
+            self.reader = ReadResponse(self.sock, self._read)
+            self.reader.read()
+            return
+        self.block_len = len(block)
+        self._watch("write", self.config.get_write_timeout())
+        self.sock.write_data(block, self._written, self.sock)
 
     def _written(self, *args):
         #print repr(["_written", args])
         err, udata = args
+        if udata is not self.sock:
+            # For a socket we have given up on.
+            return
         if err:
-            self.cancel()
-            self.cb(err, None)
+            self._fail(err)
+        elif self.query and not self.blob:
+            self._write_next()
         else:
-            self.reader = ReadExp(len(http_accepted), self.sock, self._read)
-            self.reader.read()
+            self.sent += self.block_len
+            self.req_sent += self.block_len
+            self._report_progress(False)
+            if self._stalled():
+                self._timed_out("stall")
+                return
+            self._write_next()
 
-    def _read(self, serr, data):
-        #print repr(["_read", serr, data])
-        self.cancel()
-        if not serr:
-            if data == http_accepted:
-                equ = "accepted"
-            elif data == http_refused:
-                equ = "refused"
-            else:
-                equ = "other"
-        self.cb(serr, equ)
+    def _stalled(self):
+        """
+        Checks whether we have been sending slower than the configured
+        minimum rate over the last stall window.
+        """
+        now = time.time()
+        elapsed = now - self.stall_time
+        window = self.config.get_stall_window()
+        if elapsed < window:
+            return False
+        bps = (self.sent - self.stall_sent) / elapsed
+        self.stall_time = now
+        self.stall_sent = self.sent
+        if bps < self.config.get_min_upload_bps():
+            ut.report("transfer stalled (%.1f B/s)" % bps)
+            return True
+        return False
 
-    def cancel(self):
+    def _watch(self, phase, secs):
+        """
+        Starts the deadline for the named phase, replacing any
+        earlier one.
+        """
+        self.watchdog.cancel()
+        self.phase = phase
+        self.watchdog.after(secs, self._timed_out)
+
+    def _timed_out(self, phase = None):
+        phase = phase or self.phase
+        ut.report("send timed out (%s)" % phase)
+        self.watchdog.cancel()
+        self.timeout_phase = phase
+        if self.reader:
+            self.reader.cancel()
+            self.reader = None
+        if self.sock:
+            try:
+                self.sock.cancel()
+            except:
+                ut.print_exception()
+        self._fail(KErrTimedOut)
+
+    def _report_progress(self, force):
+        """
+        Updates the transfer rate, and reports progress if it is time
+        to do so. The rate is computed over the interval since the
+        last report.
+        """
+        now = time.time()
+        elapsed = now - self.rate_time
+        if (not force) and (elapsed < progress_interval):
+            return
+        if elapsed > 0:
+            self.bps = (self.sent - self.rate_sent) / elapsed
+        self.rate_time = now
+        self.rate_sent = self.sent
+        if self.progress_cb:
+            self.progress_cb(self.sent, self.total, self.bps)
+
+    def _read(self, serr, resp):
+        #print repr(["_read", serr, resp])
+        self.watchdog.cancel()
+        self.reader = None
+        if serr:
+            self._fail(serr)
+            return
+        if resp is None:
+            # Could not make sense of the response.
+            self._close_sock()
+            self._finish(0, "other")
+            return
+
+        if not (resp.reusable and self.config.get_keep_alive()):
+            self._close_sock()
+
+        if self.query:
+            query = self.query
+            self.query = None
+            try:
+                if self.blob:
+                    self._blob_part_done(resp)
+                else:
+                    self._blob_query_done(query.digest, resp)
+                # Acknowledged, so not to be taken back by "_fail".
+                self.req_sent = 0
+                self._send_next()
+            except:
+                self._abort()
+            return
+
+        self.requests.pop(0)
+        self.responses.append(resp)
+        self.equs.append(resp.classify())
+        self.req_sent = 0
+        if self.requests:
+            try:
+                self._send_next()
+            except:
+                self._abort()
+        else:
+            self._finish(0, None)
+
+    def _abort(self):
+        """
+        Gives up on the send after an exception in a socket callback,
+        which would otherwise leave the caller waiting forever.
+        """
+        ut.print_exception()
+        self._close_sock()
+        self._finish(KErrGeneral, None)
+
+    def _blob_query_done(self, digest, resp):
+        request = self.requests[0]
+        if resp.status == 200 and resp.header("x-blob-present") == digest:
+            ut.report("server has %s" % digest)
+            self.total += request.use_reference(digest)
+            return
+        fname, size = request.attachment_file(digest)
+        if (not self.config.get_resumable_on()) or \
+           size < resumable_min_size:
+            request.resolved(digest)
+            return
+        offset = resp.header("x-blob-offset")
+        if offset is None:
+            offset = self.resume.get(digest)
+        else:
+            offset = int(offset)
+        ut.report("uploading %s from %d" % (digest, offset))
+        offset = min(offset, size)
+        # The digest, file name, size, confirmed offset, bytes sent in
+        # parts, and the offset we started from.
+        self.blob = [digest, fname, size, offset, 0, offset]
+        # The bytes the server already has need not be sent.
+        self.total -= offset
+
+    def _blob_part_done(self, resp):
+        digest, fname, total, offset, blob_sent, start = self.blob
+        blob_sent += self.req_sent
+        new_offset = resp.header("x-blob-offset")
+        if (resp.status != 200 and resp.status != 409) or \
+           new_offset is None:
+            # The server does not do resumable uploads after all, so
+            # just send the attachment within the request.
+            ut.report("ranged upload refused (%d)" % resp.status)
+            self.blob = None
+            self.total += start + blob_sent
+            self.requests[0].resolved(digest)
+            return
+        new_offset = int(new_offset)
+        self.part_retries = 0
+        self.blob[3] = new_offset
+        self.blob[4] = blob_sent
+        if resp.header("x-blob-complete") or new_offset >= total:
+            self.blob = None
+            self.resume.forget(digest)
+            request = self.requests[0]
+            # The total so far has the rest of the attachment in the
+            # request. Now it has the reference instead, and what was
+            # actually sent in parts.
+            delta = request.use_reference(digest)
+            self.total += start + delta + blob_sent
+        else:
+            self.resume.set(digest, new_offset)
+
+    def _fail(self, err):
+        """
+        Handles a socket error. If it looks like a kept connection
+        had been closed by the server, we retry over a new one. If
+        we were uploading an attachment in parts, we retry a few
+        times regardless, as we will not have to start from scratch.
+        """
+        retry = (not self.fresh)
+        if self.blob and self.part_retries < max_part_retries:
+            self.part_retries += 1
+            retry = True
+        self._close_sock()
+        if retry:
+            ut.report("kept connection lost (%d), reconnecting" % err)
+            # Only what was sent of the unacknowledged request gets
+            # sent again.
+            self.sent -= self.req_sent
+            self.req_sent = 0
+            try:
+                self._send_next()
+                return
+            except:
+                ut.print_exception()
+        self._finish(err, None)
+
+    def _finish(self, serr, equ):
+        if equ is not None:
+            self.equs.append(equ)
+        self.watchdog.cancel()
+        self.requests = None
+        self.busy = False
+        if self.sock:
+            self.idle_timer.after(self.config.get_keep_alive_idle(),
+                                  self._close_sock)
+        self.cb(serr, self.equs)
+
+    def _close_sock(self):
+        self.idle_timer.cancel()
+        self.connecting = False
         if self.sock:
             self.sock.close()
             self.sock = None
+        self.chunks = None # closes any file being read
+
+    def cancel(self):
+        self.watchdog.cancel()
+        if self.reader:
+            self.reader.cancel()
+            self.reader = None
+        self._close_sock()
+        self.requests = None
+        self.busy = False
 
     def close(self):
         self.cancel()
@@ -522,7 +2711,19 @@ class Uploader:
             self.conn.close()
         if self.serv:
             self.serv.close()
-        self.data = None # to save memory
+
+# The top-level metadata sections, and the card fields they are made
+# from.
+metadata_sections = [("data filename", "filedata"),
+                     ("photo filename", "picfile"),
+                     ("sender", "sender"),
+                     ("receiver", "recipient"),
+                     ("status", "mood"),
+                     ("gps", "gps"),
+                     ("bt scan", "btprox"),
+                     ("gsm", "gsm"),
+                     ("gsm history", "gsm_history"),
+                     ("time", "time")]
 
 class Card:
     """
@@ -530,11 +2731,21 @@ class Card:
     automatically, and in some cases upon request. Any persistent data
     is replicated in the Config instance, and initial values come from
     there if available.
+
+    Each field has a version number that is bumped whenever the field
+    is changed, which must hence only happen through the "set_*"
+    methods. The encoded form of each metadata section is cached
+    along with the version of its field, so that only changed
+    sections need encoding when sending.
     """
     
     def __init__(self, config, cb):
         self.config = config
         self.cb = cb
+        self.versions = {}
+        self.section_cache = {}
+        self.metadata = {}
+        self.metadata_versions = {}
         self.clear()
 
     def clear(self):
@@ -544,6 +2755,9 @@ class Card:
         self.picfile = self.config.db.get("picfile", None)
         if self.picfile and (not os.path.isfile(ut.to_str(self.picfile))):
             self.picfile = None
+
+        # Any smaller variant of "picfile" to send in its stead.
+        self.upload_picfile = None
         self.clear_temporary()
 
     def clear_temporary(self):
@@ -552,14 +2766,16 @@ class Card:
         """
         self.filedataname = None
         self.filedata = None
+        self.filedatafile = None
         self.btprox = None
         self.gsm = None
+        self.gsm_history = None
         self.gps = None
         self.gps_gui = None
 
         if os.path.isfile(ut.to_str(test_filedata)):
             self.filedataname = ut.basename(test_filedata)
-            self.filedata = read_file(test_filedata)
+            self.filedatafile = test_filedata
         
         self.update_timestamp("all")
 
@@ -585,6 +2801,9 @@ class Card:
             if self.gps_gui != guival:
                 self.gps_gui = guival
                 self.update_timestamp("gps")
+            else:
+                # Still a change in the metadata to send.
+                self._bump("gps")
 
     def remove_gps(self):
         self.set_gps(None)
@@ -599,7 +2818,8 @@ class Card:
                   (u"Altitude", "text", unirepr(pos["altitude"])),
                   (u"Vertical accuracy", "text", unirepr(pos["vertical_accuracy"])),
                   (u"Horizontal accuracy", "text", unirepr(pos["horizontal_accuracy"])) ]
-        cou = self.gps["course"]
+        # There is no course in a position from "PositionAcquirer".
+        cou = self.gps.get("course")
         if cou is not None:
             flist.extend([
                 (u"Speed", "text", unirepr(cou["speed"])),
@@ -620,6 +2840,12 @@ class Card:
 
     def remove_gsm(self):
         self.set_gsm(None)
+        self.set_gsm_history(None)
+
+    def set_gsm_history(self, value):
+        if value != self.gsm_history:
+            self.gsm_history = value
+            self.update_timestamp("gsm_history")
 
     def view_gsm(self):
         if self.gsm is None:
@@ -638,13 +2864,13 @@ class Card:
         if self.btprox is None:
             appuifw.note(u"Proximity not scanned for Bluetooth devices", "error")
             return
-        if self.btprox == []:
+        if len(self.btprox) == 0:
             appuifw.note(u"No Bluetooth devices in proximity", "info")
             return
         # The Forms apparently do not like having more than 20 or so
         # items.
         flist = [ (unicode(d["mac"]), "text", unicode(d["name"])) for
-                  d in self.btprox ][:20]
+                  d in self.btprox.expand()[:20] ]
         form = appuifw.Form(flist, appuifw.FFormDoubleSpaced|
                             appuifw.FFormViewModeOnly)
         form.execute()
@@ -667,17 +2893,33 @@ class Card:
     def set_filedata(self, desc, data):
         self.filedataname = desc
         self.filedata = data
+        self.filedatafile = None
+        self.update_timestamp("filedata")
+
+    def set_filedata_file(self, desc, fname):
+        """
+        Like "set_filedata", but the data is in the named file, and
+        only gets read when the card is sent.
+        """
+        self.filedataname = desc
+        self.filedata = None
+        self.filedatafile = fname
         self.update_timestamp("filedata")
 
+    def has_filedata(self):
+        return (self.filedata is not None) or (self.filedatafile is not None)
+
     def remove_filedata(self):
-        if self.filedata:
+        if self.has_filedata():
             self.filedata = None
+            self.filedatafile = None
             self.update_timestamp("filedata")
 
     def set_picfile(self, new_picfile):
         old_picfile = self.picfile
         if new_picfile != old_picfile:
             self.picfile = new_picfile
+            self.upload_picfile = None
             self.config.db["picfile"] = new_picfile
             self.config.save()
             self.update_timestamp("picfile")
@@ -702,6 +2944,17 @@ class Card:
             self.update_timestamp("recipient")
 
     def update_timestamp(self, field):
+        """
+        Records a change in the named field ("all" for all of them),
+        which includes the time of the change.
+        """
+        if field == "all":
+            for key, name in metadata_sections:
+                self._bump(name)
+        else:
+            self._bump(field)
+        self._bump("time")
+
         tm = time.time()
         tmrec = {"time" : tm,
                  "timezone" : time.timezone,
@@ -713,9 +2966,14 @@ class Card:
         if self.cb:
             self.cb(field)
 
+    def _bump(self, field):
+        self.versions[field] = self.versions.get(field, 0) + 1
+
     def refresh_metadata(self):
+        # The versions of the fields at the time, for the encoding.
+        self.metadata_versions = self.versions.copy()
         metadata = self.metadata = {}
-        if self.filedata:
+        if self.has_filedata():
             metadata["data filename"] = self.filedataname
         if self.picfile:
             metadata["photo filename"] = ut.basename(self.picfile)
@@ -727,14 +2985,44 @@ class Card:
             metadata["gps"] = self.gps
         
         if self.btprox:
-            metadata["bt scan"] = self.btprox
+            metadata["bt scan"] = self.btprox.expand()
 
         if self.gsm is not None:
             (country_code, network_code, area_code, cell_id) = self.gsm
             metadata["gsm"] = {"country code" : country_code, "network code" : network_code, "area code" : area_code, "cell id" : cell_id}
+
+        if self.gsm_history:
+            metadata["gsm history"] = self.gsm_history
         
         metadata["time"] = self.time
 
+    def encode_metadata(self, codec):
+        """
+        Returns "metadata" encoded with the given codec, re-encoding
+        only those sections whose fields have changed since they were
+        last encoded with that codec.
+        """
+        if not hasattr(codec, "encode_item"):
+            return codec.encode(filter_nan(self.metadata))
+        items = []
+        for key, field in metadata_sections:
+            if not self.metadata.has_key(key):
+                continue
+            version = self.metadata_versions.get(field, 0)
+            cached = self.section_cache.get(key)
+            if cached and cached[0] == codec.name and cached[1] == version:
+                item = cached[2]
+            else:
+                value = strip_nan(self.metadata[key])
+                if value is NAN_VALUE:
+                    item = None
+                else:
+                    item = codec.encode_item(key, value)
+                self.section_cache[key] = (codec.name, version, item)
+            if item is not None:
+                items.append(item)
+        return codec.join_items(items)
+
     def has_any_sender(self):
         return self.sender != {}
 
@@ -766,20 +3054,25 @@ class Card:
 
 max_read = 1024
 
-# xxx We could do with less memory by reading data in chunks and
-# uploading the chunks as we go.
-def inbox_read_data(inbox, msg_id):
+def inbox_save_data(inbox, msg_id, fname):
+    """
+    Copies the data of the specified message into the named file, in
+    chunks, so that the data need not be in memory as a whole.
+    """
     datalen = inbox.size(msg_id)
     read = 0
-    data = []
-    while read < datalen:
-        thismax = datalen - read
-        if thismax > max_read:
-            thismax = max_read
-        s = inbox.data(msg_id, read, thismax)
-        read += len(s)
-        data.append(s)
-    return "".join(data)
+    mkdir_p(os.path.dirname(fname))
+    fp = open(fname, "wb")
+    try:
+        while read < datalen:
+            thismax = datalen - read
+            if thismax > max_read:
+                thismax = max_read
+            s = inbox.data(msg_id, read, thismax)
+            read += len(s)
+            fp.write(s)
+    finally:
+        fp.close()
 
 KUidMsgTypeBt = 0x10009ED5
 
@@ -789,8 +3082,8 @@ class FiledataReader:
     """
     def __init__(self, cb):
         """
-        cb:: Called with description and data when new filedata is
-             available.
+        cb:: Called with description and the name of the file
+             holding the data when new filedata is available.
         """
         self.inbox = None
         self.timer = e32.Ao_timer()
@@ -838,11 +3131,11 @@ class FiledataReader:
             ut.report("message size is %d" % self.inbox.size(id))
             desc = self.inbox.description(id)
             if self.is_filedata_message(id, desc):
-                data = inbox_read_data(self.inbox, id)
+                inbox_save_data(self.inbox, id, filedata_file)
                 ut.report("message fetched")
                 self.inbox.delete(id)
                 ut.report("message deleted")
-                self.cb(desc, data)
+                self.cb(desc, ut.to_unicode(filedata_file))
             else:
                 ut.report("ignoring non-Filedata message")
         except:
@@ -859,32 +3152,491 @@ class FiledataReader:
         self.timer.cancel()
 
 if os.path.exists("e:\\data"):
-    uploads_dir = "e:\\data\\tpytwink\\uploads\\"
+    data_dir = "e:\\data\\tpytwink\\"
 else:
-    uploads_dir = "c:\\data\\tpytwink\\uploads\\"
+    data_dir = "c:\\data\\tpytwink\\"
+uploads_dir = data_dir + "uploads\\"
+
+# Any received filedata is kept here until the card has been sent
+# (or stored), and is overwritten by the next filedata.
+filedata_file = data_dir + "filedata.dat"
 
-def save_unsent_card(data):
+def save_unsent_card(request):
+    """
+    The card is first written into a temporary file, and only renamed
+    into a ".txt" file once complete, so that the "Outbox" never
+    picks up a partially written card.
+    """
     tm = time.time()
     tm_s = time.strftime("%Y-%m-%d-%H-%M-%S", time.gmtime(tm))
+    mkdir_p(os.path.dirname(uploads_dir))
     filename = uploads_dir + tm_s + ".txt"
-    make_file(filename, data)
+    seq = 1
+    while os.path.exists(filename):
+        seq += 1
+        filename = uploads_dir + ("%s_%d.txt" % (tm_s, seq))
+    tmpname = filename[:-4] + ".tmp"
+    fp = open(tmpname, "wb")
+    try:
+        for chunk in request.chunks(file_block_size):
+            fp.write(chunk)
+    finally:
+        fp.close()
+    os.rename(tmpname, filename)
+
+# How often (in seconds) to look for stored cards when there are no
+# retries pending sooner.
+outbox_poll_interval = 60
+
+# The range (in seconds) for the delay between failed attempts at
+# sending a stored card. The delay doubles after each failure, and
+# is randomized by up to +-50% so that a number of cards do not
+# all get retried at the same time.
+outbox_min_delay = 15
+outbox_max_delay = 1800
+
+class Outbox:
+    """
+    Sends any cards stored by "save_unsent_card" in "uploads_dir" on
+    the background, whenever there is an access point to send them
+    over. At most a configured number of requests are in flight at a
+    time. Failed sends are retried with exponential backoff.
+
+    A journal is kept of cards that are being sent and have been
+    sent, so that should we crash after a card has been accepted but
+    before its file has been removed, the card does not get sent
+    again. Cards are only removed once accepted, and thus never lost.
+    A card that is resent after a crash during its sending has the
+    same "X-Card-Id", so the server can recognize it as a duplicate.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.timer = e32.Ao_timer()
+        self.uploaders = []
+        self.in_flight = {} # name -> Uploader
+        self.retries = {} # name -> (attempts, next attempt time)
+        self.journal_file = uploads_dir + "journal.dat"
+        self.active = False
+        # Set while in "_drain", which schedules the next drain
+        # itself, so that any send that fails right away does not
+        # schedule one as well.
+        self.draining = False
+        self.redrain = False
+
+    def start(self):
+        if self.active:
+            return
+        self.active = True
+        try:
+            self._recover()
+        except:
+            ut.print_exception()
+        self.poke()
+
+    def stop(self):
+        self.active = False
+        self.timer.cancel()
+        for uploader in self.uploaders:
+            uploader.cancel()
+        self.in_flight = {}
+
+    def close(self):
+        self.stop()
+        for uploader in self.uploaders:
+            uploader.close()
+        self.uploaders = []
+
+    def poke(self):
+        """
+        Makes the outbox look for cards to send right away. To be
+        called e.g. when a new card has been stored.
+        """
+        if self.active:
+            self.timer.cancel()
+            self.timer.after(0, self._drain)
+
+    def _list(self):
+        try:
+            names = [ fn for fn in os.listdir(uploads_dir)
+                      if fn[-4:] == ".txt" ]
+        except:
+            # No such directory, presumably.
+            names = []
+        names.sort()
+        return names
+
+    def _journal(self, state, name):
+        mkdir_p(os.path.dirname(uploads_dir))
+        fp = open(self.journal_file, "a")
+        try:
+            fp.write("%s %s\n" % (state, name))
+        finally:
+            fp.close()
+
+    def _recover(self):
+        """
+        Completes the handling of any cards whose outcome was
+        journaled, but whose files were not yet dealt with.
+        """
+        try:
+            fp = open(self.journal_file, "r")
+            try:
+                lines = fp.readlines()
+            finally:
+                fp.close()
+        except IOError:
+            return
+        states = {}
+        for line in lines:
+            words = line.split()
+            if len(words) == 2:
+                states[words[1]] = words[0]
+        for name, state in states.items():
+            if state == "sent" or state == "refused":
+                self._dispose(name, state)
+        os.remove(self.journal_file)
+
+    def _dispose(self, name, state):
+        """
+        Gets rid of the file of a card that has been sent, or that
+        the server refused, in which case we keep it for reference
+        under another name.
+        """
+        fn = uploads_dir + name
+        if os.path.exists(fn):
+            if state == "sent":
+                os.remove(fn)
+            else:
+                os.rename(fn, fn[:-4] + ".rej")
+
+    def _get_uploader(self):
+        for uploader in self.uploaders:
+            if not uploader.busy:
+                return uploader
+        uploader = Uploader(self.config)
+        self.uploaders.append(uploader)
+        return uploader
+
+    def _num_busy(self):
+        n = 0
+        for uploader in self.uploaders:
+            if uploader.busy:
+                n += 1
+        return n
+
+    def _drain(self):
+        self.timer.cancel()
+        if not self.active:
+            return
+        self.draining = True
+        self.redrain = False
+        try:
+            delay = self._drain_ready()
+        finally:
+            self.draining = False
+        if self.redrain:
+            delay = 0
+        self.timer.after(delay, self._drain)
+
+    def _drain_ready(self):
+        """
+        Sends what there is to send, and returns the number of
+        seconds after which to look again.
+        """
+        names = self._list()
+        now = time.time()
+        delay = outbox_poll_interval
+        if self.config.get_outbox_on() and self.config.get_apid():
+            ready = []
+            for name in names:
+                if self.in_flight.has_key(name):
+                    continue
+                attempts, when = self.retries.get(name, (0, 0))
+                if when <= now:
+                    ready.append(name)
+                elif when - now < delay:
+                    delay = when - now
+            max_busy = self.config.get_outbox_max_in_flight()
+            batch_size = self.config.get_outbox_batch_size()
+            while ready and self._num_busy() < max_busy:
+                self._send(ready[:batch_size])
+                ready = ready[batch_size:]
+        if (not names) and (not self.in_flight):
+            self._compact()
+        return delay
+
+    def _compact(self):
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+    def _send(self, names):
+        requests = []
+        sendable = []
+        for name in names:
+            try:
+                requests.append(load_stored_request(uploads_dir + name))
+                sendable.append(name)
+            except:
+                ut.print_exception()
+                self._journal("refused", name)
+                self._dispose(name, "refused")
+        if not sendable:
+            return
+
+        uploader = self._get_uploader()
+        for name in sendable:
+            self._journal("sending", name)
+            self.in_flight[name] = uploader
+        def cb(serr, equs):
+            self._sent(sendable, serr, equs)
+        try:
+            uploader.send_batch(requests, cb, None,
+                                self.config.get_batch_envelope())
+        except:
+            ut.print_exception()
+            self._sent(sendable, -1, [])
+
+    def _sent(self, names, serr, equs):
+        if serr:
+            ut.report("outbox send error (Symbian %d)" % serr)
+        i = 0
+        for name in names:
+            if self.in_flight.has_key(name):
+                del self.in_flight[name]
+            if equs and i < len(equs):
+                equ = equs[i]
+            else:
+                equ = None
+            i += 1
+            if equ == "accepted" or equ == "refused":
+                if equ == "accepted":
+                    state = "sent"
+                else:
+                    state = "refused"
+                self._journal(state, name)
+                self._dispose(name, state)
+                if self.retries.has_key(name):
+                    del self.retries[name]
+            else:
+                self._backoff(name)
+        if self.draining:
+            self.redrain = True
+        elif self.active:
+            self.poke()
+
+    def _backoff(self, name):
+        attempts, when = self.retries.get(name, (0, 0))
+        delay = min(outbox_min_delay * (2 ** attempts), outbox_max_delay)
+        delay = delay * (0.5 + random.random())
+        self.retries[name] = (attempts + 1, time.time() + delay)
+        ut.report("will retry %s in %d secs" % (name, delay))
+
+def upload_picfile_name(pn, profile):
+    """
+    Returns the name of the file for the upload variant of the named
+    picture, for the given upload profile. Like the gallery
+    thumbnails, the variants are kept in a subdirectory named after
+    their parameters, and given a ".txt" extension to keep them out
+    of Gallery.
+    """
+    maxdim, quality = profile
+    path = ut.dirname(pn)
+    fn = ut.basename(pn)
+    return path + (u"\\_galupload_%d_%d\\" % (maxdim, quality)) + \
+           fn + u"upload.txt"
+
+class UploadPicMaker:
+    """
+    Produces a downscaled variant of a picture for uploading, using
+    the same asynchronous load, resize, and save chain that the
+    gallery uses for thumbnails. Any already made variant is reused
+    if it is newer than the picture.
+    """
+    def __init__(self):
+        self.image = None
+        self.immediate = None
+        self.cb = None
+
+    def make(self, pn, profile, cb):
+        """
+        profile:: A (maximum dimension, JPEG quality) pair.
+        cb:: Called with the name of the file to upload, which is the
+             original picture if no smaller variant can be had.
+        """
+        self.cancel()
+        self.pn = pn
+        self.cb = cb
+        self.maxdim, self.quality = profile
+        self.up_pn = upload_picfile_name(pn, profile)
+        try:
+            up_s = ut.to_str(self.up_pn)
+            if os.path.isfile(up_s) and \
+               os.path.getmtime(up_s) >= os.path.getmtime(ut.to_str(pn)):
+                self._via_immediate(lambda: self._done(self.up_pn))
+                return
+            info = graphics.Image.inspect(pn)
+            size = info["size"]
+            if max(size[0], size[1]) <= self.maxdim:
+                self._via_immediate(lambda: self._done(self.pn))
+                return
+            self.image = graphics.Image.new(size)
+            self.image.load(pn, callback = self._loaded)
+        except:
+            ut.print_exception()
+            self.image = None
+            self._via_immediate(lambda: self._done(self.pn))
+
+    def _try(self, action):
+        try:
+            action()
+        except:
+            ut.print_exception()
+            self.image = None
+            self._done(self.pn)
+
+    def _check_code(self, code):
+        if code != 0:
+            raise ("failed to process image (%d)" % code)
+
+    def _imm_completed(self, code, user_cb):
+        self._try(user_cb)
+
+    def _via_immediate(self, user_cb):
+        if self.immediate:
+            self.immediate.cancel()
+        else:
+            self.immediate = AoImmediate()
+            self.immediate.open()
+        self.immediate.complete(self._imm_completed, user_cb)
+
+    def _loaded(self, code):
+        def req_resize():
+            self.image.resize((self.maxdim, self.maxdim), keepaspect = 1,
+                              callback = self._resized)
+        def action():
+            self._check_code(code)
+            self._via_immediate(req_resize)
+        self._try(action)
+
+    def _resized(self, image):
+        self.image = image
+        def req_save():
+            mkdir_p(os.path.dirname(ut.to_str(self.up_pn)))
+            self.image.save(self.up_pn, callback = self._saved,
+                            format = "JPEG", quality = self.quality)
+        self._try(lambda: self._via_immediate(req_save))
+
+    def _saved(self, code):
+        def action():
+            self._check_code(code)
+            self.image = None
+            self._via_immediate(lambda: self._done(self.up_pn))
+        self._try(action)
+
+    def _done(self, pn):
+        cb = self.cb
+        self.cb = None
+        if cb:
+            cb(pn)
+
+    def cancel(self):
+        self.cb = None
+        if self.image:
+            self.image.stop()
+            self.image = None
+        if self.immediate:
+            self.immediate.cancel()
+
+    def close(self):
+        self.cancel()
+        if self.immediate:
+            self.immediate.close()
+            self.immediate = None
+
+# The sources of context that a card may get from a "ContextCache".
+context_sources = ["gsm", "btprox", "gps"]
+
+class ContextCache:
+    """
+    Holds the latest scanned value of each context source, along with
+    the time it was scanned, so that a card sent soon after a scan
+    can reuse the value rather than having to wait for a rescan. How
+    long a value may be reused is configured per source, as e.g. the
+    cell changes less often than the devices around us.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.entries = {} # source -> (value, scan time)
+
+    def put(self, source, value):
+        """
+        Records a scanned value. A value of None, meaning that the
+        scan failed, drops any earlier value, so that we never end up
+        sending an old value for want of a new one.
+        """
+        if value is None:
+            self.forget(source)
+        else:
+            self.entries[source] = (value, time.time())
+
+    def get(self, source):
+        """
+        Returns the cached value of the source, or None if there is
+        none that is fresh enough.
+        """
+        entry = self.entries.get(source)
+        if entry is None or self.expiry(source) <= time.time():
+            return None
+        return entry[0]
+
+    def expiry(self, source):
+        """
+        Returns the time at which the cached value of the source stops
+        being fresh, or 0 if there is none.
+        """
+        entry = self.entries.get(source)
+        if entry is None:
+            return 0
+        return entry[1] + self.config.get_context_max_age(source)
+
+    def forget(self, source = None):
+        """
+        Drops the cached value of the source, or of all sources.
+        """
+        if source is None:
+            self.entries = {}
+        elif self.entries.has_key(source):
+            del self.entries[source]
 
 class ScannerSender:
     """
     The task of an object of this type is to add context data and send
     it, reporting on success or failure with a callback.
     """
-    def __init__(self, config):
+    def __init__(self, config, outbox):
         """
-        apid: Initial access point ID to use.
+        outbox:: Any stored cards are handed to this "Outbox".
         """
         self.config = config
+        self.outbox = outbox
         self.gsm_scanner = GsmScanner()
+        self.cell_tracker = CellTracker(config)
         self.btprox_scanner = None
-        self.positioner = None
+        self.bt_names = BtNameCache(config)
+        self.btprox_monitor = BtproxMonitor(config, self.bt_names)
+        self.position_acquirer = PositionAcquirer(config)
+        self.gps_fix = None # the latest fix of any running GPS scanning
         self.uploader = Uploader(config)
+        self.digests = DigestCache(config)
+        self.pic_maker = UploadPicMaker()
         self.immediate = AoImmediate()
         self.immediate.open()
+        self.scan_timer = e32.Ao_timer()
+        self.scans_pending = {}
+        self.context = ContextCache(config)
+        self.scanning = {}
+        self.refresh_timer = e32.Ao_timer()
+        self.refreshing = False
         self.btprox_scan_error_shown = False
         self.active = False
 
@@ -893,11 +3645,17 @@ class ScannerSender:
         Cancels any operation(s) in progress, whether finished or not.
         """
         self.immediate.cancel()
+        self.scan_timer.cancel()
+        self.scans_pending = {}
+        self.scanning = {}
+        self.refresh_timer.cancel()
+        self.btprox_monitor.stop_waiting(self._btprox_scanned)
+        self.btprox_monitor.stop_waiting(self._btprox_done)
         self.gsm_scanner.cancel()
         if self.btprox_scanner:
-            self.btprox_scanner.cancel()
-        if self.positioner:
-            self.positioner.cancel()
+            self.btprox_scanner.cancel()
+        self.position_acquirer.cancel()
+        self.pic_maker.cancel()
         self.uploader.cancel()
         self.active = False
 
@@ -905,12 +3663,16 @@ class ScannerSender:
         """
         Does cleanup.
         """
+        self.refreshing = False
+        self.refresh_timer.cancel()
+        self.cell_tracker.stop()
         self.immediate.close()
         self.gsm_scanner.close()
         if self.btprox_scanner:
             self.btprox_scanner.close()
-        if self.positioner:
-            self.positioner.close()
+        self.btprox_monitor.close()
+        self.position_acquirer.close()
+        self.pic_maker.close()
         self.uploader.close()
 
     def scan_and_send(self, card, cb):
@@ -926,23 +3688,241 @@ class ScannerSender:
         self.card = card
         self.cb = cb
 
+        self._prepare_picture()
+        self._prewarm()
         self._clear_context()
         if self.config.get_noscan():
             self._send_card()
+        elif self.config.get_concurrent_scan():
+            self._scan_concurrently()
         else:
+            self._stop_scans()
             self._scan_gsm()
 
     def _clear_context(self):
         """
         Note that it is important to set values to None when scanning
         fails so that we never end up sending a card with an old
-        value.
+        value. Values that are still fresh in the context cache are
+        taken from there, and need not be scanned. Any background
+        cell tracking gives the current cell and the recent cell
+        changes, and background btprox scanning the devices seen
+        recently. Any running GPS scanning gives its latest fix, and
+        otherwise a position is only taken from the cache, as the card
+        outlives a send.
+        """
+        gsm = None
+        history = None
+        if self.cell_tracker.running:
+            gsm = self.cell_tracker.cell
+            window = self.config.get_gsm_history_window()
+            if window > 0:
+                history = self.cell_tracker.history(window)
+        if gsm is None:
+            gsm = self.context.get("gsm")
+        self.card.set_gsm(gsm)
+        self.card.set_gsm_history(history)
+        btprox = None
+        if self.config.get_btprox_scan():
+            if self.btprox_monitor.running:
+                btprox = self.btprox_monitor.recent()
+            if btprox is None:
+                btprox = self.context.get("btprox")
+        self.card.set_btprox(btprox)
+        gps = self.gps_fix
+        if gps is None:
+            gps = self.context.get("gps")
+        self.card.set_gps(gps)
+
+    def _scan_concurrently(self):
+        """
+        Starts all enabled scans at once, and sends the card once they
+        have all completed, or when the scan deadline is reached,
+        with whatever context we have by then. The sending then waits
+        only as long as the slowest scan, rather than for all of them
+        in turn.
+        """
+        ut.report("_scan_concurrently")
+        self.scans_pending = {}
+        if self.card.gsm is None:
+            self.scans_pending["gsm"] = True
+        if self.config.get_btprox_scan() and self.card.btprox is None:
+            if not self.btprox_scanner and not self.btprox_monitor.running:
+                self.init_btprox_scanner()
+            if self.btprox_scanner or self.btprox_monitor.running:
+                self.scans_pending["btprox"] = True
+            elif not self.btprox_scan_error_shown:
+                self.btprox_scan_error_shown = True
+                appuifw.note(u"Could not scan proximity: Is Bluetooth enabled?", "error")
+        if self.card.gps is None and self._may_acquire_position():
+            self.scans_pending["gps"] = True
+        if not self.scans_pending:
+            ut.report("using cached context")
+            self._send_card()
+            return
+        self.cb("progress", u"Scanning context")
+        self.active = True
+        self.scan_timer.after(self.config.get_scan_deadline(),
+                              self._scan_deadline)
+        # Any scan already started by "refresh_context" is not
+        # restarted, but waited for.
+        for name in self.scans_pending.keys():
+            self._start_scan(name)
+
+    def _start_scan(self, name):
+        """
+        Starts scanning the named source, unless a scan of it is
+        already in progress. The result goes to the context cache,
+        and to the card if the card is waiting for it.
+        """
+        if self.scanning.has_key(name):
+            return
+        self.scanning[name] = True
+        if name == "gsm":
+            self.gsm_scanner.scan(self._gsm_scanned)
+        elif name == "gps":
+            try:
+                self.position_acquirer.acquire(self._position_scanned)
+            except:
+                ut.print_exception()
+                self._position_scanned(None)
+        elif name == "btprox" and self.btprox_monitor.running:
+            self.btprox_monitor.wait(self._btprox_scanned)
+        elif name == "btprox":
+            try:
+                self.btprox_scanner.scan(self._btprox_scanned)
+            except:
+                ut.print_exception()
+                self._btprox_scanned(None)
+
+    def _stop_scans(self):
+        """
+        Cancels any scans started by "refresh_context", for when the
+        scanners are needed for something else.
+        """
+        if self.scanning.has_key("gsm"):
+            self.gsm_scanner.cancel()
+        if self.scanning.has_key("btprox"):
+            self.btprox_monitor.stop_waiting(self._btprox_scanned)
+            if self.btprox_scanner:
+                self.btprox_scanner.cancel()
+        if self.scanning.has_key("gps"):
+            self.position_acquirer.cancel()
+        self.scanning = {}
+
+    def refresh_context(self):
+        """
+        Starts keeping the context cache fresh on the background, by
+        rescanning each source once half of its maximum age has
+        passed, so that a card sent in the meantime need not wait for
+        any scanning. This goes on until "stop_refreshing".
+        """
+        self.refreshing = True
+        self._refresh()
+
+    def stop_refreshing(self):
+        """
+        Any scans in progress are left to complete, as their results
+        may still be of use.
+        """
+        self.refreshing = False
+        self.refresh_timer.cancel()
+
+    def _refresh(self):
+        self.refresh_timer.cancel()
+        if not self.refreshing or self.config.get_noscan():
+            return
+        names = []
+        if not self.cell_tracker.running:
+            names.append("gsm")
+        if self.config.get_btprox_scan() and not self.btprox_monitor.running:
+            names.append("btprox")
+        now = time.time()
+        delay = None
+        for name in names:
+            half_age = self.config.get_context_max_age(name) / 2.0
+            if half_age <= 0:
+                continue
+            expiry = self.context.expiry(name)
+            if expiry - half_age <= now and not self.active:
+                if name == "btprox" and not self.btprox_scanner:
+                    self.init_btprox_scanner()
+                if name == "gsm" or self.btprox_scanner:
+                    ut.report("refreshing %s context" % name)
+                    self._start_scan(name)
+                expiry = now + half_age * 2
+            if delay is None or expiry - half_age - now < delay:
+                delay = expiry - half_age - now
+        if delay is not None:
+            self.refresh_timer.after(max(delay, 1), self._refresh)
+
+    def _gsm_scanned(self, gsm):
+        if self.scanning.has_key("gsm"):
+            del self.scanning["gsm"]
+        self.context.put("gsm", gsm)
+        if self.scans_pending.has_key("gsm"):
+            self.card.set_gsm(gsm)
+            self._scan_done("gsm")
+
+    def _btprox_scanned(self, btdata):
+        if self.scanning.has_key("btprox"):
+            del self.scanning["btprox"]
+        if btdata is None:
+            self.btprox_scanner = None
+        self.context.put("btprox", btdata)
+        if self.scans_pending.has_key("btprox"):
+            self.card.set_btprox(btdata)
+            self._scan_done("btprox")
+
+    def _position_scanned(self, position):
+        if self.scanning.has_key("gps"):
+            del self.scanning["gps"]
+        if position is not None:
+            self.context.put("gps", {"position": position})
+        if self.scans_pending.has_key("gps"):
+            if position is not None:
+                self.card.set_gps({"position": position})
+            self._scan_done("gps")
+
+    def _scan_done(self, name):
+        ut.report("%s scan done" % name)
+        if not self.scans_pending.has_key(name):
+            return
+        del self.scans_pending[name]
+        if not self.scans_pending:
+            self.scan_timer.cancel()
+            self.active = False
+            self._send_card()
+
+    def _scan_deadline(self):
+        """
+        Ends any scans still in progress. Bluetooth scanning passes on
+        the devices found so far, and positioning the best fix so far,
+        and the rest leave their context unset.
         """
-        self.card.set_gsm(None)
-        self.card.set_btprox(None)
+        ut.report("scan deadline, pending %s" % repr(self.scans_pending.keys()))
+        if self.scans_pending.has_key("gsm"):
+            self.gsm_scanner.cancel()
+            if self.scanning.has_key("gsm"):
+                del self.scanning["gsm"]
+            self._scan_done("gsm")
+        if self.scans_pending.has_key("btprox"):
+            if self.btprox_monitor.running:
+                self.btprox_monitor.stop_waiting(self._btprox_scanned)
+                self._btprox_scanned(self.btprox_monitor.recent())
+            else:
+                # This calls "_btprox_scanned".
+                self.btprox_scanner.stop()
+        if self.scans_pending.has_key("gps"):
+            # This calls "_position_scanned".
+            self.position_acquirer.stop()
 
     def _scan_gsm(self):
         ut.report("_scan_gsm")
+        if self.card.gsm is not None:
+            # Fresh from the context cache.
+            self._scan_btprox()
+            return
         def f():
             self.gsm_scanner.scan(self._gsm_done)
             self.active = True
@@ -957,12 +3937,13 @@ class ScannerSender:
         """
         ut.report("_gsm_done")
         self.active = False
+        self.context.put("gsm", gsm)
         self.card.set_gsm(gsm)
         self._scan_btprox()
 
     def init_btprox_scanner(self):
         try:
-            self.btprox_scanner = BtproxScanner()
+            self.btprox_scanner = BtproxScanner(self.config, self.bt_names)
         except:
             self.btprox_scanner = None
 
@@ -972,6 +3953,14 @@ class ScannerSender:
             if not self.config.get_btprox_scan():
                 self._btprox_done(None)
                 return
+            if self.card.btprox is not None:
+                # Fresh from the context cache.
+                self._scan_position_or_send()
+                return
+            if self.btprox_monitor.running:
+                self.btprox_monitor.wait(self._btprox_done)
+                self.active = True
+                return
             if not self.btprox_scanner:
                 self.init_btprox_scanner()
             if not self.btprox_scanner:
@@ -994,72 +3983,101 @@ class ScannerSender:
         self.active = False
         if btdata is None:
             self.btprox_scanner = None
+        self.context.put("btprox", btdata)
         self.card.set_btprox(btdata)
-        if self.card.gps is None:
-            # Our positioning hack no longer appears to work, so disabling for now.
-            #self._scan_position()
-            self._send_card()
+        self._scan_position_or_send()
+
+    def _scan_position_or_send(self):
+        if self.card.gps is None and self._may_acquire_position():
+            self._scan_position()
         else:
             self._send_card()
 
+    def _may_acquire_position(self):
+        return gps_avail and Positioner is not None and \
+               self.config.get_position_acquire()
+
     def _scan_position(self):
         ut.report("_scan_position")
 
         def f():
-            if self.positioner:
-                self.positioner.close()
-                self.positioner = None
             try:
-                from pytwink import Positioner
-
-                modlist = positioning.modules()
-                module_id = None
-                for entry in modlist:
-                    if entry["name"] == u"Network based" and \
-                       entry["available"]:
-                        module_id = entry["id"]
-                        break
-                if not module_id:
-                    raise "no network positioning module"
-
-                updatetimeout = 15000000
-                maxupdateage =  30000000
-                self.positioner = Positioner(module_id, updatetimeout, maxupdateage)
-                self.positioner.ask_position(self._positioner_done)
-                return
+                self.position_acquirer.acquire(self._positioner_done)
+                self.active = True
             except:
+                ut.print_exception()
                 self._send_card()
 
-            self.active = True
-
         self.cb("progress", u"Querying position")
         self._via_immediate(f)
 
-    def _positioner_done(self, code):
-        ut.report("_positioner_done (%d)" % code)
+    def _positioner_done(self, position):
+        ut.report("_positioner_done")
         self.active = False
-        if not code:
-            self.card.gps = {"position": self.positioner.get_position()}
+        if position is not None:
+            self.card.set_gps({"position": position})
+            self.context.put("gps", self.card.gps)
         self._send_card()
 
+    def _prepare_picture(self):
+        """
+        Starts making any upload variant of the picture, which then
+        happens in parallel with context scanning.
+        """
+        self.card.upload_picfile = None
+        self.send_pending = False
+        profile = self.config.get_upload_profile()
+        if self.card.picfile is None or profile is None:
+            self.pic_ready = True
+            return
+        self.pic_ready = False
+        self.pic_maker.make(self.card.picfile, profile, self._picture_ready)
+
+    def _prewarm(self):
+        """
+        Starts bringing up the network connection, which then happens
+        in parallel with context scanning.
+        """
+        if self.config.get_store_on() or \
+           (not self.config.get_prewarm_on()):
+            return
+        self.uploader.prewarm(self.config.get_prewarm_connect())
+
+    def _picture_ready(self, pn):
+        ut.report("uploading picture %s" % repr(pn))
+        self.pic_ready = True
+        self.card.upload_picfile = pn
+        if self.send_pending:
+            self.active = False
+            self._send_card()
+
     def _send_card(self):
+        if not self.pic_ready:
+            self.cb("progress", u"Preparing picture")
+            self.send_pending = True
+            self.active = True
+            return
         if self.config.get_store_on():
             self.cb("progress", u"Storing card")
             def f():
                 try:
                     self.card.prepare_for_sending()
-                    data = serialize_card(self.card)
-                    save_unsent_card(data)
+                    request = self._serialize_card(False)
+                    save_unsent_card(request)
+                    self.outbox.poke()
                     self.cb("ok", u"Card stored")
                 except:
                     ut.print_exception()
                     self.cb("fail", u"Storing failed")
+                self._resolve_names()
         else:
             self.cb("progress", u"Sending card")
             def f():
                 try:
                     self.card.prepare_for_sending()
-                    self.uploader.send(serialize_card(self.card), self._send_done)
+                    self.uploader.send(self._serialize_card(True),
+                                       self._send_done,
+                                       self._send_progress)
                     self.active = True
                 except:
                     self.config.set_apid(None)
@@ -1068,9 +4086,38 @@ class ScannerSender:
                     self.cb("fail", u"Sending failed")
         self._via_immediate(f)
 
+    def _serialize_card(self, for_upload):
+        """
+        for_upload:: Whether the card is being sent right away, in
+                     which case any attachments may be deduplicated.
+        """
+        digests = None
+        if for_upload and self.config.get_dedup_on():
+            digests = self.digests
+        codec = meta.get_codec(self.config.get_metadata_codec())
+        request = serialize_card(self.card, self.config.get_compress_on(),
+                                 digests, codec)
+        ratio = request.compression_ratio()
+        if ratio is not None:
+            ut.report("compressed to %d%%" % int(ratio * 100))
+            self.config.add_compression_stats(request.raw_len,
+                                              request.deflated_len)
+        return request
+
+    def _send_progress(self, sent, total, bps):
+        if total > 0:
+            percent = (sent * 100) / total
+        else:
+            percent = 100
+        self.cb("progress", u"Sending card %d%% (%.1f kB/s)" %
+                (percent, bps / 1024.0))
+
     def _send_done(self, serr, equ):
         self.active = False
-        if serr:
+        if serr == KErrTimedOut:
+            ut.report("send timed out (%s)" % self.uploader.timeout_phase)
+            self.cb("fail", u"Sending timed out")
+        elif serr:
             ut.report("send error (Symbian %d)" % serr)
             self.cb("fail", u"Sending failed")
         elif equ == "refused":
@@ -1079,6 +4126,15 @@ class ScannerSender:
             self.cb("ok", u"Card sent")
         else:
             self.cb("fail", u"Unexpected response from server")
+        self._resolve_names()
+
+    def _resolve_names(self):
+        """
+        Looks up the names of any devices that the scan did not get
+        the names of, now that doing so no longer delays sending.
+        """
+        if self.btprox_scanner and not self.active:
+            self.btprox_scanner.resolve_names()
 
     def _via_immediate(self, cb):
         def this_cb(code, dummy):
@@ -1090,6 +4146,13 @@ class ScannerSender:
 tpytwink_logdir = u'c:\\logs\\tpytwink\\'
 configdb_file = u'c:\\data\\tpytwink\\settings.txt'
 
+# The number of seconds within which a change made with
+# "Config.save_later" gets saved.
+config_save_delay = 30
+
+# The number of cards for which to keep compression figures.
+compression_log_size = 20
+
 class Config:
     """
     It is useful for us to have the configuration in a dedicated
@@ -1101,6 +4164,8 @@ class Config:
         # settings are copied to the model(s) as required, but any
         # changes happen first in this model.
         self.db = {}
+        self.save_timer = e32.Ao_timer()
+        self.dirty = False
 
         self.load()
 
@@ -1128,12 +4193,29 @@ class Config:
             pass
 
     def save(self):
+        self.save_timer.cancel()
+        self.dirty = False
         fp = open(configdb_file, "w")
         try:
             fp.write("data = " + repr(self.db))
         finally:
             fp.close()
 
+    def save_later(self):
+        """
+        Saves the configuration within "config_save_delay" seconds.
+        For changes made on the background or while sending, which
+        may come often, and are not worth rewriting the whole file
+        for each time.
+        """
+        if not self.dirty:
+            self.dirty = True
+            self.save_timer.after(config_save_delay, self.save)
+
+    def close(self):
+        if self.dirty:
+            self.save()
+
     # ------------------------------------------------------------------
     # apid...
 
@@ -1210,6 +4292,58 @@ class Config:
     def toggle_btprox_scan(self):
         self.set_btprox_scan(not self.get_btprox_scan())
 
+    def get_btprox_background(self):
+        """
+        Whether btprox scanning is done periodically on the
+        background, rather than just prior to a send.
+        """
+        return self.db.get("btprox_background", False)
+
+    def set_btprox_background(self, on):
+        if self.get_btprox_background() == on:
+            return
+        self.db["btprox_background"] = on
+        self.save()
+        appuifw.note(u"Background BT scanning %s" % (on and "enabled" or "disabled"), "info")
+
+    def toggle_btprox_background(self):
+        self.set_btprox_background(not self.get_btprox_background())
+
+    def get_btprox_interval(self):
+        """
+        The number of seconds between background btprox scans while
+        the devices around us keep changing.
+        """
+        return self.db.get("btprox_interval", 60)
+
+    def get_btprox_max_interval(self):
+        """
+        The number of seconds that the interval between background
+        btprox scans grows to while the devices stay the same.
+        """
+        return self.db.get("btprox_max_interval", 480)
+
+    def get_btprox_window(self):
+        """
+        The number of seconds for which a device seen by background
+        btprox scanning is still included in cards.
+        """
+        return self.db.get("btprox_window", 120)
+
+    def get_btprox_max_devices(self):
+        """
+        The number of devices after which a btprox scan ends.
+        """
+        return self.db.get("btprox_max_devices", 50)
+
+    def get_btprox_inquiry_only(self):
+        """
+        Whether btprox scans skip asking devices for their names,
+        where possible, taking the names from those looked up
+        earlier instead.
+        """
+        return self.db.get("btprox_inquiry_only", True)
+
     # ------------------------------------------------------------------
     # gps_scan...
 
@@ -1253,6 +4387,339 @@ class Config:
     def toggle_store_on(self):
         self.set_store_on(not self.get_store_on())
 
+    # ------------------------------------------------------------------
+    # keep_alive...
+
+    def get_keep_alive(self):
+        """
+        Whether to keep the connection to the server open between
+        requests.
+        """
+        return self.db.get("keep_alive", True)
+
+    def set_keep_alive(self, on):
+        if self.get_keep_alive() == on:
+            return
+        self.db["keep_alive"] = on
+        self.save()
+
+    def get_keep_alive_idle(self):
+        """
+        How long (in seconds) a kept connection may be idle before we
+        close it.
+        """
+        return self.db.get("keep_alive_idle", 30)
+
+    def get_prewarm_on(self):
+        """
+        Whether to bring up the network connection while scanning for
+        context, before the card is ready to be sent.
+        """
+        return self.db.get("prewarm_on", True)
+
+    def get_prewarm_connect(self):
+        """
+        Whether prewarming includes connecting to the server, and not
+        just bringing up the access point.
+        """
+        return self.db.get("prewarm_connect", True)
+
+    def get_prewarm_idle(self):
+        """
+        The number of seconds after which an unused prewarmed
+        connection is torn down.
+        """
+        return self.db.get("prewarm_idle", 60)
+
+    def get_concurrent_scan(self):
+        """
+        Whether to do all context scans at once, rather than one
+        after another.
+        """
+        return self.db.get("concurrent_scan", True)
+
+    def get_scan_deadline(self):
+        """
+        The number of seconds after which to send a card with whatever
+        context has been scanned, when scanning concurrently.
+        """
+        return self.db.get("scan_deadline", 20)
+
+    def get_gsm_tracking(self):
+        """
+        Whether the GSM cell is tracked on the background, rather
+        than looked up just prior to a send.
+        """
+        return self.db.get("gsm_tracking", True)
+
+    def get_gsm_min_interval(self):
+        """
+        The number of seconds between GSM cell samples right after
+        the cell has changed.
+        """
+        return self.db.get("gsm_min_interval", 10)
+
+    def get_gsm_max_interval(self):
+        """
+        The number of seconds that the interval between GSM cell
+        samples grows to while the cell stays the same.
+        """
+        return self.db.get("gsm_max_interval", 120)
+
+    def get_gsm_log_size(self):
+        """
+        The number of GSM cell changes to remember.
+        """
+        return self.db.get("gsm_log_size", 20)
+
+    def get_gsm_history_window(self):
+        """
+        The number of seconds for which GSM cell changes are included
+        in cards. Zero leaves them out.
+        """
+        return self.db.get("gsm_history_window", 900)
+
+    def get_position_acquire(self):
+        """
+        Whether to ask positioning modules for a position before a
+        send, when there is no recent fix from GPS scanning.
+        """
+        return self.db.get("position_acquire", True)
+
+    def get_position_modules(self):
+        """
+        The names of the positioning modules to ask for a position,
+        or None for all the available ones.
+        """
+        return self.db.get("position_modules", None)
+
+    def get_position_accuracy(self):
+        """
+        The horizontal accuracy in meters that a fix must have for it
+        to be taken without waiting for the other modules.
+        """
+        return self.db.get("position_accuracy", 500)
+
+    def get_position_deadline(self):
+        """
+        The number of seconds after which to give up on getting a
+        position, taking the best fix so far, if any.
+        """
+        return self.db.get("position_deadline", 15)
+
+    def get_position_interval(self):
+        """
+        The number of seconds between positions in continuous
+        positioning with a "PositionStream".
+        """
+        return self.db.get("position_interval", 10)
+
+    def get_position_update_timeout(self):
+        """
+        The number of seconds a "PositionStream" waits for a position
+        before giving up on the request.
+        """
+        return self.db.get("position_update_timeout", 90)
+
+    def get_position_buffer_size(self):
+        """
+        The number of fixes a "PositionStream" keeps.
+        """
+        return self.db.get("position_buffer_size", 60)
+
+    def get_position_batch_size(self):
+        """
+        The number of fixes a "PositionStream" passes to its
+        subscribers at a time.
+        """
+        return self.db.get("position_batch_size", 6)
+
+    def get_context_max_age(self, source):
+        """
+        The number of seconds for which a scanned value of the named
+        context source (one of "context_sources") is reused for
+        sending, rather than scanned anew. Zero disables reuse.
+        """
+        return self.db.get("%s_max_age" % source,
+                           {"gsm": 60, "btprox": 30, "gps": 30}[source])
+
+    def get_connect_timeout(self):
+        """
+        The number of seconds within which connecting to the server
+        must complete.
+        """
+        return self.db.get("connect_timeout", 30)
+
+    def get_write_timeout(self):
+        """
+        The number of seconds within which each block of a request
+        must get written.
+        """
+        return self.db.get("write_timeout", 30)
+
+    def get_response_timeout(self):
+        """
+        The number of seconds within which the server must respond
+        after the whole request has been written.
+        """
+        return self.db.get("response_timeout", 60)
+
+    def get_min_upload_bps(self):
+        """
+        The rate in bytes per second below which a transfer is
+        considered stalled, if it stays below it for a stall window.
+        """
+        return self.db.get("min_upload_bps", 128)
+
+    def get_stall_window(self):
+        """
+        The number of seconds over which the transfer rate is checked
+        for stalls.
+        """
+        return self.db.get("stall_window", 30)
+
+    def get_dns_ttl(self):
+        """
+        The number of seconds for which a looked up server address
+        is used.
+        """
+        return self.db.get("dns_ttl", 3600)
+
+    def get_batch_envelope(self):
+        """
+        Whether several cards going out together are to be sent as a
+        single batch request, rather than back-to-back.
+        """
+        return self.db.get("batch_envelope", False)
+
+    # ------------------------------------------------------------------
+    # compression...
+
+    def get_compress_on(self):
+        """
+        Whether to compress compressible card parts for sending.
+        """
+        return self.db.get("compress_on", False)
+
+    def set_compress_on(self, on):
+        if self.get_compress_on() == on:
+            return
+        self.db["compress_on"] = on
+        self.save()
+        appuifw.note(u"Compression %s" % (on and "enabled" or "disabled"), "info")
+
+    def toggle_compress_on(self):
+        self.set_compress_on(not self.get_compress_on())
+
+    def get_metadata_codec(self):
+        """
+        The name of the codec to encode card metadata with.
+        """
+        return self.db.get("metadata_codec", "json")
+
+    def set_metadata_codec(self, name):
+        if self.get_metadata_codec() == name:
+            return
+        self.db["metadata_codec"] = name
+        self.save()
+        appuifw.note(u"Metadata encoding %s" % name, "info")
+
+    def toggle_binary_metadata(self):
+        if self.get_metadata_codec() == "binary":
+            self.set_metadata_codec("json")
+        else:
+            self.set_metadata_codec("binary")
+
+    def get_compression_stats(self):
+        """
+        Returns the number of compressed cards, and the total size of
+        their compressed parts before and after compression.
+        """
+        return self.db.get("compression_stats", (0, 0, 0))
+
+    def get_compression_log(self):
+        """
+        Returns the (time, size before, size after) of the compressed
+        parts of the latest compressed cards, oldest first.
+        """
+        return self.db.get("compression_log", [])
+
+    def add_compression_stats(self, raw_len, deflated_len):
+        cards, raw, deflated = self.get_compression_stats()
+        self.db["compression_stats"] = (cards + 1, raw + raw_len,
+                                        deflated + deflated_len)
+        log = self.get_compression_log() + \
+              [(int(time.time()), raw_len, deflated_len)]
+        self.db["compression_log"] = log[-compression_log_size:]
+        self.save_later()
+
+    # ------------------------------------------------------------------
+    # upload profile...
+
+    def get_upload_profile(self):
+        """
+        The maximum dimension and JPEG quality of the pictures to
+        upload, as a pair, or None if pictures are to be uploaded as
+        they are.
+        """
+        return self.db.get("upload_profile", (1024, 75))
+
+    def set_upload_profile(self, profile):
+        if self.get_upload_profile() == profile:
+            return
+        self.db["upload_profile"] = profile
+        self.save()
+
+    # ------------------------------------------------------------------
+    # dedup...
+
+    def get_dedup_on(self):
+        """
+        Whether to ask the server if it already has the picture
+        before sending it.
+        """
+        return self.db.get("dedup_on", True)
+
+    def get_resumable_on(self):
+        """
+        Whether to upload large attachments in parts, so that an
+        interrupted upload can be resumed.
+        """
+        return self.db.get("resumable_on", True)
+
+    # ------------------------------------------------------------------
+    # outbox...
+
+    def get_outbox_on(self):
+        """
+        Whether stored cards are to be sent on the background.
+        """
+        return self.db.get("outbox_on", True)
+
+    def set_outbox_on(self, on):
+        if self.get_outbox_on() == on:
+            return
+        self.db["outbox_on"] = on
+        self.save()
+        appuifw.note(u"Sending stored cards %s" % (on and "enabled" or "disabled"), "info")
+
+    def toggle_outbox_on(self):
+        self.set_outbox_on(not self.get_outbox_on())
+
+    def get_outbox_max_in_flight(self):
+        """
+        The maximum number of stored card requests being sent at any
+        one time.
+        """
+        return self.db.get("outbox_max_in_flight", 1)
+
+    def get_outbox_batch_size(self):
+        """
+        The maximum number of stored cards to send over one
+        connection in one go.
+        """
+        return self.db.get("outbox_batch_size", 5)
+
 class Engine:
     """
     This engine object maintains the model of the application. The
@@ -1268,7 +4735,8 @@ class Engine:
         self.config = Config()
         self.apply_debug_config()
 
-        self.scanner_sender = ScannerSender(self.config)
+        self.outbox = Outbox(self.config)
+        self.scanner_sender = ScannerSender(self.config, self.outbox)
         self.card = Card(self.config, lambda field: None)
         self._init_gps_scanner()
         self.reader = FiledataReader(self._new_filedata)
@@ -1276,6 +4744,7 @@ class Engine:
         self._configdb_loaded()
 
         self.context_start_scanning()
+        self.outbox.start()
         
     def is_ready_to_send(self):
         if not self.card.validate():
@@ -1302,6 +4771,10 @@ class Engine:
             return
         if self.config.get_gps_scan():
             self._gps_start_scanning()
+        if self.config.get_gsm_tracking():
+            self.scanner_sender.cell_tracker.start()
+        if self.config.get_btprox_background():
+            self.scanner_sender.btprox_monitor.start()
         ut.report("context scanning started")
         
     def context_stop_scanning(self):
@@ -1309,6 +4782,8 @@ class Engine:
         Stops all constant context scanning.
         """
         self._gps_stop_scanning()
+        self.scanner_sender.cell_tracker.stop()
+        self.scanner_sender.btprox_monitor.stop()
         ut.report("context scanning stopped")
 
     def _init_gps_scanner(self):
@@ -1355,10 +4830,16 @@ class Engine:
         if self.gps_scanner is not None:
             self.gps_scanner.stop()
         self.card.set_gps(None)
+        self.scanner_sender.gps_fix = None
+        self.scanner_sender.context.forget("gps")
 
     def _gps_scanned(self, data):
         #print repr(data)
         self.card.set_gps(data)
+        self.scanner_sender.gps_fix = data
+        if data is not None:
+            # A fix lost just now is still good for a while.
+            self.scanner_sender.context.put("gps", data)
 
     def edit_gps_config(self):
         if not self.gps_scanner:
@@ -1399,9 +4880,35 @@ class Engine:
     def show_gsm(self):
         self.card.view_gsm()
 
-    def _new_filedata(self, desc, data):
+    def toggle_outbox_on(self):
+        self.config.toggle_outbox_on()
+        self.outbox.poke()
+
+    def toggle_btprox_background(self):
+        self.config.toggle_btprox_background()
+        if self.config.get_btprox_background():
+            self.context_start_scanning()
+        else:
+            self.scanner_sender.btprox_monitor.stop()
+
+    def show_compression_stats(self):
+        cards, raw, deflated = self.config.get_compression_stats()
+        if not raw:
+            appuifw.note(u"No cards compressed", "info")
+            return
+        text = u"%d cards, %d kB saved (%d%%)" % \
+               (cards, (raw - deflated) / 1024,
+                ((raw - deflated) * 100) / raw)
+        log = self.config.get_compression_log()
+        if log:
+            t, raw, deflated = log[-1]
+            if raw:
+                text += u", last card %d%%" % (((raw - deflated) * 100) / raw)
+        appuifw.note(text, "info")
+
+    def _new_filedata(self, desc, fname):
         appuifw.note(u"New data file acquired", "info")
-        self.card.set_filedata(desc, data)
+        self.card.set_filedata_file(desc, fname)
         self.filedata_cb()
 
     _setting_map = [
@@ -1523,6 +5030,19 @@ class Engine:
     def show_log_file(self):
         ut.show_log(tpytwink_logdir)
 
+    _upload_profiles = [
+        (u"Original", None),
+        (u"Large (1600 px)", (1600, 85)),
+        (u"Medium (1024 px)", (1024, 75)),
+        (u"Small (640 px)", (640, 70))
+        ]
+
+    def select_upload_profile(self):
+        chlist = [ n for n, p in self._upload_profiles ]
+        index = appuifw.popup_menu(chlist, u'Picture size to send')
+        if index is not None:
+            self.config.set_upload_profile(self._upload_profiles[index][1])
+
     def select_camera_uid(self):
         old_uid = self.config.db.get("camera_uid", 0x101ffa86)
         nums = [0x101ffa86, 0x101f857a]
@@ -1572,11 +5092,17 @@ class Engine:
                 self.card.set_picfile(new_picfile)
 
     def start_observing_filedata(self, cb):
+        """
+        While waiting for file data, the context is kept fresh, so
+        that the card can be sent as soon as the data arrives.
+        """
         self.filedata_cb = cb
         self.reader.start_observing()
+        self.scanner_sender.refresh_context()
 
     def stop_observing_filedata(self):
         self.reader.stop_observing()
+        self.scanner_sender.stop_refreshing()
 
     def is_observing_filedata(self):
         return self.reader.is_observing()
@@ -1585,4 +5111,6 @@ class Engine:
         if self.gps_scanner:
             self.gps_scanner.close()
         self.scanner_sender.close()
+        self.outbox.close()
         self.reader.close()
+        self.config.close()
@@ -332,6 +332,7 @@ class App:
             toggle_gps_scan,
             toggle_btprox_scan,
             (u"Change access point", self.engine.config.change_apid),
+            (u"Picture size to send", self.engine.select_upload_profile),
             toggle_store_on
             ])
         if self.engine.get_debug_on():
@@ -351,6 +352,11 @@ class App:
                 (u"Remove context", self.engine.card.clear_context),
                 (u"Remove access point", self.clear_ap),
                 (u"Toggle scanning", self.engine.config.toggle_noscan),
+                (u"Toggle outbox", self.engine.toggle_outbox_on),
+                (u"Toggle background BT", self.engine.toggle_btprox_background),
+                (u"Toggle compression", self.engine.config.toggle_compress_on),
+                (u"View compression", self.engine.show_compression_stats),
+                (u"Toggle binary metadata", self.engine.config.toggle_binary_metadata),
                 (u"Select Camera UID", self.engine.select_camera_uid)
                 ])
         main_menu.append((u"Exit Tpytwink", self.abort))
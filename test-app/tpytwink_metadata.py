@@ -0,0 +1,321 @@
+#
+# Copyright 2007 Helsinki Institute for Information Technology (HIIT)
+# and the authors.  All rights reserved.
+#
+# Authors: Tero Hasu <tero.hasu@hut.fi>
+#
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Codecs for the card metadata. The codec used for a card is
+identified by the Content-Type of its metadata part, so that the
+receiver knows how to decode it.
+
+Besides JSON, there is a compact binary encoding, in which dictionary
+keys known to appear in card metadata are sent as small integers,
+integers as variable length integers, floats as 4 bytes if that
+loses nothing and as 8 bytes otherwise, and Bluetooth addresses as 6
+bytes. This module has no Symbian specific dependencies, so that it
+may also be used on a PC.
+"""
+
+import binascii
+import struct
+
+import simplejson
+
+class JsonCodec:
+    name = "json"
+    content_type = "application/json; charset=UTF-8"
+    filename = "postcard-metadata.json"
+    binary = False
+
+    def encode(self, obj):
+        return simplejson.dumps(obj)
+
+    def encode_item(self, key, value):
+        """
+        Encodes one dictionary item, for "join_items" to put together
+        into a dictionary. This allows the encoded items to be cached.
+        """
+        return simplejson.dumps(key) + ": " + simplejson.dumps(value)
+
+    def join_items(self, items):
+        return "{" + ", ".join(items) + "}"
+
+    def decode(self, data):
+        return simplejson.loads(data)
+
+# --------------------------------------------------------------------
+# binary encoding...
+
+# The first bytes of a binary encoded value, ending with the format
+# version.
+binary_magic = "TPM\x01"
+
+# Dictionary keys that are encoded as their index in this list. This
+# list may only ever be appended to, as both ends must agree on it.
+binary_keys = [
+    # card
+    "sender", "receiver", "status", "gps", "bt scan", "gsm", "time",
+    "data filename", "photo filename",
+    # contacts
+    "title", "first_name", "second_name", "last_name", "email_address",
+    "first_name_reading", "last_name_reading",
+    # gsm
+    "country code", "network code", "area code", "cell id",
+    # time
+    "timezone", "daylight", "altzone",
+    # bt scan
+    "mac", "name",
+    # gps
+    "position", "course", "satellites",
+    "latitude", "longitude", "altitude",
+    "vertical_accuracy", "horizontal_accuracy",
+    "speed", "heading", "speed_accuracy", "heading_accuracy",
+    "horizontal_dop", "vertical_dop", "time_dop",
+    "used_satellites",
+    # gsm history
+    "gsm history"
+    ]
+
+binary_key_codes = {}
+for i in range(len(binary_keys)):
+    binary_key_codes[binary_keys[i]] = i
+
+# True and False are mere ints before Python 2.3, in which case they
+# are encoded as such.
+bool_type = type(True)
+if bool_type is int:
+    bool_type = None
+
+def _varint(n, out):
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n = n >> 7
+    out.append(chr(n))
+
+def _pack_mac(s):
+    """
+    Returns a Bluetooth address of the form "00:11:22:aa:bb:cc" as 6
+    bytes, or None if the string is not of that form (in lower case).
+    """
+    if len(s) != 17 or s[2] != ":" or s[14] != ":":
+        return None
+    try:
+        packed = binascii.unhexlify(str(s.replace(":", "")))
+    except (TypeError, UnicodeError, binascii.Error):
+        return None
+    if len(packed) != 6 or _unpack_mac(packed) != s:
+        return None
+    return packed
+
+def _unpack_mac(packed):
+    h = binascii.hexlify(packed)
+    return h[0:2] + ":" + h[2:4] + ":" + h[4:6] + ":" + \
+           h[6:8] + ":" + h[8:10] + ":" + h[10:12]
+
+def _encode(obj, out):
+    t = type(obj)
+    if t is dict:
+        out.append("m")
+        _varint(len(obj), out)
+        for key, value in obj.items():
+            code = binary_key_codes.get(key)
+            if code is None:
+                key = unicode(key).encode("utf-8")
+                _varint(len(key) * 2, out)
+                out.append(key)
+            else:
+                _varint(code * 2 + 1, out)
+            _encode(value, out)
+    elif t is unicode or t is str:
+        packed = _pack_mac(obj)
+        if packed is not None:
+            out.append("a")
+            out.append(packed)
+            return
+        if t is unicode:
+            out.append("u")
+            obj = obj.encode("utf-8")
+        else:
+            out.append("s")
+        _varint(len(obj), out)
+        out.append(obj)
+    elif t is list or t is tuple:
+        out.append("l")
+        _varint(len(obj), out)
+        for item in obj:
+            _encode(item, out)
+    elif obj is None:
+        out.append("N")
+    elif bool_type is not None and t is bool_type:
+        out.append(obj and "T" or "F")
+    elif t is int or t is long:
+        out.append("i")
+        if obj < 0:
+            _varint(-obj * 2 - 1, out)
+        else:
+            _varint(obj * 2, out)
+    elif t is float:
+        try:
+            packed = struct.pack(">f", obj)
+            if struct.unpack(">f", packed)[0] != obj:
+                packed = None
+        except (OverflowError, SystemError, struct.error):
+            packed = None
+        if packed is None:
+            out.append("d")
+            out.append(struct.pack(">d", obj))
+        else:
+            out.append("f")
+            out.append(packed)
+    else:
+        raise TypeError("cannot encode %s" % repr(t))
+
+class Decoder:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, n):
+        pos = self.pos
+        if pos + n > len(self.data):
+            raise ValueError("truncated metadata")
+        self.pos = pos + n
+        return self.data[pos:pos+n]
+
+    def varint(self):
+        n = 0
+        shift = 0
+        while 1:
+            b = ord(self.take(1))
+            n = n | ((b & 0x7f) << shift)
+            if b < 0x80:
+                return n
+            shift = shift + 7
+
+    def value(self):
+        tag = self.take(1)
+        if tag == "m":
+            d = {}
+            for i in range(self.varint()):
+                code = self.varint()
+                if code & 1:
+                    key = binary_keys[code >> 1]
+                else:
+                    key = self.take(code >> 1).decode("utf-8")
+                    try:
+                        key = str(key)
+                    except UnicodeError:
+                        pass
+                d[key] = self.value()
+            return d
+        elif tag == "u":
+            return self.take(self.varint()).decode("utf-8")
+        elif tag == "s":
+            return self.take(self.varint())
+        elif tag == "a":
+            return _unpack_mac(self.take(6))
+        elif tag == "l":
+            return [ self.value() for i in range(self.varint()) ]
+        elif tag == "N":
+            return None
+        elif tag == "T":
+            return True
+        elif tag == "F":
+            return False
+        elif tag == "i":
+            n = self.varint()
+            if n & 1:
+                return -((n + 1) >> 1)
+            return n >> 1
+        elif tag == "f":
+            return struct.unpack(">f", self.take(4))[0]
+        elif tag == "d":
+            return struct.unpack(">d", self.take(8))[0]
+        raise ValueError("bad tag %s" % repr(tag))
+
+class BinaryCodec:
+    name = "binary"
+    content_type = "application/x-tpytwink-metadata"
+    filename = "postcard-metadata.bin"
+    binary = True
+
+    def encode(self, obj):
+        out = [binary_magic]
+        _encode(obj, out)
+        return "".join(out)
+
+    def encode_item(self, key, value):
+        out = []
+        _encode({key: value}, out)
+        # Without the dictionary tag and the item count of 1.
+        return "".join(out[2:])
+
+    def join_items(self, items):
+        out = [binary_magic, "m"]
+        _varint(len(items), out)
+        out.extend(items)
+        return "".join(out)
+
+    def decode(self, data):
+        if data[:len(binary_magic)] != binary_magic:
+            raise ValueError("not binary metadata")
+        decoder = Decoder(data)
+        decoder.pos = len(binary_magic)
+        value = decoder.value()
+        if decoder.pos != len(data):
+            raise ValueError("trailing data after metadata")
+        return value
+
+# --------------------------------------------------------------------
+# codec registry...
+
+json_codec = JsonCodec()
+binary_codec = BinaryCodec()
+
+codecs = {}
+
+def register_codec(codec):
+    codecs[codec.name] = codec
+
+register_codec(json_codec)
+register_codec(binary_codec)
+
+def get_codec(name):
+    """
+    Returns the named codec, or the JSON codec if there is no such
+    codec.
+    """
+    return codecs.get(name, json_codec)
+
+def codec_for_content_type(ctype):
+    """
+    Returns the codec for the given metadata part Content-Type, or
+    None if none matches.
+    """
+    ctype = ctype.split(";")[0].strip().lower()
+    for codec in codecs.values():
+        if codec.content_type.split(";")[0] == ctype:
+            return codec
+    return None
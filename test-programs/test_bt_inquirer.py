@@ -0,0 +1,36 @@
+import e32
+
+from pytwink import BtInquirer
+
+inquirer = BtInquirer()
+
+myLock = e32.Ao_lock()
+
+found = []
+
+def cb(errCode, mac, name):
+    print repr((errCode, mac, name))
+    if errCode:
+        myLock.signal()
+    else:
+        found.append(mac)
+        inquirer.next()
+
+def name_cb(errCode, mac, name):
+    print repr((errCode, mac, name))
+    myLock.signal()
+
+try:
+    print "discovering without names"
+    inquirer.discover(0, cb)
+    inquirer.cancel()
+    inquirer.discover(0, cb)
+    myLock.wait()
+    for mac in found:
+        print "looking up name of %s" % mac
+        inquirer.lookup_name(mac, name_cb)
+        myLock.wait()
+finally:
+    inquirer.close()
+
+print "all done"
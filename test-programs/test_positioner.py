@@ -26,6 +26,7 @@ else:
         print repr(errCode)
         if not errCode:
             print repr(positioner.get_position())
+            print repr(positioner.get_fix())
         myLock.signal()
 
     try: